@@ -0,0 +1,122 @@
+import logging
+import re
+
+import voluptuous as vol
+
+from homeassistant.const import Platform
+from homeassistant.core import SupportsResponse
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.discovery import async_load_platform
+
+from soliscontrol import solis_common as common
+
+from .const import DOMAIN, REQUIRED_KEYS, SLOTS, CONF_STATION_ID
+from .coordinator import SolisControlCoordinator
+
+""" Native Home Assistant integration for controlling Solis inverters via the Solis Cloud API
+
+Uses the async client (solis_control_async_mod) on the Home Assistant aiohttp session so there are no
+executor jobs - see coordinator.py. Configured in configuration.yaml with one entry for each inverter
+using the same settings as main.yaml and secrets.yaml (see README.md) eg
+
+solis_control:
+  - solis_key_id: !secret solis_key_id
+    solis_key_secret: !secret solis_key_secret
+    solis_user_name: !secret solis_user_name
+    solis_password: !secret solis_password
+    solis_station_id: !secret solis_station_id
+    battery_capacity: 7.1
+    battery_max_current: 74
+    inverter_max_current: 62.5
+    charge_period:
+      start: "02:00"
+      end: "05:00"
+      current: 50
+    scan_interval: 300 # seconds (optional)
+
+Exposes SOC and the charge/discharge slots as sensors and the set_inverter_slot and set_inverter_times services"""
+
+log = logging.getLogger(__name__)
+
+HHMM_REGEX = re.compile(r'([01]\d|20|21|22|23):[0-5]\d$')
+
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.All(cv.ensure_list, [ vol.Schema({ vol.Required(k): vol.Any(str, int, float) for k in REQUIRED_KEYS }, extra=vol.ALLOW_EXTRA) ])
+}, extra=vol.ALLOW_EXTRA)
+
+SET_SLOT_SCHEMA = vol.Schema({
+    vol.Optional('start', default='00:00'): vol.Match(HHMM_REGEX),
+    vol.Optional('end', default='00:00'): vol.Match(HHMM_REGEX),
+    vol.Optional('slot', default='c3'): vol.In(SLOTS),
+    vol.Optional('amps', default=50): vol.Coerce(int),
+    vol.Optional('station_id'): cv.string,
+})
+
+SET_TIMES_SCHEMA = vol.Schema({
+    vol.Required('period_name'): cv.string,
+    vol.Required('minutes'): vol.Coerce(int),
+    vol.Optional('station_id'): cv.string,
+})
+
+def get_coordinator(hass, station_id=None):
+    # the coordinator for a station (station_id can be left out if there is only one)
+    coordinators = hass.data[DOMAIN]
+    if station_id is None:
+        if len(coordinators) != 1:
+            raise HomeAssistantError('station_id is required when there is more than one inverter')
+        return next(iter(coordinators.values()))
+    if str(station_id) not in coordinators:
+        raise HomeAssistantError("Unknown station_id '%s'" % station_id)
+    return coordinators[str(station_id)]
+
+async def async_setup(hass, config):
+    session = async_get_clientsession(hass)
+    coordinators = {}
+    for station in config[DOMAIN]:
+        station = dict(station)
+        station[CONF_STATION_ID] = str(station[CONF_STATION_ID])
+        coordinator = SolisControlCoordinator(hass, station, session)
+        await coordinator.async_refresh() # entities show as unavailable until a poll succeeds
+        coordinators[coordinator.station_id] = coordinator
+    hass.data[DOMAIN] = coordinators
+    hass.async_create_task(async_load_platform(hass, Platform.SENSOR, DOMAIN, {}, config))
+
+    async def set_inverter_slot(call):
+        start = call.data['start']
+        end = call.data['end']
+        slot = call.data['slot']
+        amps = call.data['amps']
+        if start > end:
+            raise HomeAssistantError("Setting solis inverter times not possible - start time '%s' is after end time '%s'" % (start, end))
+        coordinator = get_coordinator(hass, call.data.get('station_id'))
+        charge = not slot.startswith('d')
+        params = { 'start': start, 'end': end, 'amps': str(amps) }
+        result = await coordinator.set_schedule([ (params, charge, int(slot[1:]) - 1) ], amps=amps)
+        if not common.write_ok(result):
+            raise HomeAssistantError(result)
+        cdtype = 'Charge' if charge else 'Discharge'
+        return { 'status': 'OK', 'message': '%s time slot %s: set from %s to %s @ %sA' % (cdtype, slot, start, end, str(amps)) }
+
+    async def set_inverter_times(call):
+        period_name = call.data['period_name']
+        coordinator = get_coordinator(hass, call.data.get('station_id'))
+        config_period = None
+        for p in coordinator.periods:
+            if p['name'] == period_name:
+                config_period = p
+                break
+        if not config_period:
+            raise HomeAssistantError("Setting solis inverter times not possible - invalid period_name '%s' supplied" % period_name)
+        start, end = common.start_end_from_minutes(config_period, call.data['minutes'])
+        start, end = common.limit_times(config_period, start, end)
+        params = { 'start': start, 'end': end, 'amps': str(config_period['current']) }
+        result = await coordinator.set_schedule([ (params, config_period['charge'], config_period['timeslot']) ])
+        if not common.write_ok(result):
+            raise HomeAssistantError(result)
+        return { 'status': 'OK', 'message': '%s: set from %s to %s @%sA' % (period_name, start, end, str(config_period['current'])) }
+
+    hass.services.async_register(DOMAIN, 'set_inverter_slot', set_inverter_slot, schema=SET_SLOT_SCHEMA, supports_response=SupportsResponse.OPTIONAL)
+    hass.services.async_register(DOMAIN, 'set_inverter_times', set_inverter_times, schema=SET_TIMES_SCHEMA, supports_response=SupportsResponse.OPTIONAL)
+    return True
@@ -0,0 +1,7 @@
+DOMAIN = 'solis_control'
+DEFAULT_SCAN_INTERVAL = 300 # seconds between polls of each inverter
+CONF_SCAN_INTERVAL = 'scan_interval'
+CONF_STATION_ID = 'solis_station_id'
+REQUIRED_KEYS = ( 'solis_key_id', 'solis_key_secret', 'solis_user_name', 'solis_password', 'solis_station_id',
+    'battery_capacity', 'battery_max_current', 'inverter_max_current' )
+SLOTS = ( 'c1', 'c2', 'c3', 'd1', 'd2', 'd3' )
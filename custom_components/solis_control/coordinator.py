@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from datetime import timedelta
+
+from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
+
+from soliscontrol import solis_control_async_mod as solis_control
+from soliscontrol import solis_common as common
+
+from .const import DEFAULT_SCAN_INTERVAL, CONF_SCAN_INTERVAL, CONF_STATION_ID
+
+""" Update coordinator for one Solis inverter using the async client (solis_control_async_mod) on the
+shared Home Assistant aiohttp session - so polling runs on the event loop without any executor jobs
+
+Connection state is kept in the station's config dict as in the other clients. Each poll reads the
+inverter detail (SOC etc) and the charge/discharge schedule, connecting first if necessary. An expired
+login token is renewed and the call tried again, and any other failure means a full connect on the next poll"""
+
+log = logging.getLogger(__name__)
+
+class SolisControlCoordinator(DataUpdateCoordinator):
+
+    def __init__(self, hass, config, session):
+        super().__init__(hass, log, name='Solis station %s' % config[CONF_STATION_ID],
+            update_interval=timedelta(seconds=config.get(CONF_SCAN_INTERVAL, DEFAULT_SCAN_INTERVAL)))
+        self.config = config
+        self.session = session
+        self.connected = False
+        self.periods = common.extract_periods(config)
+        self.lock = asyncio.Lock() # one sequence of calls at a time for each inverter (eg a service write during a poll)
+
+    @property
+    def station_id(self):
+        return self.config[CONF_STATION_ID]
+
+    async def ensure_connected(self):
+        if not self.connected:
+            for k in ('inverter_id', 'login_token', 'inverter_datetime'):
+                self.config.pop(k, None)
+            self.connected = await solis_control.connect(self.config, self.session)
+        return self.connected
+
+    async def call(self, func, *args, **kwargs):
+        # await func(config, session, *args, **kwargs) and if it fails because the token has expired, log in again and try once more
+        self.config.pop('last_error', None)
+        result = await func(self.config, self.session, *args, **kwargs)
+        if self.config.get('last_error') and common.last_error_kind(self.config) == 'token':
+            self.config.pop('login_token', None)
+            if await solis_control.get_login_detail(self.config, self.session):
+                self.config.pop('last_error', None)
+                result = await func(self.config, self.session, *args, **kwargs)
+        return result
+
+    def last_error(self, default):
+        error = self.config.get('last_error')
+        return error['msg'] if error and error.get('msg') else default
+
+    async def _async_update_data(self):
+        async with self.lock:
+            try:
+                if not await self.ensure_connected():
+                    raise UpdateFailed('Could not connect to Solis API: %s' % self.last_error('unknown error'))
+                if not await self.call(solis_control.get_inverter_detail):
+                    self.connected = False
+                    raise UpdateFailed('Error getting inverter detail: %s' % self.last_error('no data'))
+                inverter_data = await self.call(solis_control.get_inverter_data)
+                if not inverter_data:
+                    self.connected = False
+                    raise UpdateFailed('Error getting charging/discharging times: %s' % self.last_error('no data'))
+            except common.SolisControlException as e:
+                self.connected = False
+                raise UpdateFailed(str(e)) from e
+        data = { k: self.config.get(k) for k in common.DETAIL_FIELDS.values() }
+        data['inverter_data'] = inverter_data
+        data.update(common.extract_inverter_data(inverter_data))
+        return data
+
+    async def set_schedule(self, edits, amps=None):
+        # write all the edits - a list of (params, charge, timeslot) - in one read and one write, returns 'OK' or an error message
+        # if amps is set it is checked against the inverter and battery limits first
+        async with self.lock:
+            try:
+                if not await self.ensure_connected():
+                    return 'Could not connect to Solis API'
+                if amps is not None:
+                    check = common.check_current(self.config, amps)
+                    if check != 'OK':
+                        return check
+                result = await self.call(solis_control.set_inverter_schedule, edits)
+            except common.SolisControlException as e:
+                self.connected = False
+                return str(e)
+        if common.write_ok(result):
+            await self.async_request_refresh()
+        return result
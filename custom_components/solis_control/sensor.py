@@ -0,0 +1,72 @@
+from homeassistant.components.sensor import SensorDeviceClass, SensorEntity, SensorStateClass
+from homeassistant.const import PERCENTAGE, UnitOfEnergy, UnitOfPower
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
+
+from .const import DOMAIN, SLOTS
+
+""" Sensors for each inverter - battery SOC, inverter power, energy today and one for each charge/discharge slot
+(state 'HH:MM to HH:MM @xxA' or 'Off' with the start, end and amps as attributes)"""
+
+VALUE_SENSORS = ( # (data key, name, device class, unit, state class)
+    ('battery_soc', 'Battery SOC', SensorDeviceClass.BATTERY, PERCENTAGE, SensorStateClass.MEASUREMENT),
+    ('battery_ods', 'Battery over discharge SOC', SensorDeviceClass.BATTERY, PERCENTAGE, None),
+    ('inverter_power', 'Inverter power', SensorDeviceClass.POWER, UnitOfPower.KILO_WATT, None),
+    ('energy_today', 'Energy today', SensorDeviceClass.ENERGY, UnitOfEnergy.KILO_WATT_HOUR, SensorStateClass.TOTAL_INCREASING),
+)
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    if discovery_info is None:
+        return
+    entities = []
+    for coordinator in hass.data[DOMAIN].values():
+        for key, name, device_class, unit, state_class in VALUE_SENSORS:
+            entities.append(SolisValueSensor(coordinator, key, name, device_class, unit, state_class))
+        for slot in SLOTS:
+            entities.append(SolisSlotSensor(coordinator, slot))
+    async_add_entities(entities)
+
+class SolisValueSensor(CoordinatorEntity, SensorEntity):
+
+    def __init__(self, coordinator, key, name, device_class, unit, state_class):
+        super().__init__(coordinator)
+        self.key = key
+        self._attr_name = 'Solis %s %s' % (coordinator.station_id, name)
+        self._attr_unique_id = '%s_%s_%s' % (DOMAIN, coordinator.station_id, key)
+        self._attr_device_class = device_class
+        self._attr_native_unit_of_measurement = unit
+        self._attr_state_class = state_class
+
+    @property
+    def native_value(self):
+        if not self.coordinator.data:
+            return None
+        return self.coordinator.data.get(self.key)
+
+class SolisSlotSensor(CoordinatorEntity, SensorEntity):
+
+    def __init__(self, coordinator, slot):
+        super().__init__(coordinator)
+        self.charge = slot.startswith('c')
+        self.timeslot = int(slot[1:]) - 1
+        cdtype = 'charge' if self.charge else 'discharge'
+        self._attr_name = 'Solis %s %s slot %s' % (coordinator.station_id, cdtype, slot[1:])
+        self._attr_unique_id = '%s_%s_slot_%s' % (DOMAIN, coordinator.station_id, slot)
+
+    def params(self):
+        if not self.coordinator.data:
+            return None
+        slots = self.coordinator.data['charge_slots' if self.charge else 'discharge_slots']
+        return slots[self.timeslot]
+
+    @property
+    def native_value(self):
+        params = self.params()
+        if params is None:
+            return None
+        if params['start'] == '00:00' and params['end'] == '00:00':
+            return 'Off'
+        return '%s to %s @%sA' % (params['start'], params['end'], params['amps'])
+
+    @property
+    def extra_state_attributes(self):
+        return self.params()
@@ -9,5 +9,6 @@
       author_email='andrew@speakman.org.uk',
       url='https://github.com/aspeakman/soliscontrol',
       packages=['soliscontrol'],
-      install_requires=install_requires
+      install_requires=install_requires,
+      extras_require={ 'numpy': [ 'numpy' ] } # for the planner, tariff, ingest, calibrate and simulate modules
       )
\ No newline at end of file
@@ -3,11 +3,18 @@
 
 import solis_control_req_mod as solis_control
 import solis_common as common
+import solis_history as history
 try:
     import solis_s3_logger as logger
     DATA_LOGGER = True
 except ImportError:
     DATA_LOGGER = False
+try:
+    from soliscontrol import solis_bundle as bundle # installed (native) package so each operation is one task.executor job
+    NATIVE_BUNDLE = True
+except ImportError:
+    import solis_bundle as bundle # pyscript module so each request is a separate task.executor job
+    NATIVE_BUNDLE = False
     
 ENERGY_USE = 'energy_use_history'
 state.persist('pyscript.' + ENERGY_USE, default_value='')
@@ -15,7 +22,13 @@
 state.persist('pyscript.' + FORECAST_MULTIPLIERS, default_value='')
 FORECAST_YESTERDAY = 'solar_prediction_yesterday'
 state.persist('pyscript.' + FORECAST_YESTERDAY, default_value='')
-n_history = pyscript.app_config.get('history_days', 7) # number of old solar forecasts/ daily energy use values to store
+n_history = pyscript.app_config.get('history_days', 7) # number of old solar forecasts/ daily energy use values used
+try:
+    HISTORY_FOLDER = hass.config.path('pyscript', 'solis_history')
+except NameError: # hass_is_global not set
+    HISTORY_FOLDER = 'pyscript/solis_history'
+HISTORY_FOLDER = pyscript.app_config.get('history_folder', HISTORY_FOLDER) # ring buffer files holding the full history - see solis_history
+HISTORIES = {} # name -> ring buffer - see get_history()
     
 log_msg = 'Current energy %.1fkWh (%.0f%% SOC) -> set %s from %s to %s to reach %.1fkWh (%.0f%% SOC)'
 log_off_msg = 'Current energy %.1fkWh (%.0f%% SOC) -> set %s off (%s to %s) because %s'
@@ -24,6 +37,18 @@
 
 ENTITY_UNAVAILABLE = ( None, 'unavailable', 'unknown', 'none', 'None' )
 
+CONNECTION = {} # long lived connection handle shared by triggers and services - see get_connection()
+
+def get_connection(): # so back-to-back actions do not each need a full connect
+    if not CONNECTION:
+        CONNECTION.update(solis_control.open_connection(pyscript.app_config['solis_control']))
+    return CONNECTION
+
+def run_bundle(operation, *args, **kwargs): # see solis_bundle
+    if NATIVE_BUNDLE:
+        return task.executor(operation, *args, **kwargs)
+    return operation(*args, **kwargs)
+
 def sensor_get(entity_name): # sensor must exist
     entity_name = entity_name if entity_name.startswith('sensor.') else 'sensor.' + entity_name
     result = state.get(entity_name)
@@ -43,44 +68,43 @@ def pyscript_get(entity_name): # get pyscript state variable if it doesn't exist
         state.persist(entity_name, default_value='') 
         return ''
         
-def get_flist(list_name):
-    lf = pyscript_get(list_name)
-    if lf:
-        lf = lf.split(sep=',')
-        return [ float(f) for f in lf ]
-    else:
-        return []
+def get_history(list_name): # ring buffer for a list of daily values - the latest n_history are shown in the pyscript state
+    if list_name not in HISTORIES:
+        buf = history.open_history(HISTORY_FOLDER + '/' + list_name + '.bin', n_history)
+        if not buf['seq']: # migrate the values previously kept only in the pyscript state
+            lf = pyscript_get(list_name)
+            if lf:
+                history.extend(buf, [ float(f) for f in lf.split(sep=',') ])
+                log.info('Migrated %d values from pyscript.%s to %s' % (buf['seq'], list_name, buf['path']))
+        HISTORIES[list_name] = buf
+    return HISTORIES[list_name]
         
-def set_flist(list_name, values, maxlen=None, nround=1):
+def add_history(list_name, value, nround=1):
+    buf = get_history(list_name)
+    history.append(buf, round(value, nround))
     fstring = '{:.%df}' % nround
-    if not list_name.startswith('pyscript.'):
-        list_name = 'pyscript.' + list_name
-    lf = values[-maxlen:] if maxlen else values
-    lf = [ fstring.format(f) for f in lf ]
-    state.set(list_name, value=','.join(lf))
+    state.set('pyscript.' + list_name, value=','.join([ fstring.format(f) for f in history.values(buf) ]))
         
 def get_forecast(period_name=None, save=False):
     # get the solar forecast (in kWh) for the rest of the day (or if not available use average of last n_history)
     forecast = sensor_get(pyscript.app_config['forecast_remaining'])
     if period_name: # try to use old forecasts which are tied to a specific charge/discharge period
-        old_forecasts = period_name+'_forecasts'
-        lf = get_flist(old_forecasts)
+        old_forecasts = get_history(period_name+'_forecasts')
         if forecast is None:
-            forecast = sum(lf) / len(lf) if lf else 0.0 # use average of old forecasts if current solar power forecast not available
-            log.info('Forecast not available - using %.1fkWh (mean of last %d forecasts)', forecast, len(lf))
+            forecast = history.mean(old_forecasts) or 0.0 # use average of old forecasts if current solar power forecast not available
+            log.info('Forecast not available - using %.1fkWh (mean of last %d forecasts)', forecast, history.count(old_forecasts))
         forecast = float(forecast)
         if forecast and save:
-            lf.append(forecast)         # add new forecast to right side of list
-            set_flist(old_forecasts, lf, n_history)
+            add_history(period_name+'_forecasts', forecast)
     mtype = None
     if pyscript.app_config.get('forecast_multiplier'):
         mtype = 'fixed multiplier setting'
         multiplier = pyscript.app_config['forecast_multiplier']
     elif pyscript.app_config.get('forecast_tomorrow'):
-        lf = get_flist(FORECAST_MULTIPLIERS)
-        if lf:
-            multiplier = sum(lf) / len(lf)
-            mtype = 'mean of last %d multipliers' % len(lf)
+        multipliers = get_history(FORECAST_MULTIPLIERS)
+        if history.count(multipliers):
+            multiplier = history.mean(multipliers)
+            mtype = 'mean of last %d multipliers' % history.count(multipliers)
     if mtype and forecast:
         new_forecast = forecast * multiplier
         log.info('Forecast %.1fkWh * %.2f (%s) = %.1fkWh' % (forecast, multiplier, mtype, new_forecast))
@@ -124,15 +148,14 @@ def calc_requirement(config_period): # calculate requirement for this config_per
                 return -1.0 # do nothing
             req_kwh = float(result)
     else:
-        lf = get_flist(ENERGY_USE)
-        if not lf:
+        req_kwh = history.maximum(get_history(ENERGY_USE)) # maximum of the stored values
+        if req_kwh is None:
             sensor_name = pyscript.app_config.get('energy_monitor', 'solis_daily_grid_energy_used')
             st = sensor_get(sensor_name)
             if st:
-                lf = [ float(st) ]
+                req_kwh = float(st)
             else:
                 return -1.0 # do nothing
-        req_kwh = max(lf) # maximum of the stored values
     start = time.fromisoformat(config_period['start']+':00')
     prop_remain = (24.0 * 60.0 - (start.hour * 60.0) - start.minute) / (24.0 * 60.0) # proportion of day remaining
     result = req_kwh * prop_remain
@@ -148,50 +171,39 @@ def set_charge_discharge_times(**config_period):
         return
     forecast = get_forecast(config_period['name'], save=True)
     level_adjusted = calc_level(required, forecast, config_period['name'])
-    result = set_times(level_adjusted, config_period)
-    if result != 'OK': # handle payload error - "'code': 'B0115'," = the current datalogger is offline or disconnected?
-        task.sleep(config_period['cron_before'] * 30) # try again once after after half interval
-        log.info(result + ' - trying again')
-        set_times(level_adjusted, config_period)
+    set_times(level_adjusted, config_period)
         
 def set_times(level_required, config_period):
-    result = 'Cannot connect session'
-    with solis_control.get_session() as session:
-        config = dict(pyscript.app_config['solis_control'])
-        if DATA_LOGGER and config.get(logger.IP_FIELD) and config.get(logger.PASSWORD_FIELD):
-            logger.check_logger(config, session) # check if data logger is connected to inverter - if not restart it
-        connected = solis_control.connect(config, session)
-        if connected:
-            eah = config.get('energy_amp_hour')
-            unavailable_energy, full_energy, current_energy, real_soc = common.energy_values(config)
-            soc = (current_energy + unavailable_energy) / (full_energy + unavailable_energy) * 100.0 # state of battery charge
-            if config_period['charge']:
-                action = 'charge'
-                msg_expl = 'already above'
-                start, end, energy_after = common.charge_times(config_period, full_energy, current_energy, level_required, eah) # charge times to reach ideal energy level
-            else:
-                action = 'discharge'
-                msg_expl = 'already below'
-                start, end, energy_after = common.discharge_times(config_period, current_energy, level_required, eah) # discharge times to reach ideal energy level
-            start, end = common.limit_times(config_period, start, end)
-            after_soc = (energy_after + unavailable_energy) / (full_energy + unavailable_energy) * 100.0 # actual target state of charge
-            params = { 'start': start, 'end': end, 'amps': str(config_period['current']) }
-            result = solis_control.set_inverter_params(config, session, params, charge=config_period['charge'], timeslot=config_period['timeslot']) 
-            if result == 'OK':
-                set_times_entity(config_period, start, end)
-                if start == '00:00' and end == '00:00':
-                    log.info(log_off_msg, current_energy, soc, action, start, end, msg_expl)
-                else:
-                    log.info(log_msg, current_energy, soc, action, start, end, energy_after, after_soc)
-            else:
-                if start == '00:00' and end == '00:00':
-                    log.error(log_err_off_msg, current_energy, soc, action, start, end, msg_expl, result)
-                else:
-                    log.error(log_err_msg, current_energy, soc, action, start, end, energy_after, after_soc, result)
+    # transient errors (eg B0115 = datalogger offline) are retried within seconds - see solis_retry
+    # and all the calls must finish before the period starts - if not they are left for the next trigger
+    result = run_bundle(bundle.set_period_times, get_connection(), config_period, level_required, config_period['cron_before'] * 60)
+    if not result['planned']:
+        log.error('Setting %s times: %s' % (config_period['name'], result['message']))
+        return result['message']
+    start = result['start']
+    end = result['end']
+    current_energy = result['current_energy']
+    soc = result['soc']
+    if config_period['charge']:
+        action = 'charge'
+        msg_expl = 'already above'
+    else:
+        action = 'discharge'
+        msg_expl = 'already below'
+    if result['status'] == 'OK':
+        set_times_entity(config_period, start, end)
+        if start == '00:00' and end == '00:00':
+            log.info(log_off_msg, current_energy, soc, action, start, end, msg_expl)
         else:
-            result = 'Could not connect to Solis API'
-            log.error(result)
-    return result
+            log.info(log_msg, current_energy, soc, action, start, end, result['energy_after'], result['after_soc'])
+        if result['message'] == common.UNCHANGED_MSG:
+            log.info('Inverter already set - no write needed')
+    else:
+        if start == '00:00' and end == '00:00':
+            log.error(log_err_off_msg, current_energy, soc, action, start, end, msg_expl, result['message'])
+        else:
+            log.error(log_err_msg, current_energy, soc, action, start, end, result['energy_after'], result['after_soc'], result['message'])
+    return result['message']
     
 def set_times_entity(config_period, start='00:00', end='00:00'):
     # set entity exposing charge/discharge times after successful setting
@@ -216,9 +228,7 @@ def store_daily_energy_use():
     # whereas 'solis_daily_grid_energy_purchased' is just that which comes off the grid 
     st = sensor_get(sensor_name)
     if st:
-        lf = get_flist(ENERGY_USE)
-        lf.append(float(st))
-        set_flist(ENERGY_USE, lf, n_history)
+        add_history(ENERGY_USE, float(st))
         
 @time_trigger("cron(0 23 * * *)")
 def store_daily_solar_accuracy():
@@ -232,9 +242,7 @@ def store_daily_solar_accuracy():
         fy = fy.split(' ') if fy else []
         if len(fy) == 2 and fy[1] == yesterday.isoformat():
             multiplier = float(pv_today) / float(fy[0]) # multiplier to prediction to produce todays value
-            lf = get_flist(FORECAST_MULTIPLIERS)
-            lf.append(multiplier)
-            set_flist(FORECAST_MULTIPLIERS, lf, n_history, 2)
+            add_history(FORECAST_MULTIPLIERS, multiplier, 2)
             log.info("Forecast yesterday %s, solar energy today %s = multiplier %f" % (fy[0], pv_today, multiplier))
     forecast_tomorrow = sensor_get(forecast_tomorrow_sensor) # solar prediction tomorrow
     if forecast_tomorrow:
@@ -269,35 +277,8 @@ def test_solis(period_name, level_required, starting_level=None):
     if not config_period:
         result['message'] = "Test of solis inverter not possible - invalid period_name '%s' supplied" % period_name
         return result
-    with solis_control.get_session() as session:
-        config = dict(pyscript.app_config['solis_control'])
-        if DATA_LOGGER and config.get(logger.IP_FIELD) and config.get(logger.PASSWORD_FIELD):
-            logger.check_logger(config, session) # check if data logger is connected to inverter - if not restart it
-        connected = solis_control.connect(config, session)
-        if connected:
-            unavailable_energy, full_energy, current_energy, real_soc = common.energy_values(config)
-            current = '(%s-%s at %sA)' % (config_period['start'], config_period['end'],str(config_period['current']))
-            energy_start = float(starting_level) if starting_level is not None else -1.0
-            if period_name.startswith('charge'):
-                energy_start = 0.0 if energy_start < 0.0 or energy_start > full_energy else energy_start
-                start, end, energy_after = common.charge_times(config_period, full_energy, energy_start, level_required) 
-                # charge times from 0% to reach ideal energy level
-                action = 'charge'
-            else:
-                energy_start = full_energy if energy_start <= 0.0 or energy_start > full_energy else energy_start
-                start, end, energy_after = common.discharge_times(config_period, energy_start, level_required) 
-                # discharge times from 100% to reach ideal energy level
-                action = 'discharge'
-            start_soc = (energy_start + unavailable_energy) / (full_energy + unavailable_energy) * 100.0 # actual target state of charge
-            after_soc = (energy_after + unavailable_energy) / (full_energy + unavailable_energy) * 100.0 # actual target state of charge
-            #start, end = common.limit_times(config_period, start, end)
-            msg_expl = 'remain at' if start == '00:00' and end == '00:00' else 'reach'
-            msg = "'%s' %s notional %s times starting from %.1fkWh (%.0f%% SOC) -> %s to %s to %s %.1fkWh (%.0f%% SOC)"
-            result['message'] = msg % (period_name, current, action, energy_start, start_soc, start, end, msg_expl, energy_after, after_soc)
-            result['status'] = 'OK'
-        else:
-            result['message'] = 'Could not connect to Solis API'
-    return result
+    result = run_bundle(bundle.notional_times, get_connection(), config_period, level_required, starting_level)
+    return { 'status': result['status'], 'message': result['message'] }
     
 @service("pyscript.check_logger", supports_response="only")
 def check_logger():
@@ -360,20 +341,12 @@ def clear_inverter_times():
 name: Clear out all inverter charge/discharge times
 description: Clears out any scheduled charging / discharging times on the inverter
 """
-    result = { 'status': 'Error', 'message': 'Cannot connect session' }
-    with solis_control.get_session() as session:
-        config = dict(pyscript.app_config['solis_control'])
-        connected = solis_control.connect(config, session)
-        if connected:
-            result['message'] = solis_control.set_inverter_data(config, session)
-            if result['message'] == 'OK':
-                result['status'] = 'OK'
-                result['message'] = 'Charging/discharging schedule cleared'
-                for p in periods:
-                    set_times_entity(p['name'], p['timeslot'], p['charge'])
-        else:
-            result['message'] = 'Could not connect to Solis API'
-    return result
+    result = run_bundle(bundle.clear_schedule, get_connection())
+    if result['status'] == 'OK':
+        result['message'] = 'Charging/discharging schedule cleared'
+        for p in periods:
+            set_times_entity(p)
+    return { 'status': result['status'], 'message': result['message'] }
 
 @service("pyscript.set_inverter_times", supports_response="only")
 def set_inverter_times(period_name, minutes):
@@ -399,21 +372,14 @@ def set_inverter_times(period_name, minutes):
     if not config_period:
         result['message'] = "Setting solis inverter times not possible - invalid period_name '%s' supplied" % period_name
         return result
-    with solis_control.get_session() as session:
-        config = dict(pyscript.app_config['solis_control'])
-        connected = solis_control.connect(config, session)
-        if connected:
-            cstart, cend = common.start_end_from_minutes(config_period, minutes)
-            cstart, cend = common.limit_times(config_period, cstart, cend)
-            params = { 'start': cstart, 'end': cend, 'amps': str(config_period['current']) }
-            result['message'] = solis_control.set_inverter_params(config, session, params, charge=config_period['charge'], timeslot=config_period['timeslot'])
-            if result['message'] == 'OK':
-                set_times_entity(config_period, cstart, cend)
-                result['status'] = 'OK'
-                result['message'] = '%s: set from %s to %s @%sA' % (period_name, cstart, cend, str(config_period['current']))
-        else:
-            result['message'] = 'Could not connect to Solis API'
-    return result
+    cstart, cend = common.start_end_from_minutes(config_period, minutes)
+    cstart, cend = common.limit_times(config_period, cstart, cend)
+    params = { 'start': cstart, 'end': cend, 'amps': str(config_period['current']) }
+    result = run_bundle(bundle.set_schedule, get_connection(), [ (params, config_period['charge'], config_period['timeslot']) ])
+    if result['status'] == 'OK':
+        set_times_entity(config_period, cstart, cend)
+        result['message'] = '%s: set from %s to %s @%sA' % (period_name, cstart, cend, str(config_period['current']))
+    return { 'status': result['status'], 'message': result['message'] }
     
 @service("pyscript.set_inverter_slot", supports_response="only")
 def set_inverter_slot(start=None, end=None, slot=None, amps=None):
@@ -478,27 +444,14 @@ def set_inverter_slot(start=None, end=None, slot=None, amps=None):
     if slot not in ('c1', 'c2', 'c3', 'd1', 'd2', 'd3'):
         result['message'] = "Setting solis inverter times not possible - invalid slot '%s' supplied (c/d + 1,2,3 only)" % slot
         return result
-    charge = True
-    with solis_control.get_session() as session:
-        config = dict(pyscript.app_config['solis_control'])
-        connected = solis_control.connect(config, session)
-        if connected:
-            check = common.check_current(config, amps)
-            if check != 'OK':
-                result['message'] = check
-            else:
-                if slot.startswith('d'):
-                    charge = False
-                timeslot = int(slot[1:]) - 1
-                iparams = { 'start': start, 'end': end, 'amps': str(amps) }
-                result['message'] = solis_control.set_inverter_params(config, session, iparams, charge=charge, timeslot=timeslot)
-                if result['message'] == 'OK':
-                    result['status'] = 'OK'
-                    cdtype = 'Charge' if charge else 'Discharge'
-                    result['message'] = '%s time slot %s: set from %s to %s @ %sA' % (cdtype, slot, start, end, str(amps))
-        else:
-            result['message'] = 'Could not connect to Solis API'
-    return result
+    charge = not slot.startswith('d')
+    timeslot = int(slot[1:]) - 1
+    iparams = { 'start': start, 'end': end, 'amps': str(amps) }
+    result = run_bundle(bundle.set_schedule, get_connection(), [ (iparams, charge, timeslot) ], amps=amps)
+    if result['status'] == 'OK':
+        cdtype = 'Charge' if charge else 'Discharge'
+        result['message'] = '%s time slot %s: set from %s to %s @ %sA' % (cdtype, slot, start, end, str(amps))
+    return { 'status': result['status'], 'message': result['message'] }
     
 @service("pyscript.show_inverter_slots", supports_response="only")
 def show_inverter_slots():
@@ -506,19 +459,8 @@ def show_inverter_slots():
 name: Reveal all inverter charge/discharge time slots
 description: Show current charging/discharging times on the inverter
 """
-    result = { 'status': 'Error', 'message': 'Cannot connect session', 'data': None }
-    with solis_control.get_session() as session:
-        config = dict(pyscript.app_config['solis_control'])
-        connected = solis_control.connect(config, session)
-        if connected:
-            data = solis_control.get_inverter_data(config, session)
-            if data:
-                result['data'] = common.extract_inverter_data(data)
-                result['status'] = 'OK'
-                result['message'] = data
-        else:
-            result['message'] = 'Could not connect to Solis API'
-    return result
+    result = run_bundle(bundle.read_schedule, get_connection())
+    return { 'status': result['status'], 'message': result['message'], 'data': result['slots'] }
 
 registered_triggers = []   
 def create_time_trigger(time_spec, work_function, kwargs):
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+import os
+import timeit
+import time
+import json
+import argparse
+import hashlib
+import hmac
+import base64
+from datetime import datetime, timezone
+
+try:
+    import solis_common as common
+    import solis_control_req_mod as solis_control
+    import solis_fake_server as fake_server
+    import solis_limiter as limiter
+except ImportError:
+    from soliscontrol import solis_common as common
+    from soliscontrol import solis_control_req_mod as solis_control
+    from soliscontrol import solis_fake_server as fake_server
+    from soliscontrol import solis_limiter as limiter
+
+""" Benchmarks for solis_common and the client request cycle
+
+The suite times the solis_common hot paths and a full connect() -> set_inverter_params() -> get_inverter_data()
+cycle of solis_control_req_mod against an in-process fake transport (the solis_fake_server request handling
+without any HTTP) and reports p50/p95/p99 latency and calls per second for each
+
+Results can be saved as a baseline and later runs compared against it to spot regressions - the
+baseline in BASELINE_FILE was recorded on a development machine so compare on like-for-like hardware
+
+Also compares the InverterSchedule based handling of the 18 field cid 103 inverter data
+with the previous string split/strptime implementation and the pre-keyed request signing with
+the previous header building (both kept below for reference)"""
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+REGRESSION_RATIO = 1.25 # p50 slower than baseline by more than this is reported as a regression
+SAMPLE_CONFIG = {
+    'solis_key_id': fake_server.DEFAULT_KEY_ID,
+    'solis_key_secret': fake_server.DEFAULT_KEY_SECRET,
+    'battery_max_current': 74,
+    'inverter_max_current': 62.5,
+    'inverter_power': 3.6,
+    'charge_period': { 'start': '02:05', 'end': '04:55', 'current': 50 },
+    'charge_period2': { 'start': '14:30', 'end': '15:30', 'current': 50 },
+    'discharge_period': { 'start': '16:05', 'end': '18:55', 'current': 50 },
+}
+
+SAMPLE_DATA = '50,50,02:05,04:55,16:05,18:55,50,50,14:30,15:30,00:00,00:00,40,40,00:00,00:00,00:00,00:00'
+SAMPLE_EDITS = [
+    ({ 'start': '02:05', 'end': '03:35', 'amps': '50' }, True, 0),
+    ({ 'start': '14:30', 'end': '15:00', 'amps': '50' }, True, 1),
+    ({ 'start': '16:05', 'end': '17:00', 'amps': '50' }, False, 0),
+]
+
+def legacy_validated_inverter_data(inverter_data):
+    inverter_data = inverter_data.replace('-', ',')
+    ivt = inverter_data.split(',')
+    if len(ivt) != 18:
+        raise common.SolisControlException('Bad inverter data: len != 18 -> %s' % inverter_data)
+    default = common.DEFAULT_INVERTER_DATA.split(',')
+    for i in range(len(ivt)):
+        if i in [ 0, 1, 6, 7, 12, 13 ]: # charge/ discharge current
+            if not ivt[i].isdigit() or int(ivt[i]) < 0 or int(ivt[i]) > 100:
+                ivt[i] = default[i]
+        else: # start / end times
+            try:
+                datetime.strptime(ivt[i], '%H:%M')
+            except ValueError:
+                ivt[i] = default[i]
+    return ivt
+
+def legacy_update_inverter_data(inverter_data, params, charge=True, timeslot=0):
+    ivt = legacy_validated_inverter_data(inverter_data)
+    offset = timeslot * 6
+    if charge:
+        ivt[offset+2] = params['start']
+        ivt[offset+3] = params['end']
+        if 'amps' in params:
+            ivt[offset+0] = str(params['amps'])
+    else: # discharge
+        ivt[offset+4] = params['start']
+        ivt[offset+5] = params['end']
+        if 'amps' in params:
+            ivt[offset+1] = str(params['amps'])
+    return ','.join(ivt)
+
+def legacy_operation(inverter_data, edits):
+    # read-modify-write as previously done: validate, update for each edit, compare and validate again in prepare_body
+    existing = inverter_data
+    for params, charge, timeslot in edits:
+        inverter_data = legacy_update_inverter_data(inverter_data, params, charge, timeslot)
+    unchanged = ','.join(legacy_validated_inverter_data(existing)) == ','.join(legacy_validated_inverter_data(inverter_data))
+    return ','.join(legacy_validated_inverter_data(inverter_data)), unchanged
+
+def schedule_operation(inverter_data, edits):
+    # the same read-modify-write with the inverter data parsed once and serialised once
+    existing = common.InverterSchedule.parse(inverter_data)
+    schedule = existing.copy()
+    for params, charge, timeslot in edits:
+        schedule.set_params(params, charge, timeslot)
+    return schedule.to_string(), schedule == existing
+
+def bench(func, number, repeat=5):
+    # best time per call in microseconds
+    return min(timeit.repeat(func, number=number, repeat=repeat)) * 1e6 / number
+
+def schedule_benchmarks(number=20000):
+    assert legacy_operation(SAMPLE_DATA, SAMPLE_EDITS) == schedule_operation(SAMPLE_DATA, SAMPLE_EDITS)
+    results = []
+    results.append(('validated_inverter_data',
+        bench(lambda: legacy_validated_inverter_data(SAMPLE_DATA), number),
+        bench(lambda: common.validated_inverter_data(SAMPLE_DATA), number)))
+    results.append(('update_inverter_data',
+        bench(lambda: legacy_update_inverter_data(SAMPLE_DATA, *SAMPLE_EDITS[0]), number),
+        bench(lambda: common.update_inverter_data(SAMPLE_DATA, *SAMPLE_EDITS[0]), number)))
+    results.append(('read-modify-write (3 edits)',
+        bench(lambda: legacy_operation(SAMPLE_DATA, SAMPLE_EDITS), number),
+        bench(lambda: schedule_operation(SAMPLE_DATA, SAMPLE_EDITS), number)))
+    return results
+
+def legacy_prepare_post_header(config, body, canonicalized_resource):
+    content_md5 = common.digest(body)
+    content_type = "application/json"
+    now = datetime.now(timezone.utc)
+    date = now.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    encrypt_str = ("POST" + "\n"
+        + content_md5 + "\n"
+        + content_type + "\n"
+        + date + "\n"
+        + canonicalized_resource
+    )
+    hmac_obj = hmac.new(
+        config['solis_key_secret'].encode('utf-8'),
+        msg=encrypt_str.encode('utf-8'),
+        digestmod=hashlib.sha1
+    )
+    sign = base64.b64encode(hmac_obj.digest())
+    authorization = "API " + config['solis_key_id'] + ":" + sign.decode('utf-8')
+    header = {
+        "Content-MD5":content_md5,
+        "Content-Type":content_type,
+        "Date":date,
+        "Authorization":authorization
+    }
+    return header
+
+def legacy_request(config, inverter_id):
+    body = '{"inverterId":"'+inverter_id+'","cid":"103"}'
+    return body, legacy_prepare_post_header(config, body, common.READ_ENDPOINT)
+
+def check_signing(config, inverter_id='1308675217947000000'):
+    # the prepared requests must be byte-identical to the legacy ones (retried if the second changes in between)
+    for i in range(5):
+        legacy = legacy_request(config, inverter_id)
+        new = common.prepare_request(config, common.READ_ENDPOINT, inverter_id, '103')
+        if legacy[1]['Date'] == new[1]['Date']:
+            return legacy == new
+    return False
+
+def signing_benchmarks(number=20000):
+    config = dict(SAMPLE_CONFIG)
+    assert check_signing(config)
+    results = []
+    results.append(('prepare_post_header',
+        bench(lambda: legacy_prepare_post_header(config, '{"inverterId":"1308675217947000000","cid":"103"}', common.READ_ENDPOINT), number),
+        bench(lambda: common.prepare_post_header(config, '{"inverterId":"1308675217947000000","cid":"103"}', common.READ_ENDPOINT), number)))
+    results.append(('signed read request',
+        bench(lambda: legacy_request(config, '1308675217947000000'), number),
+        bench(lambda: common.prepare_request(config, common.READ_ENDPOINT, '1308675217947000000', '103'), number)))
+    return results
+
+class FakeResponse:
+    # the parts of a requests Response used by solis_control_req_mod
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class FakeSession:
+    # requests Session stand-in which passes each post to a FakeSolisCloud in-process
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        path = url[url.index('/', url.index('//') + 2):]
+        status, text = self.cloud.handle(path, headers or {}, data or '')
+        return FakeResponse(status, text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+def percentile(ordered, fraction):
+    # value at a fraction (0 to 1) of a sorted list - nearest rank
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def measure(func, samples=200, batch=50):
+    # time func in batches of calls, returns a dict of p50/p95/p99 latency (microseconds per call) and calls per second
+    # note batching keeps timer overhead out of the results for the very fast functions
+    func() # warm up
+    timings = []
+    for i in range(samples):
+        started = time.perf_counter()
+        for j in range(batch):
+            func()
+        timings.append((time.perf_counter() - started) * 1e6 / batch)
+    ordered = sorted(timings)
+    return {
+        'p50': percentile(ordered, 0.50),
+        'p95': percentile(ordered, 0.95),
+        'p99': percentile(ordered, 0.99),
+        'calls_per_sec': 1e6 * len(timings) / sum(timings),
+    }
+
+def cycle_benchmark(cloud, samples=200):
+    # connect -> set_inverter_params -> get_inverter_data against the fake transport
+    # alternate end times so every set is a real control write rather than being skipped as unchanged
+    session = FakeSession(cloud)
+    configs = fake_server.station_configs(cloud, 'http://fake', SAMPLE_CONFIG)
+    state = { 'n': 0 }
+    def cycle():
+        config = dict(configs[state['n'] % len(configs)])
+        state['n'] += 1
+        if not solis_control.connect(config, session):
+            raise common.SolisControlException('Fake connect failed')
+        params = { 'start': '02:05', 'end': '03:00' if (state['n'] // len(configs)) % 2 else '03:30', 'amps': '50' }
+        if solis_control.set_inverter_params(config, session, params) != 'OK':
+            raise common.SolisControlException('Fake set failed')
+        solis_control.get_inverter_data(config, session)
+    saved = dict(limiter.LIMITS)
+    limiter.set_limits(rate=1e9, burst=1e9, enabled=True) # include the rate limiter overhead but not any waiting
+    try:
+        return measure(cycle, samples, 1)
+    finally: # leave the limits as they were for any later callers
+        limiter.LIMITS.update(saved)
+
+def suite(samples=200, batch=50):
+    # dict of benchmark name -> result dict - see measure()
+    config = dict(SAMPLE_CONFIG)
+    body = '{"inverterId":"1308675217947000000","cid":"103"}'
+    results = {}
+    results['validated_inverter_data'] = measure(lambda: common.validated_inverter_data(SAMPLE_DATA), samples, batch)
+    results['increment_hhmm'] = measure(lambda: common.increment_hhmm('02:05', 95), samples, batch)
+    results['diff_hhmm'] = measure(lambda: common.diff_hhmm('22:05', '02:55'), samples, batch)
+    results['prepare_post_header'] = measure(lambda: common.prepare_post_header(config, body, common.READ_ENDPOINT), samples, batch)
+    results['prepare_request'] = measure(lambda: common.prepare_request(config, common.READ_ENDPOINT, '1308675217947000000', '103'), samples, batch)
+    results['extract_periods'] = measure(lambda: common.extract_periods(config), samples, batch)
+    results['check_current'] = measure(lambda: common.check_current(config), samples, batch)
+    results['connect/set/get cycle'] = cycle_benchmark(fake_server.FakeSolisCloud(10, seed=1), samples)
+    return results
+
+def compare(results, baseline, ratio=REGRESSION_RATIO):
+    # report lines comparing p50 with the baseline, returns (lines, number of regressions)
+    lines = []
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            lines.append('%-26s %10.2f %10s %8s' % (name, result['p50'], '-', 'new'))
+            continue
+        change = result['p50'] / baseline[name]['p50']
+        flag = ''
+        if change > ratio:
+            flag = 'REGRESSION'
+            regressions += 1
+        lines.append('%-26s %10.2f %10.2f %7.2fx %s' % (name, result['p50'], baseline[name]['p50'], change, flag))
+    return lines, regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks for the solis_common module',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", "--number", help="number of calls per timing (legacy comparison)", type=int, default=20000)
+    parser.add_argument("-l", "--legacy", help="compare with the legacy inverter data and request signing implementations instead", action='store_true')
+    parser.add_argument("-s", "--samples", help="number of timed samples per benchmark", type=int, default=200)
+    parser.add_argument("--save", help="save the results as a baseline file", nargs='?', const=BASELINE_FILE)
+    parser.add_argument("--compare", help="compare the results with a baseline file", nargs='?', const=BASELINE_FILE)
+    args = parser.parse_args()
+
+    if args.legacy:
+        print ('%-30s %12s %12s %8s' % ('Operation', 'Legacy us', 'Current us', 'Speedup'))
+        for name, legacy, new in schedule_benchmarks(args.number) + signing_benchmarks(args.number):
+            print ('%-30s %12.2f %12.2f %7.1fx' % (name, legacy, new, legacy / new))
+    else:
+        results = suite(args.samples)
+        print ('%-26s %10s %10s %10s %12s' % ('Benchmark', 'p50 us', 'p95 us', 'p99 us', 'Calls/s'))
+        for name, r in results.items():
+            print ('%-26s %10.2f %10.2f %10.2f %12.0f' % (name, r['p50'], r['p95'], r['p99'], r['calls_per_sec']))
+        if args.compare:
+            with open(args.compare, 'r') as file:
+                baseline = json.load(file)
+            lines, regressions = compare(results, baseline)
+            print ('\n%-26s %10s %10s %8s' % ('Compared with baseline', 'p50 us', 'Base us', 'Change'))
+            for line in lines:
+                print (line)
+            print ('%d regression(s)' % regressions)
+        if args.save:
+            with open(args.save, 'w') as file:
+                json.dump(results, file, indent=2)
+            print ('Saved baseline to', args.save)
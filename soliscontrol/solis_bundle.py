@@ -0,0 +1,211 @@
+import time
+import logging
+
+try:
+    import solis_control_req_mod as solis_control
+    import solis_common as common
+    import solis_retry as retry
+except ImportError:
+    from soliscontrol import solis_control_req_mod as solis_control
+    from soliscontrol import solis_common as common
+    from soliscontrol import solis_retry as retry
+try:
+    import solis_s3_logger as logger
+    DATA_LOGGER = True
+except ImportError:
+    try:
+        from soliscontrol import solis_s3_logger as logger
+        DATA_LOGGER = True
+    except ImportError:
+        DATA_LOGGER = False
+
+""" Composite operations on a connection handle (see solis_control_req_mod.open_connection()) which each do
+a whole sequence of Solis Cloud calls - eg connect, read the SOC, plan the times and write them
+
+Under Pyscript each request made from solis_control_req_mod is a separate task.executor job so one operation
+moves between the Home Assistant event loop and the thread pool 6-8 times. If this module is imported from the
+installed soliscontrol package (a native module) an operation can instead be run as a single job:
+
+    result = task.executor(solis_bundle.set_period_times, conn, config_period, level_required)
+
+Imported from the Pyscript modules folder the same functions can be called directly (one job per request)
+
+Each operation returns a result dict with 'status' ('OK' or 'Error'), 'message' and 'elapsed' (seconds)
+and never raises, so exceptions from a native module do not have to be caught in Pyscript. Each holds the handle
+lock throughout (see solis_control_req_mod.lock_connection()) so that actions running at the same time (eg a trigger
+and a service) take turns - whether they are separate executor jobs or Pyscript tasks on the event loop thread"""
+
+NOT_CONNECTED = 'Could not connect to Solis API'
+
+try:
+    task.executor()
+except NameError:
+    PYSCRIPT = False
+except TypeError:
+    PYSCRIPT = True
+else: # default
+    PYSCRIPT = False
+
+if not PYSCRIPT:
+    log = logging.getLogger(__name__)
+
+def finish(result, started):
+    result['elapsed'] = time.perf_counter() - started
+    return result
+
+def unexpected(e):
+    msg = 'Unexpected error: %s' % repr(e)
+    log.warning(msg)
+    return msg
+
+def soc_percent(energy, unavailable_energy, full_energy):
+    # battery state of charge (%) for an amount of available energy
+    return (energy + unavailable_energy) / (full_energy + unavailable_energy) * 100.0
+
+def check_logger(config, session):
+    # check the data logger is connected to the inverter and restart it if not (only if it is configured)
+    if DATA_LOGGER and config.get(logger.IP_FIELD) and config.get(logger.PASSWORD_FIELD):
+        return logger.check_logger(config, session)
+    return None
+
+def set_period_times(conn, config_period, level_required, budget=None):
+    # read the latest SOC (connecting if necessary), plan the charge/discharge times to reach level_required
+    # and write them - all the calls must finish within budget seconds if it is set (see common.set_deadline())
+    # result has the plan as 'start', 'end', 'current_energy', 'soc', 'energy_after' and 'after_soc' if it was made
+    started = time.perf_counter()
+    solis_control.lock_connection(conn) # one operation at a time on the shared handle
+    try:
+        config = conn['config']
+        result = { 'status': 'Error', 'message': NOT_CONNECTED, 'planned': False }
+        if budget:
+            common.set_deadline(config, budget)
+        try:
+            check_logger(config, conn['session'])
+            if retry.refresh_soc(conn): # connects only if necessary but always gets the latest SOC
+                eah = common.period_eah(config, config_period['charge'], config_period['current'])
+                unavailable_energy, full_energy, current_energy, real_soc = common.energy_values(config)
+                if config_period['charge']:
+                    start, end, energy_after = common.charge_times(config_period, full_energy, current_energy, level_required, eah)
+                else:
+                    start, end, energy_after = common.discharge_times(config_period, current_energy, level_required, eah)
+                start, end = common.limit_times(config_period, start, end)
+                result.update({ 'planned': True, 'start': start, 'end': end,
+                    'current_energy': current_energy, 'soc': soc_percent(current_energy, unavailable_energy, full_energy),
+                    'energy_after': energy_after, 'after_soc': soc_percent(energy_after, unavailable_energy, full_energy) })
+                params = { 'start': start, 'end': end, 'amps': str(config_period['current']) }
+                result['message'] = retry.call(solis_control.set_inverter_params, config, conn['session'], params,
+                    charge=config_period['charge'], timeslot=config_period['timeslot'])
+                if common.write_ok(result['message']):
+                    result['status'] = 'OK'
+        except common.SolisControlException as e: # includes an open circuit breaker and a spent deadline
+            result['message'] = str(e)
+        except Exception as e: # eg unparseable logger pages or network errors outside solis_retry - never raises
+            result['message'] = unexpected(e)
+        finally: # the handle config is long lived so the deadline must not outlast this operation
+            common.clear_deadline(config)
+    finally:
+        solis_control.unlock_connection(conn)
+    return finish(result, started)
+
+def notional_times(conn, config_period, level_required, starting_level=None):
+    # connect and calculate the charge/discharge times from a starting level (default empty for charging or full for
+    # discharging) ignoring the solar forecast and current energy - nothing is written to the inverter
+    started = time.perf_counter()
+    solis_control.lock_connection(conn) # one operation at a time on the shared handle
+    try:
+        config = conn['config']
+        result = { 'status': 'Error', 'message': NOT_CONNECTED }
+        try:
+            check_logger(config, conn['session'])
+            if solis_control.ensure_connected(conn):
+                unavailable_energy, full_energy, current_energy, real_soc = common.energy_values(config)
+                energy_start = float(starting_level) if starting_level is not None else -1.0
+                eah = common.period_eah(config, config_period['charge'], config_period['current'])
+                if config_period['charge']:
+                    energy_start = 0.0 if energy_start < 0.0 or energy_start > full_energy else energy_start
+                    start, end, energy_after = common.charge_times(config_period, full_energy, energy_start, level_required, eah)
+                    action = 'charge'
+                else:
+                    energy_start = full_energy if energy_start <= 0.0 or energy_start > full_energy else energy_start
+                    start, end, energy_after = common.discharge_times(config_period, energy_start, level_required, eah)
+                    action = 'discharge'
+                current = '(%s-%s at %sA)' % (config_period['start'], config_period['end'], str(config_period['current']))
+                msg_expl = 'remain at' if start == '00:00' and end == '00:00' else 'reach'
+                msg = "'%s' %s notional %s times starting from %.1fkWh (%.0f%% SOC) -> %s to %s to %s %.1fkWh (%.0f%% SOC)"
+                result['message'] = msg % (config_period['name'], current, action, energy_start, soc_percent(energy_start, unavailable_energy, full_energy),
+                    start, end, msg_expl, energy_after, soc_percent(energy_after, unavailable_energy, full_energy))
+                result['status'] = 'OK'
+        except common.SolisControlException as e:
+            result['message'] = str(e)
+        except Exception as e:
+            result['message'] = unexpected(e)
+    finally:
+        solis_control.unlock_connection(conn)
+    return finish(result, started)
+
+def set_schedule(conn, edits, amps=None):
+    # connect if necessary and write all the edits - a list of (params, charge, timeslot) - in one read and one write
+    # if amps is set it is checked against the inverter and battery limits first
+    started = time.perf_counter()
+    solis_control.lock_connection(conn) # one operation at a time on the shared handle
+    try:
+        result = { 'status': 'Error', 'message': NOT_CONNECTED }
+        try:
+            if solis_control.ensure_connected(conn):
+                check = common.check_current(conn['config'], amps) if amps is not None else 'OK'
+                if check != 'OK':
+                    result['message'] = check
+                else:
+                    result['message'] = retry.call(solis_control.set_inverter_schedule, conn['config'], conn['session'], edits)
+                    if common.write_ok(result['message']):
+                        result['status'] = 'OK'
+        except common.SolisControlException as e:
+            result['message'] = str(e)
+        except Exception as e:
+            result['message'] = unexpected(e)
+    finally:
+        solis_control.unlock_connection(conn)
+    return finish(result, started)
+
+def clear_schedule(conn):
+    # connect if necessary and turn off all charging/discharging
+    started = time.perf_counter()
+    solis_control.lock_connection(conn) # one operation at a time on the shared handle
+    try:
+        result = { 'status': 'Error', 'message': NOT_CONNECTED }
+        try:
+            if solis_control.ensure_connected(conn):
+                result['message'] = retry.call(solis_control.set_inverter_data, conn['config'], conn['session'])
+                if result['message'] == 'OK':
+                    result['status'] = 'OK'
+        except common.SolisControlException as e:
+            result['message'] = str(e)
+        except Exception as e:
+            result['message'] = unexpected(e)
+    finally:
+        solis_control.unlock_connection(conn)
+    return finish(result, started)
+
+def read_schedule(conn):
+    # connect if necessary and read the charging/discharging times - result 'data' is the raw 18 field inverter data
+    # and 'slots' the same split into charge/discharge timeslots (see common.extract_inverter_data())
+    started = time.perf_counter()
+    solis_control.lock_connection(conn) # one operation at a time on the shared handle
+    try:
+        result = { 'status': 'Error', 'message': NOT_CONNECTED, 'data': None, 'slots': None }
+        try:
+            if solis_control.ensure_connected(conn):
+                result['message'] = 'Could not read the inverter schedule'
+                data = retry.call(solis_control.get_inverter_data, conn['config'], conn['session'])
+                if data:
+                    result['data'] = data
+                    result['slots'] = common.extract_inverter_data(data)
+                    result['message'] = data
+                    result['status'] = 'OK'
+        except common.SolisControlException as e:
+            result['message'] = str(e)
+        except Exception as e:
+            result['message'] = unexpected(e)
+    finally:
+        solis_control.unlock_connection(conn)
+    return finish(result, started)
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import time
+
+try:
+    import solis_control_req_mod as solis_control
+    import solis_common as common
+except ImportError:
+    from soliscontrol import solis_control_req_mod as solis_control
+    from soliscontrol import solis_common as common
+
+""" On-disk cache of station discovery results and the login token so that a cold start
+(eg a cron driven solis_run.py) does not repeat calls whose results rarely change
+
+Entries are keyed by station id and API key id and hold the inverterList results (inverter id and
+serial number, station name) and the login token, each with the time it was obtained
+
+A cached connect only needs the inverter detail (for the current SOC) and the inverter time,
+so 2 requests instead of 5. If either fails with an auth or not-found type error the entry is
+dropped and a full connect is done instead (transient errors are left for solis_retry to handle)"""
+
+CACHE_FILE = 'solis_cache.json'
+ENTRY_TTL = 30 * 24 * 3600 # seconds before discovery results are fetched again
+CACHED_FIELDS = ( 'inverter_id', 'inverter_sn', 'station_name' )
+
+log = logging.getLogger(__name__)
+
+def cache_key(config):
+    return '%s:%s' % (config['solis_station_id'], config['solis_key_id'])
+
+def load_cache(cache_file=CACHE_FILE):
+    try:
+        with open(cache_file, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache, cache_file=CACHE_FILE):
+    # written to a temporary file then renamed so a failed write does not leave a corrupt cache
+    # readable only by the owner as it contains the login token
+    temp_file = cache_file + '.tmp'
+    with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+        json.dump(cache, file, indent=2)
+    os.replace(temp_file, cache_file)
+
+def update_entry(config, entry=None):
+    # cache entry from the connection state in config
+    now = time.time()
+    entry = dict(entry or {})
+    if config.get('inverter_id') and entry.get('inverter_id') != config['inverter_id']:
+        entry['entry_time'] = now
+    for k in CACHED_FIELDS:
+        if config.get(k):
+            entry[k] = config[k]
+    if config.get('login_token') and entry.get('login_token') != config['login_token']:
+        entry['login_token'] = config['login_token']
+        entry['token_time'] = now
+    return entry
+
+def store(config, cache_file=CACHE_FILE):
+    # save the current connection state (eg after a new login) for a connected station
+    if config.get('inverter_id'):
+        cache = load_cache(cache_file)
+        key = cache_key(config)
+        entry = update_entry(config, cache.get(key))
+        if entry != cache.get(key):
+            cache[key] = entry
+            save_cache(cache, cache_file)
+    
+def invalidate(config, cache_file=CACHE_FILE):
+    # forget the cached details for a station
+    cache = load_cache(cache_file)
+    if cache.pop(cache_key(config), None) is not None:
+        save_cache(cache, cache_file)
+
+def cached_connect(config, session):
+    # connect using cached details (from the config) - returns True, False (failed) or None (must do a full connect)
+    if not solis_control.get_inverter_detail(config, session):
+        return None if common.last_error_kind(config) == 'fatal' else False
+    if not solis_control.get_inverter_datetime(config, session):
+        if common.last_error_kind(config) == 'token': # log in again
+            config.pop('login_token', None)
+            if not solis_control.get_login_detail(config, session) or not solis_control.get_inverter_datetime(config, session):
+                return False
+        else:
+            return None if common.last_error_kind(config) == 'fatal' else False
+    check = common.check_time(config) # default acceptable time difference = 1 min
+    if check != 'OK':
+        if solis_control.set_inverter_datetime(config, session) != 'OK' or not solis_control.get_inverter_datetime(config, session):
+            return False
+    return True
+
+def connect(config, session, cache_file=CACHE_FILE):
+    # solis_control.connect() using and updating the cache - the same result (True or False)
+    # note a full connect is done with the calls overlapped - see solis_control.connect_parallel()
+    cache = load_cache(cache_file)
+    key = cache_key(config)
+    entry = cache.get(key)
+    now = time.time()
+    result = None
+    if entry and now - entry.get('entry_time', 0) < ENTRY_TTL and all(entry.get(k) for k in CACHED_FIELDS):
+        for k in CACHED_FIELDS:
+            config[k] = entry[k]
+        if entry.get('login_token') and now - entry.get('token_time', 0) < config.get('token_ttl', solis_control.TOKEN_TTL):
+            config['login_token'] = entry['login_token']
+        elif not solis_control.get_login_detail(config, session):
+            return False
+        config.pop('last_error', None)
+        try:
+            result = cached_connect(config, session)
+        except common.DeadlineExceeded as e: # not a problem with the cached details
+            log.warning('Cannot connect to inverter: %s', str(e))
+            return False
+        except common.SolisControlException as e:
+            log.warning('Cannot connect to inverter: %s', str(e))
+            result = None
+        if result is None:
+            log.info('Cached details for station %s rejected - full connect' % config['solis_station_id'])
+            entry = None
+            for k in CACHED_FIELDS + ( 'login_token', ):
+                config.pop(k, None)
+    if result is None:
+        result, timings = solis_control.connect_parallel(config, session)
+    if result:
+        cache[key] = update_entry(config, entry)
+        save_cache(cache, cache_file)
+    elif entry is None and key in cache:
+        del cache[key]
+        save_cache(cache, cache_file)
+    return result
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+import os
+import time
+import argparse
+import yaml
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError: # optional dependency - see setup.py extras
+    raise ImportError("solis_calibrate needs numpy - install it with 'pip install numpy' or 'pip install soliscontrol[numpy]'") from None
+
+try:
+    import solis_common as common
+    import solis_ingest as ingest
+except ImportError:
+    from soliscontrol import solis_common as common
+    from soliscontrol import solis_ingest as ingest
+
+""" Calibration of the energy_amp_hour constant from recorded battery SOC and current
+
+Instead of working it out from one charge or discharge (see common.eah_from_soc()) this scans the 5 minute
+history kept by solis_ingest and finds every charge and discharge episode automatically - a run of samples with
+the battery current above a minimum in the same direction, long enough and with a large enough SOC change to measure.
+For each episode the energy moved (from the SOC change and battery capacity) and the amp hours (the current
+integrated over time) are worked out, then energy_amp_hour is fitted separately for charging and discharging
+and for each band of current by least squares through the origin (energy = eah * amp hours) with the
+groups done together in numpy. Episodes whose own value is far from the fit (more than 'reject' times the
+median absolute deviation of their group) are dropped and the fit is repeated
+
+The fitted bands can be written back to main.yaml as 'energy_amp_hour_charge' and 'energy_amp_hour_discharge'
+(lower limit of current band in amps -> energy_amp_hour) which are used by common.period_eah() when
+planning charge/discharge times
+
+Requires numpy"""
+
+DEFAULT_BANDS = ( 0.0, 20.0, 40.0 ) # lower limits of the current bands (A)
+MIN_CURRENT = 2.0 # A - battery current below this is idle
+MAX_GAP = 900.0 # seconds - samples further apart than this split an episode
+MIN_MINUTES = 20.0 # shortest episode
+MIN_SOC_CHANGE = 4.0 # % - smallest SOC change in an episode (SOC is reported to the nearest 1% or 0.1%)
+MAX_VARIATION = 0.25 # maximum coefficient of variation of the current within an episode (ie a steady current)
+MIN_EPISODES = 3 # fewest episodes to fit a band
+REJECT = 3.0 # outliers are more than this many (scaled) median absolute deviations from the fit
+MAX_ITERATIONS = 5
+MAD_SCALE = 1.4826 # median absolute deviation -> standard deviation for normal errors
+MIN_SPREAD = 0.001 # floor on the scaled deviation so near perfect groups do not reject everything
+FITTED_COMMENT = '# energy_amp_hour bands fitted by solis_calibrate.py'
+
+def current_sign(soc, current):
+    # +1 if positive battery current is charging (SOC goes up) otherwise -1 - worked out from the data
+    change = np.diff(soc)
+    valid = ~(np.isnan(change) | np.isnan(current[:-1]))
+    return -1.0 if np.sum(current[:-1][valid] * change[valid]) < 0.0 else 1.0
+
+def detect_episodes(times, soc, current, capacity, min_current=MIN_CURRENT, max_gap=MAX_GAP, min_minutes=MIN_MINUTES,
+        min_soc_change=MIN_SOC_CHANGE, max_variation=MAX_VARIATION, sign=None):
+    # dict of arrays with one entry for each charge/discharge episode - 'charge' (bool), 'start' (epoch seconds), 'minutes',
+    # 'current' (mean A), 'amp_hours', 'soc_change' (%), 'energy' (kWh moved) and 'eah' (energy / amp hours)
+    # times, soc and current are arrays of the samples in time order
+    times = np.asarray(times, dtype=np.float64)
+    soc = np.asarray(soc, dtype=np.float64)
+    current = np.asarray(current, dtype=np.float64)
+    ok = ~(np.isnan(times) | np.isnan(soc) | np.isnan(current))
+    times, soc, current = times[ok], soc[ok], current[ok]
+    if len(times) < 2:
+        return { k: np.empty(0) for k in ('charge', 'start', 'minutes', 'current', 'amp_hours', 'soc_change', 'energy', 'eah') }
+    current = current * (sign if sign is not None else current_sign(soc, current)) # +ve is now charging
+    direction = np.where(current >= min_current, 1, np.where(current <= -min_current, -1, 0))
+    breaks = np.concatenate(([ True ], (direction[1:] != direction[:-1]) | (np.diff(times) > max_gap)))
+    run = np.cumsum(breaks) - 1 # run number of each sample
+    starts = np.flatnonzero(breaks)
+    ends = np.concatenate((starts[1:], [ len(times) ])) - 1
+    runs = len(starts)
+    amps = np.abs(current)
+    same = run[:-1] == run[1:] # consecutive samples in the same run
+    pair_ah = 0.5 * (amps[:-1] + amps[1:]) * np.diff(times) / 3600.0 # trapezoid rule
+    amp_hours = np.bincount(run[:-1][same], pair_ah[same], minlength=runs)
+    minutes = (times[ends] - times[starts]) / 60.0
+    soc_change = soc[ends] - soc[starts]
+    counts = np.bincount(run, minlength=runs)
+    mean_amps = np.bincount(run, amps, minlength=runs) / counts
+    spread = np.sqrt(np.maximum(np.bincount(run, amps * amps, minlength=runs) / counts - mean_amps * mean_amps, 0.0))
+    charge = direction[starts] > 0
+    keep = ((direction[starts] != 0) & (minutes >= min_minutes) & (np.abs(soc_change) >= min_soc_change)
+        & (np.sign(soc_change) == direction[starts]) & (spread <= max_variation * mean_amps)
+        & ~(charge & (soc[ends] >= 99.5))) # the battery was full before the end
+    energy = np.abs(soc_change) * capacity / 100.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eah = energy / amp_hours
+        mean_current = amp_hours / minutes * 60.0
+    return { 'charge': charge[keep], 'start': times[starts][keep], 'minutes': minutes[keep], 'current': mean_current[keep],
+        'amp_hours': amp_hours[keep], 'soc_change': soc_change[keep], 'energy': energy[keep], 'eah': eah[keep] }
+
+def fit_bands(episodes, bands=DEFAULT_BANDS, reject=REJECT, min_episodes=MIN_EPISODES, iterations=MAX_ITERATIONS):
+    # least squares energy_amp_hour for each direction and current band with outlier rejection
+    # returns (fits, kept) - fits is a list of dicts ('charge', 'lower' (A), 'eah', 'episodes', 'rejected', 'rmse')
+    # for each group with at least min_episodes and kept is a boolean array marking the episodes used
+    bands = np.asarray(sorted(bands), dtype=np.float64)
+    band = np.maximum(np.searchsorted(bands, episodes['current'], side='right') - 1, 0)
+    group = np.where(episodes['charge'], 0, len(bands)) + band # charge bands then discharge bands
+    groups = 2 * len(bands)
+    x = episodes['amp_hours']
+    y = episodes['energy']
+    kept = np.ones(len(x), dtype=bool)
+    for i in range(iterations):
+        sxy = np.bincount(group[kept], x[kept] * y[kept], minlength=groups)
+        sxx = np.bincount(group[kept], x[kept] * x[kept], minlength=groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            eah = sxy / sxx
+        deviation = np.abs(episodes['eah'] - eah[group])
+        limit = np.zeros(groups)
+        for g in np.unique(group[kept]):
+            limit[g] = reject * max(MAD_SCALE * np.median(deviation[kept & (group == g)]), MIN_SPREAD)
+        new_kept = kept & (deviation <= limit[group])
+        if np.array_equal(new_kept, kept):
+            break
+        kept = new_kept
+    sxy = np.bincount(group[kept], x[kept] * y[kept], minlength=groups)
+    sxx = np.bincount(group[kept], x[kept] * x[kept], minlength=groups)
+    used = np.bincount(group[kept], minlength=groups)
+    found = np.bincount(group, minlength=groups)
+    residuals = np.bincount(group[kept], (y[kept] - (sxy / np.where(sxx > 0.0, sxx, 1.0))[group[kept]] * x[kept]) ** 2, minlength=groups)
+    fits = []
+    for g in range(groups):
+        if used[g] >= min_episodes:
+            fits.append({ 'charge': g < len(bands), 'lower': float(bands[g % len(bands)]), 'eah': round(float(sxy[g] / sxx[g]), 4),
+                'episodes': int(used[g]), 'rejected': int(found[g] - used[g]), 'rmse': float(np.sqrt(residuals[g] / used[g])) })
+    return fits, kept
+
+def band_settings(fits):
+    # config settings from the fits eg { 'energy_amp_hour_charge': { 0: 0.0495, 20: 0.0512 }, ... } - see common.period_eah()
+    settings = {}
+    for fit in fits:
+        lower = int(fit['lower']) if fit['lower'].is_integer() else fit['lower']
+        settings.setdefault(common.EAH_BAND_KEYS[fit['charge']], {})[lower] = fit['eah']
+    return settings
+
+def write_settings(config_file, settings):
+    # replace (or add) the top level band settings in a YAML config file keeping the rest of the file (and its comments) as it is
+    with open(config_file, 'r') as file:
+        lines = file.readlines()
+    output = []
+    skipping = False
+    for line in lines:
+        if skipping and (line.startswith((' ', '\t')) or not line.strip()):
+            continue
+        skipping = any(line.startswith(key + ':') for key in settings)
+        if not skipping and not line.startswith(FITTED_COMMENT):
+            output.append(line)
+    if output and not output[-1].endswith('\n'):
+        output[-1] += '\n'
+    output.append('%s on %s\n' % (FITTED_COMMENT, datetime.now().strftime('%Y-%m-%d')))
+    output.append(yaml.safe_dump(settings, default_flow_style=False, sort_keys=True))
+    temp_path = config_file + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.writelines(output)
+    os.replace(temp_path, config_file)
+
+def calibrate(data, capacity, bands=DEFAULT_BANDS, **kwargs):
+    # episodes and fits from a table of 5 minute samples (dict with 'time', 'battery_soc' and 'battery_current' arrays
+    # eg from solis_ingest.load_table()) - keyword arguments are passed to detect_episodes()
+    episodes = detect_episodes(data['time'], data['battery_soc'], data['battery_current'], capacity, **kwargs)
+    fits, kept = fit_bands(episodes, bands)
+    return { 'episodes': episodes, 'kept': kept, 'fits': fits, 'settings': band_settings(fits) }
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Fit energy_amp_hour for charging and discharging from stored SOC and current history',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("store", help="folder of data stored by solis_ingest.py", nargs='?', default=ingest.DEFAULT_STORE)
+    parser.add_argument("-s", "--sn", help="inverter serial number (default the only one in the store)")
+    parser.add_argument("-c", "--config", help="YAML config file with battery_capacity", default='main.yaml')
+    parser.add_argument("-b", "--bands", help="lower limits of the current bands (A)", default=','.join('%g' % b for b in DEFAULT_BANDS))
+    parser.add_argument("-w", "--write", help="write the fitted values back to the config file", action='store_true')
+    parser.add_argument("-v", "--verbose", help="list every episode", action='store_true')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        config = yaml.safe_load(file)
+    inverter_sn = args.sn or sorted(os.listdir(args.store))[0]
+    started = time.perf_counter()
+    data = ingest.load_table(args.store, inverter_sn, 'day', [ 'time', 'battery_soc', 'battery_current' ])
+    result = calibrate(data, config['battery_capacity'], [ float(b) for b in args.bands.split(',') ])
+    episodes = result['episodes']
+    if args.verbose:
+        for i in range(len(episodes['start'])):
+            print ('%s %-9s %5.0f min %5.1fA %6.2fAh %+5.1f%% SOC %5.2fkWh eah %.4f%s' % (datetime.fromtimestamp(episodes['start'][i]).strftime('%Y-%m-%d %H:%M'),
+                'charge' if episodes['charge'][i] else 'discharge', episodes['minutes'][i], episodes['current'][i], episodes['amp_hours'][i],
+                episodes['soc_change'][i], episodes['energy'][i], episodes['eah'][i], '' if result['kept'][i] else ' (rejected)'))
+    print ('%d rows, %d episodes in %.0fms' % (len(data['time']), len(episodes['start']), (time.perf_counter() - started) * 1000.0))
+    for fit in result['fits']:
+        print ('%-9s >= %3gA: energy_amp_hour %.4f from %d episodes (%d rejected, rms error %.3fkWh)' % ('charge' if fit['charge'] else 'discharge',
+            fit['lower'], fit['eah'], fit['episodes'], fit['rejected'], fit['rmse']))
+    if args.write and result['settings']:
+        write_settings(args.config, result['settings'])
+        print ('Written to %s' % args.config)
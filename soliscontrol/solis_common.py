@@ -4,6 +4,7 @@
 import json
 from datetime import datetime, timezone, time
 from random import randint
+from time import monotonic, time as time_now
 import re
 
 """ Common module for Solis Cloud API access
@@ -19,9 +20,32 @@
 READ_ENDPOINT = '/v2/api/atRead'
 INVERTER_ENDPOINT = '/v1/api/inverterList'
 DETAIL_ENDPOINT = '/v1/api/inverterDetail'
+DETAIL_LIST_ENDPOINT = '/v1/api/inverterDetailList'
+DAY_ENDPOINT = '/v1/api/inverterDay'
+MONTH_ENDPOINT = '/v1/api/inverterMonth'
 DEFAULT_API_URL = 'https://www.soliscloud.com:13333'
+BODY_TEMPLATES = { # JSON request body for each endpoint filled in by request_body()
+    INVERTER_ENDPOINT: '{"stationId":"%s"}',
+    DETAIL_ENDPOINT: '{"id":"%s","sn":"%s"}',
+    DAY_ENDPOINT: '{"id":"%s","sn":"%s","money":"%s","time":"%s","timeZone":"%s"}',
+    MONTH_ENDPOINT: '{"id":"%s","sn":"%s","money":"%s","month":"%s","timeZone":"%s"}',
+    LOGIN_ENDPOINT: '{"userInfo":"%s","passWord":"%s"}',
+    READ_ENDPOINT: '{"inverterId":"%s","cid":"%s"}',
+    CONTROL_ENDPOINT: '{"inverterId":"%s","cid":"%s","value":"%s"}',
+}
+PAGE_TEMPLATE = '{"pageNo":%d,"pageSize":%d}' # JSON request body for one page of a list endpoint (all records in the account)
+LIST_PAGE_SIZE = 100 # maximum records in each page of a list endpoint
+LIST_NAMES = { # list endpoints which can be paged with PAGE_TEMPLATE (name used in messages)
+    INVERTER_ENDPOINT: 'inverter list',
+    DETAIL_LIST_ENDPOINT: 'inverter detail list',
+}
+CONTENT_TYPE = 'application/json'
+SIGNERS = {} # (key id, key secret) -> HMAC-SHA1 object already keyed with the secret - see signer()
+DATE_CACHE = [ (None, '') ] # (second, Date header string) last formatted - see http_date()
 ENERGY_AMP_HOUR = 0.05 # kWh added to battery for each amp hour charged
 # Based on charging rule = 20A times 1 hour adds 1 kWh of charge – see https://www.youtube.com/watch?v=ps22E30OUEk
+EAH_BAND_KEYS = { True: 'energy_amp_hour_charge', False: 'energy_amp_hour_discharge' } # optional config dicts of
+# lower limit of current band (A) -> energy_amp_hour when charging (True) or discharging (False) - see period_eah()
 ENTRY_FIELDS = {
     'id': 'inverter_id',
     'sn': 'inverter_sn',
@@ -38,9 +62,45 @@
     'token': 'login_token',
 }
 DEFAULT_INVERTER_DATA = '50,50,00:00,00:00,00:00,00:00,50,50,00:00,00:00,00:00,00:00,50,50,00:00,00:00,00:00,00:00'
+UNCHANGED_MSG = 'OK - Unchanged' # status when a control write is skipped because the inverter already has the same data
+WRITE_COUNTS = { 'written': 0, 'elided': 0 } # running totals of real and skipped control writes
+
+BUSY_CODES = ( 'B0115', ) # payload codes when the data logger/inverter is temporarily unreachable
+TOKEN_CODES = ( 'Z0001', ) # payload codes when the login token is invalid or has expired
+DEFAULT_TIMEOUT = ( 5.0, 30.0 ) # (connect, read) timeouts in seconds for each request when there is no deadline
+MIN_TIMEOUT = 0.5 # requests are not started with less than this left before the deadline
 
 class SolisControlException(Exception):
     pass
+    
+class DeadlineExceeded(SolisControlException):
+    pass
+    
+def set_deadline(config, seconds):
+    # all requests made with this config must finish within 'seconds' from now - see request_timeout()
+    config['deadline'] = monotonic() + seconds
+    
+def clear_deadline(config):
+    config.pop('deadline', None)
+    
+def remaining_time(config):
+    # seconds left before the deadline in config (None if there is no deadline)
+    if config.get('deadline') is None:
+        return None
+    return config['deadline'] - monotonic()
+    
+def request_timeout(config, default=DEFAULT_TIMEOUT):
+    # (connect, read) timeouts for the next request - each no more than the default or the time left before any deadline
+    # (so one hung request cannot use up the whole budget and leave nothing for retries)
+    # raises DeadlineExceeded (and records it as the last error) if the time has run out
+    left = remaining_time(config)
+    if left is None:
+        return default
+    if left < MIN_TIMEOUT:
+        e = DeadlineExceeded('Deadline passed - %.1fs left' % left)
+        record_error(config, msg=str(e), exception=e)
+        raise e
+    return ( min(default[0], left), min(default[1], left) )
             
 def digest(body):
     return base64.b64encode(hashlib.md5(body.encode('utf-8')).digest()).decode('utf-8')
@@ -109,38 +169,152 @@ def prepare_body(config, inverter_data=None):
     # format of inverter_data is:
     # charge_current1,discharge_current1,charge_start1,charge_end1,discharge_start1,discharge_end1,
     # etc for 2 and 3 time slots
+    # note inverter_data can be a string or an InverterSchedule
     if not config.get('inverter_id'):
         raise SolisControlException('No inverter id details from connection')
     if inverter_data:
-        ivt = validated_inverter_data(inverter_data)
-        inverter_data = ','.join(ivt)
-        return '{"inverterId":"'+config['inverter_id']+'","cid":"103","value":"'+inverter_data+'"}'
+        if not isinstance(inverter_data, InverterSchedule):
+            inverter_data = InverterSchedule.parse(inverter_data)
+        return request_body(CONTROL_ENDPOINT, config['inverter_id'], '103', inverter_data.to_string())
     else:
-        return '{"inverterId":"'+config['inverter_id']+'","cid":"103"}'
+        return request_body(READ_ENDPOINT, config['inverter_id'], '103')
+    
+def hhmm_to_minutes(hhmm): 
+    # convert HH:MM string to minutes from midnight (None if invalid)
+    if len(hhmm) == 5 and hhmm[2] == ':' and hhmm[:2].isdigit() and hhmm[3:].isdigit():
+        hours = int(hhmm[:2]); minutes = int(hhmm[3:])
+    else: # unusual formats eg '2:05'
+        try:
+            t = datetime.strptime(hhmm, '%H:%M')
+        except ValueError:
+            return None
+        hours = t.hour; minutes = t.minute
+    if hours > 23 or minutes > 59:
+        return None
+    return hours * 60 + minutes
+    
+def minutes_to_hhmm(minutes): 
+    # convert minutes from midnight to HH:MM string
+    return '%02d:%02d' % divmod(minutes % 1440, 60)
+    
+class InverterSchedule:
+    # compact parsed form of the 18 field cid 103 inverter data string (charge/discharge currents and times for 3 time slots)
+    # currents is a list of 6 ints in wire order: charge1, discharge1, charge2, discharge2, charge3, discharge3 (amps)
+    # times is a list of 12 ints in wire order: charge_start1, charge_end1, discharge_start1, discharge_end1, etc (minutes from midnight)
+    # invalid fields are replaced by the defaults in DEFAULT_INVERTER_DATA (50A and 00:00)
+    # note it is mutable (see set_slot()) so compares equal by value but is not hashable
+    __slots__ = ( 'currents', 'times' )
+    
+    def __init__(self, currents=None, times=None):
+        self.currents = list(currents) if currents else [ 50 ] * 6
+        self.times = list(times) if times else [ 0 ] * 12
+        
+    @classmethod
+    def parse(cls, inverter_data):
+        ivt = inverter_data.replace('-', ',').split(',')
+        if len(ivt) != 18:
+            raise SolisControlException('Bad inverter data: len != 18 -> %s' % inverter_data)
+        currents = []
+        times = []
+        for i, field in enumerate(ivt):
+            if i % 6 < 2: # charge/ discharge current
+                currents.append(int(field) if field.isdigit() and int(field) <= 100 else 50)
+            else: # start / end times
+                minutes = hhmm_to_minutes(field)
+                times.append(0 if minutes is None else minutes)
+        return cls(currents, times)
+        
+    def to_list(self):
+        # 18 string fields in wire order
+        c = self.currents; t = [ minutes_to_hhmm(m) for m in self.times ]
+        ivt = []
+        for timeslot in (0, 1, 2):
+            ivt.extend( ( str(c[timeslot*2]), str(c[timeslot*2+1]), t[timeslot*4], t[timeslot*4+1], t[timeslot*4+2], t[timeslot*4+3] ) )
+        return ivt
+        
+    def to_string(self):
+        return ','.join(self.to_list())
+        
+    def copy(self):
+        return InverterSchedule(self.currents, self.times)
+        
+    def get_slot(self, charge=True, timeslot=0):
+        # returns (start minutes, end minutes, amps) for one charge/discharge timeslot (0, 1 or 2)
+        if timeslot < 0 or timeslot > 2:
+            raise SolisControlException('Bad time slot: should be 0, 1 or 2 -> %d' % timeslot)
+        t = timeslot * 4 + (0 if charge else 2)
+        return self.times[t], self.times[t+1], self.currents[timeslot * 2 + (0 if charge else 1)]
+        
+    def set_slot(self, charge=True, timeslot=0, start=0, end=0, amps=None):
+        # start and end are minutes from midnight or HH:MM strings, amps is optional
+        if timeslot < 0 or timeslot > 2:
+            raise SolisControlException('Bad time slot: should be 0, 1 or 2 -> %d' % timeslot)
+        minutes = [ hhmm_to_minutes(v) if isinstance(v, str) else v for v in (start, end) ]
+        for v, m in zip((start, end), minutes):
+            if not isinstance(m, int) or m < 0 or m >= 1440:
+                raise SolisControlException('Bad time: should be HH:MM or minutes from midnight -> %s' % str(v))
+        start, end = minutes
+        t = timeslot * 4 + (0 if charge else 2)
+        self.times[t] = start
+        self.times[t+1] = end
+        if amps is not None:
+            amps = str(amps)
+            self.currents[timeslot * 2 + (0 if charge else 1)] = int(amps) if amps.isdigit() and int(amps) <= 100 else 50
+            
+    def get_params(self, charge=True, timeslot=0):
+        # one timeslot as a params dict with 'start' (HH:MM), 'end' (HH:MM) and 'amps' keys
+        start, end, amps = self.get_slot(charge, timeslot)
+        return { 'start': minutes_to_hhmm(start), 'end': minutes_to_hhmm(end), 'amps': str(amps) }
+        
+    def set_params(self, params, charge=True, timeslot=0):
+        # note params is a dict with 'start' (HH:MM), 'end' (HH:MM) and optional 'amps' keys
+        if not params or 'start' not in params or 'end' not in params:
+            raise SolisControlException("Bad params: requires 'start' and 'end' keys")
+        self.set_slot(charge, timeslot, params['start'], params['end'], params.get('amps'))
+        
+    def active_slots(self):
+        # list of (charge, timeslot, start, end) for timeslots which are switched on (ie not 00:00 to 00:00)
+        result = []
+        for timeslot in (0, 1, 2):
+            for charge in (True, False):
+                start, end, amps = self.get_slot(charge, timeslot)
+                if start != end:
+                    result.append((charge, timeslot, start, end))
+        return result
+        
+    def overlaps(self):
+        # list of pairs of active slots which overlap in time - each slot as (charge, timeslot)
+        # note a slot with end before start is taken to run over midnight
+        spans = []
+        for charge, timeslot, start, end in self.active_slots():
+            parts = [ (start, end) ] if start < end else [ (start, 1440), (0, end) ]
+            spans.append(((charge, timeslot), parts))
+        result = []
+        for i in range(len(spans)):
+            for j in range(i + 1, len(spans)):
+                if any(s1 < e2 and s2 < e1 for s1, e1 in spans[i][1] for s2, e2 in spans[j][1]):
+                    result.append((spans[i][0], spans[j][0]))
+        return result
+        
+    def __eq__(self, other):
+        if not isinstance(other, InverterSchedule):
+            return NotImplemented
+        return self.currents == other.currents and self.times == other.times
+        
+    def __repr__(self):
+        return 'InverterSchedule(%r)' % self.to_string()
     
 def extract_inverter_params(inverter_data, charge=True, timeslot=0):
     # get one entry from the full inverter_data string (which has charge/discharge time and amp settings for 3 time slots)
     # charge should be True for charging, otherwise False for discharging
     # timeslot can be 0, 1 or 2
-    ivt = validated_inverter_data(inverter_data)
-    if timeslot < 0 or timeslot > 2:
-        raise SolisControlException('Bad time slot: should be 0, 1 or 2 -> %d' % timeslot)
-    offset = timeslot * 6
-    if charge:
-        return { 'start': ivt[offset+2], 'end': ivt[offset+3], 'amps': ivt[offset+0] }
-    else: # discharge
-        return { 'start': ivt[offset+4], 'end': ivt[offset+5], 'amps': ivt[offset+1] }
+    return InverterSchedule.parse(inverter_data).get_params(charge, timeslot)
     
 def extract_inverter_data(inverter_data):
     # get all entries from the full inverter_data string (which has charge/discharge time and amp settings for 3 time slots)
-    inverter_data = inverter_data.replace('-', ',')
-    ivt = inverter_data.split(',')
-    charge = []
-    discharge = []
-    for timeslot in (0, 1, 2):
-        offset = timeslot * 6
-        charge.append( { 'start': ivt[offset+2], 'end': ivt[offset+3], 'amps': ivt[offset+0] } )
-        discharge.append( { 'start': ivt[offset+4], 'end': ivt[offset+5], 'amps': ivt[offset+1] } )
+    schedule = InverterSchedule.parse(inverter_data)
+    charge = [ schedule.get_params(True, timeslot) for timeslot in (0, 1, 2) ]
+    discharge = [ schedule.get_params(False, timeslot) for timeslot in (0, 1, 2) ]
     return { 'charge_slots': charge, 'discharge_slots': discharge }   
     
 def setup_params(config_period, start, end):
@@ -153,40 +327,33 @@ def update_inverter_data(inverter_data, params, charge=True, timeslot=0):
     # note params is a dict with 'start' (HH:MM), 'end' (HH:MM) and optional 'amps' keys
     # charge should be True for charging, otherwise False for discharging
     # timeslot can ONLY be 0, 1 or 2
-    ivt = validated_inverter_data(inverter_data)
-    if not params or 'start' not in params or 'end' not in params:
-        raise SolisControlException("Bad params: requires 'start' and 'end' keys")
-    if timeslot < 0 or timeslot > 2:
-        raise SolisControlException('Bad time slot: should be 0, 1 or 2 -> %d' % timeslot)
-    offset = timeslot * 6
-    if charge:
-        ivt[offset+2] = params['start'] 
-        ivt[offset+3] = params['end']  
-        if 'amps' in params:
-            ivt[offset+0] = str(params['amps'])
-    else: # discharge
-        ivt[offset+4] = params['start'] 
-        ivt[offset+5] = params['end']  
-        if 'amps' in params:
-            ivt[offset+1] = str(params['amps'])
-    return ','.join(ivt)
+    schedule = InverterSchedule.parse(inverter_data)
+    schedule.set_params(params, charge, timeslot)
+    return schedule.to_string()
+    
+def apply_inverter_edits(inverter_data, edits):
+    # apply a list of (params, charge, timeslot) edits to the full inverter_data string - see update_inverter_data()
+    # note the string is parsed and serialised once for all the edits
+    schedule = InverterSchedule.parse(inverter_data)
+    for params, charge, timeslot in edits:
+        schedule.set_params(params, charge, timeslot)
+    return schedule.to_string()
+    
+def unchanged_inverter_data(old_data, new_data):
+    # True if the normalised inverter data strings are the same (ie there is no need to write new_data)
+    return InverterSchedule.parse(old_data) == InverterSchedule.parse(new_data)
+    
+def count_write(elided=False):
+    # keep a tally of control writes which were sent or skipped
+    WRITE_COUNTS['elided' if elided else 'written'] += 1
+    
+def write_ok(msg):
+    # True if a set/write result message indicates success (whether or not anything was written)
+    return msg == 'OK' or msg == UNCHANGED_MSG
     
 def validated_inverter_data(inverter_data):
-    inverter_data = inverter_data.replace('-', ',')
-    ivt = inverter_data.split(',')
-    if len(ivt) != 18:
-        raise SolisControlException('Bad inverter data: len != 18 -> %s' % inverter_data)
-    default = DEFAULT_INVERTER_DATA.split(',')
-    for i in range(len(ivt)):
-        if i in [ 0, 1, 6, 7, 12, 13 ]: # charge/ discharge current
-            if not ivt[i].isdigit() or int(ivt[i]) < 0 or int(ivt[i]) > 100:
-                ivt[i] = default[i]
-        else: # start / end times
-            try:
-                datetime.strptime(ivt[i], '%H:%M')
-            except ValueError:
-                ivt[i] = default[i]
-    return ivt
+    # list of the 18 fields in the inverter_data string with any invalid values replaced by defaults
+    return InverterSchedule.parse(inverter_data).to_list()
     
 def energy_values(config):
     # return 4 values representing energy available from the battery
@@ -260,6 +427,21 @@ def eah_from_soc(capacity, current, minutes, start_soc, end_soc):
     hours = minutes / 60.0
     return round(energy_diff / hours / current, 4) # energy (kWh) added for each hour and amp 
 
+def period_eah(config, charge=True, current=None):
+    # energy_amp_hour for charging (or discharging) at a current - from the band for the current in
+    # 'energy_amp_hour_charge' or 'energy_amp_hour_discharge' if set (eg fitted by solis_calibrate) otherwise 'energy_amp_hour'
+    # note the lowest band also applies below its limit, returns None if nothing is set (ie use ENERGY_AMP_HOUR)
+    bands = config.get(EAH_BAND_KEYS[bool(charge)])
+    if not bands:
+        return config.get('energy_amp_hour')
+    bands = sorted((float(k), float(v)) for k, v in bands.items())
+    eah = bands[0][1]
+    if current is not None:
+        for lower, value in bands:
+            if float(current) >= lower:
+                eah = value
+    return eah
+
 def start_end_times(period_start, minutes, period_end=None): 
     # work out the start, end times and position them within the charge/discharge period
     if minutes <= 0:
@@ -298,31 +480,90 @@ def check_time(config, diff_mins=1.0):
         return 'Inverter date/time (%s) more than %.1f minutes out of sync with host (%s)' % (inv.isoformat(), diff_mins, host.isoformat())
     return 'OK'
                 
+def request_body(endpoint, *values):
+    # JSON body for an endpoint from its template eg request_body(READ_ENDPOINT, inverter_id, '56')
+    return BODY_TEMPLATES[endpoint] % values
+    
+def signer(config):
+    # HMAC-SHA1 object keyed with the API secret, made once for each set of credentials - copy it before use
+    key = (config['solis_key_id'], config['solis_key_secret'])
+    hmac_obj = SIGNERS.get(key)
+    if hmac_obj is None:
+        hmac_obj = SIGNERS[key] = hmac.new(key[1].encode('utf-8'), digestmod=hashlib.sha1)
+    return hmac_obj
+    
+def http_date():
+    # RFC 1123 date (UTC) for the Date header - only formatted once a second
+    second = int(time_now())
+    cached = DATE_CACHE[0]
+    if cached[0] != second:
+        cached = (second, datetime.fromtimestamp(second, timezone.utc).strftime("%a, %d %b %Y %H:%M:%S GMT"))
+        DATE_CACHE[0] = cached # replaced as a whole so it is safe across threads
+    return cached[1]
+                
 def prepare_post_header(config, body, canonicalized_resource):
     content_md5 = digest(body)
-    content_type = "application/json"
-    now = datetime.now(timezone.utc)
-    date = now.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    date = http_date()
     encrypt_str = ("POST" + "\n"
         + content_md5 + "\n"
-        + content_type + "\n"
+        + CONTENT_TYPE + "\n"
         + date + "\n"
         + canonicalized_resource
     )
-    hmac_obj = hmac.new(
-        config['solis_key_secret'].encode('utf-8'),
-        msg=encrypt_str.encode('utf-8'),
-        digestmod=hashlib.sha1
-    )
+    hmac_obj = signer(config).copy()
+    hmac_obj.update(encrypt_str.encode('utf-8'))
     sign = base64.b64encode(hmac_obj.digest())
     authorization = "API " + config['solis_key_id'] + ":" + sign.decode('utf-8')
     header = {
         "Content-MD5":content_md5,
-        "Content-Type":content_type,
+        "Content-Type":CONTENT_TYPE,
         "Date":date,
         "Authorization":authorization
     }
     return header
+    
+def prepare_request(config, endpoint, *values):
+    # (body, headers) for a signed POST to an endpoint - see request_body()
+    body = request_body(endpoint, *values)
+    return body, prepare_post_header(config, body, endpoint)
+                        
+def prepare_page_request(config, endpoint, page_no, page_size=LIST_PAGE_SIZE):
+    # (body, headers) for a signed POST for one page of a list endpoint eg INVERTER_ENDPOINT
+    body = PAGE_TEMPLATE % (page_no, page_size)
+    return body, prepare_post_header(config, body, endpoint)
+    
+def list_page(data):
+    # page dict (with 'records') from the data of a list endpoint result - records may be under 'page' or directly in data
+    return data['page'] if 'page' in data else data
+    
+def page_count(page):
+    # number of pages in a list endpoint result from its 'page' dict
+    if page.get('pages'):
+        return int(page['pages'])
+    size = int(page.get('size') or LIST_PAGE_SIZE)
+    return (int(page.get('total') or 0) + size - 1) // size
+    
+def detail_states(records, states=None):
+    # per inverter state (by serial number) from inverter detail list records
+    # each has the same keys as a config after get_inverter_entry() and get_inverter_detail() plus 'solis_station_id'
+    if states is None:
+        states = {}
+    for record in records:
+        state = { 'solis_station_id': str(record.get('stationId', '')) }
+        add_fields(ENTRY_FIELDS, record, state)
+        add_fields(DETAIL_FIELDS, record, state)
+        states[record.get('sn', '')] = state
+    return states
+    
+def index_inverters(records, index=None):
+    # index inverter list records by station id (list of records) and by serial number (record)
+    # records can be added in batches as they arrive by passing back the previous index
+    if index is None:
+        index = { 'stations': {}, 'serials': {} }
+    for record in records:
+        index['stations'].setdefault(record.get('stationId', ''), []).append(record)
+        index['serials'][record.get('sn', '')] = record
+    return index
                         
 def check_current(config, current=None):
     # current for charging/discharging must be below inverter max and also below battery_max_current
@@ -395,6 +636,39 @@ def add_fields(field_map, source, dest):
         #    dest['inverter_datetime'] = datetime.fromtimestamp(float(source['dataTimestamp'])/1000.0)
         #    dest['host_datetime'] = datetime.now()
             
+def error_kind(status=None, code=None, exception=None):
+    # classify an API error as 'timeout', 'connection', 'rate' (HTTP 429), 'server' (HTTP 5xx),
+    # 'busy' (eg B0115), 'token' (login token expired), 'deadline' (time budget spent) or 'fatal' (not worth retrying)
+    if isinstance(exception, DeadlineExceeded):
+        return 'deadline'
+    if exception is not None: # exception class names are checked so this works for requests and aiohttp
+        names = [ c.__name__ for c in type(exception).__mro__ ]
+        if any('Timeout' in n for n in names):
+            return 'timeout'
+        if any('Connection' in n or 'Disconnected' in n for n in names):
+            return 'connection'
+        return 'fatal'
+    if status == 429:
+        return 'rate'
+    if status == 401 or code in TOKEN_CODES:
+        return 'token'
+    if status is not None and status >= 500:
+        return 'server'
+    if code in BUSY_CODES:
+        return 'busy'
+    return 'fatal'
+    
+def record_error(config, status=None, code=None, msg=None, exception=None):
+    # note the last API error in the config so callers can decide whether to try again - see solis_retry
+    if exception is not None and msg is None:
+        msg = repr(exception)
+    config['last_error'] = { 'kind': error_kind(status, code, exception), 'status': status, 'code': code, 'msg': msg }
+            
+def last_error_kind(config):
+    # kind of the last error recorded in the config - 'fatal' if there is none (eg a failed check or missing data)
+    error = config.get('last_error')
+    return error['kind'] if error else 'fatal'
+            
 def json_strip(response_text): # strip erroneous trailing commas in JSON dicts 
     json_string = re.sub(r'\s*,(\s*})', r'\1', response_text) 
     return json.loads(json_string)
@@ -0,0 +1,371 @@
+from aiohttp import ClientSession, ClientError, ClientTimeout, TCPConnector
+from http import HTTPStatus
+import asyncio
+import logging
+from datetime import datetime
+
+try:
+    import solis_common as common
+    import solis_limiter as limiter
+except ImportError:
+    from soliscontrol import solis_common as common
+    from soliscontrol import solis_limiter as limiter
+
+""" Client module for Solis Cloud API access via aiohttp library and asyncio
+See monitoring API https://oss.soliscloud.com/templet/SolisCloud%20Platform%20API%20Document%20V2.0.pdf
+and separate control API https://oss.soliscloud.com/doc/SolisCloud%20Device%20Control%20API%20V2.0.pdf
+
+This is an async port of solis_control_req_mod with the same function names and arguments
+(connection state is passed between methods in the config dict) so many stations can be
+handled concurrently on one event loop - see solis_fleet.py
+
+Not for use with Home Assistant pyscript (see solis_control_req_mod instead)"""
+
+log = logging.getLogger(__name__)
+
+CLIENT_ERRORS = (ClientError, asyncio.TimeoutError)
+
+def client_timeout(config):
+    # aiohttp equivalent of the (connect, read) timeouts from common.request_timeout()
+    connect, read = common.request_timeout(config)
+    return ClientTimeout(total=read, sock_connect=connect)
+    
+def get_session(limit=100):
+    # limit is the maximum number of simultaneous connections in the pool
+    return ClientSession(connector=TCPConnector(limit=limit))
+
+async def get_inverter_entry(config, session):
+    body, header = common.prepare_request(config, common.INVERTER_ENDPOINT, config['solis_station_id'])
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    inverter_entry = None
+    try:
+        await limiter.acquire_async(config['api_url']+common.INVERTER_ENDPOINT, header, config)
+        async with session.post(config['api_url']+common.INVERTER_ENDPOINT, data = body, headers = header, timeout = client_timeout(config)) as response:
+            status = response.status
+            if status == HTTPStatus.OK:
+                result = await response.json(content_type=None)
+                if result.get('success') and result.get('data'):
+                    for record in result['data']['page']['records']:
+                      if record.get('stationId', '') == config['solis_station_id']:
+                        common.add_fields(common.ENTRY_FIELDS, record, config)
+                        inverter_entry = record
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    log.warning('Payload error getting inverter entry: %s %s' % (result.get('code'), result.get('msg')))
+            else:
+                common.record_error(config, status, msg=await response.text())
+                log.warning('HTTP error getting inverter entry: %d %s' % (status, await response.text()))
+    except CLIENT_ERRORS as e:
+        common.record_error(config, exception=e)
+        log.warning('Client error getting inverter entry: ' + repr(e))
+    return inverter_entry
+
+async def get_list_page(config, session, endpoint, page_no, page_size=common.LIST_PAGE_SIZE):
+    # one page of a list endpoint (see common.LIST_NAMES) for every inverter in the account
+    # returns the page dict ('records', 'total', 'pages' etc) or None
+    body, header = common.prepare_page_request(config, endpoint, page_no, page_size)
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    list_page = None
+    try:
+        await limiter.acquire_async(config['api_url']+endpoint, header, config)
+        async with session.post(config['api_url']+endpoint, data = body, headers = header, timeout = client_timeout(config)) as response:
+            status = response.status
+            if status == HTTPStatus.OK:
+                result = await response.json(content_type=None)
+                if result.get('success') and result.get('data'):
+                    list_page = common.list_page(result['data'])
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    log.warning('Payload error getting %s page %d: %s %s' % (common.LIST_NAMES[endpoint], page_no, result.get('code'), result.get('msg')))
+            else:
+                common.record_error(config, status, msg=await response.text())
+                log.warning('HTTP error getting %s page %d: %d %s' % (common.LIST_NAMES[endpoint], page_no, status, await response.text()))
+    except CLIENT_ERRORS as e:
+        common.record_error(config, exception=e)
+        log.warning('Client error getting %s page %d: %s' % (common.LIST_NAMES[endpoint], page_no, repr(e)))
+    return list_page
+
+async def iter_list(config, session, endpoint, page_size=common.LIST_PAGE_SIZE, concurrency=4):
+    # async generator of the records of a list endpoint for every inverter in the account, yielded as each page arrives
+    # the first page gives the number of pages then the rest are fetched at most 'concurrency' at once
+    # pages which could not be read are listed in config['missing_pages']
+    config['missing_pages'] = []
+    first = await get_list_page(config, session, endpoint, 1, page_size)
+    if not first:
+        config['missing_pages'].append(1)
+        return
+    for record in first['records']:
+        yield record
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def get_page(page_no):
+        async with semaphore:
+            return page_no, await get_list_page(config, session, endpoint, page_no, page_size)
+
+    tasks = [ asyncio.ensure_future(get_page(n)) for n in range(2, common.page_count(first) + 1) ]
+    try:
+        for next_page in asyncio.as_completed(tasks):
+            page_no, page = await next_page
+            if page:
+                for record in page['records']:
+                    yield record
+            else:
+                config['missing_pages'].append(page_no)
+    finally: # if the caller stops early
+        for task in tasks:
+            task.cancel()
+
+def iter_inverters(config, session, page_size=common.LIST_PAGE_SIZE, concurrency=4):
+    # async generator of the inverter list records (id, sn, stationId etc) for every inverter in the account
+    return iter_list(config, session, common.INVERTER_ENDPOINT, page_size, concurrency)
+
+async def get_inverter_details(config, session, page_size=common.LIST_PAGE_SIZE, concurrency=4):
+    # battery SOC, over discharge SOC, power etc for every inverter in the account from the paged detail list
+    # (one request for each 100 inverters rather than one each) - returns a dict of per inverter state by serial number
+    # see common.detail_states()
+    states = {}
+    async for record in iter_list(config, session, common.DETAIL_LIST_ENDPOINT, page_size, concurrency):
+        common.detail_states([ record ], states)
+    return states
+
+async def get_inverter_detail(config, session):
+    if not config.get('inverter_id'):
+        raise common.SolisControlException('No inverter id details from connection')
+    body, header = common.prepare_request(config, common.DETAIL_ENDPOINT, config['inverter_id'], config['inverter_sn'])
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    inverter_detail = None
+    try:
+        await limiter.acquire_async(config['api_url']+common.DETAIL_ENDPOINT, header, config)
+        async with session.post(config['api_url']+common.DETAIL_ENDPOINT, data = body, headers = header, timeout = client_timeout(config)) as response:
+            status = response.status
+            if status == HTTPStatus.OK:
+                result = await response.json(content_type=None)
+                if result.get('success') and result.get('data'):
+                    record = result['data']
+                    common.add_fields(common.DETAIL_FIELDS, record, config)
+                    inverter_detail = record
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    log.warning('Payload error getting inverter detail: %s %s' % (result.get('code'), result.get('msg')))
+            else:
+                common.record_error(config, status, msg=await response.text())
+                log.warning('HTTP error getting inverter detail: %d %s' % (status, await response.text()))
+    except CLIENT_ERRORS as e:
+        common.record_error(config, exception=e)
+        log.warning('Client error getting inverter detail: ' + repr(e))
+    return inverter_detail
+
+async def get_login_detail(config, session):
+    body, header = common.prepare_request(config, common.LOGIN_ENDPOINT, config['solis_user_name'], common.password_encode(config['solis_password']))
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    login_detail = None
+    try:
+        await limiter.acquire_async(config['api_url']+common.LOGIN_ENDPOINT, header, config)
+        async with session.post(config['api_url']+common.LOGIN_ENDPOINT, data = body, headers = header, timeout = client_timeout(config)) as response:
+            status = response.status
+            if status == HTTPStatus.OK:
+                result = common.json_strip(await response.text()) # deals with erroneous trailing commas in dicts
+                if result.get('success') and result.get('data'):
+                    record = result['data']
+                    common.add_fields(common.LOGIN_FIELDS, record, config)
+                    login_detail = record
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    log.warning('Payload error getting login detail: %s %s' % (result.get('code'), result.get('msg')))
+            else:
+                common.record_error(config, status, msg=await response.text())
+                log.warning('HTTP error getting login detail: %d %s' % (status, await response.text()))
+    except CLIENT_ERRORS as e:
+        common.record_error(config, exception=e)
+        log.warning('Client error getting login detail: ' + repr(e))
+    return login_detail
+
+async def set_inverter_params(config, session, params, charge=True, timeslot=0, verbose=False):
+    # note sets one charge/discharge timeslot - keeps existing inverter data
+    # note params is a dict with 'start' (HH:MM), 'end' (HH:MM) and optional 'amps' keys
+    # charge should be True for charging, otherwise False for discharging
+    # timeslot can ONLY be 0, 1 or 2
+    return await set_inverter_schedule(config, session, [ (params, charge, timeslot) ], verbose)
+
+async def set_inverter_schedule(config, session, edits, verbose=False, force=False, test=False):
+    # sets several charge/discharge timeslots in one read-modify-write of the inverter data - keeps other existing settings
+    # note edits is a list of (params, charge, timeslot) tuples - see set_inverter_params() above
+    # if the result is the same as the existing inverter data, nothing is written and common.UNCHANGED_MSG is returned (unless force is True)
+    # if test is True the existing data is read but nothing is written (or counted) and 'OK' is returned for a change
+    existing_data = await get_inverter_data(config, session, verbose)
+    if not existing_data:
+        return 'Error getting charging/discharging times'
+    inverter_data = common.apply_inverter_edits(existing_data, edits)
+    if not force and common.unchanged_inverter_data(existing_data, inverter_data):
+        if not test:
+            common.count_write(elided=True)
+        return common.UNCHANGED_MSG
+    if test:
+        if verbose:
+            print ('Inverter data test:', inverter_data)
+        return 'OK'
+    return await set_inverter_data(config, session, inverter_data, verbose)
+
+async def set_inverter_data(config, session, inverter_data=None, verbose=False):
+    if not config.get('login_token'):
+        raise common.SolisControlException('Not logged in')
+    check = common.check_all(config, 2.0) # check current settings and time sync (more time leeway as already connected)
+    if check != 'OK':
+        return check
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    set_times_msg = None
+    if inverter_data is None:
+        inverter_data = common.DEFAULT_INVERTER_DATA
+    if verbose:
+        print ('Inverter data write:', inverter_data)
+    try:
+        body = common.prepare_body(config, inverter_data)
+        headers = common.prepare_post_header(config, body, common.CONTROL_ENDPOINT)
+        headers['token'] = config['login_token']
+        await limiter.acquire_async(config['api_url']+common.CONTROL_ENDPOINT, headers, config)
+        async with session.post(config['api_url']+common.CONTROL_ENDPOINT, data = body, headers = headers, timeout = client_timeout(config)) as response:
+            status = response.status
+            if status == HTTPStatus.OK:
+                result = await response.json(content_type=None)
+                if result.get('code') == '0':
+                    set_times_msg = 'OK'
+                    common.count_write()
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    set_times_msg = 'Payload error setting charging/discharging times: %s' % (str(result))
+            else:
+                common.record_error(config, status, msg=await response.text())
+                set_times_msg = 'HTTP error setting charging/discharging times: %d %s' % (status, await response.text())
+    except CLIENT_ERRORS as e:
+        common.record_error(config, exception=e)
+        set_times_msg = 'Client error setting charging/discharging times: ' + repr(e)
+    return set_times_msg
+
+async def get_inverter_data(config, session, verbose=False):
+    if not config.get('login_token'):
+        raise common.SolisControlException('Not logged in')
+    body = common.prepare_body(config)
+    headers = common.prepare_post_header(config, body, common.READ_ENDPOINT)
+    headers['token']= config['login_token']
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    inverter_data = None
+    try:
+        await limiter.acquire_async(config['api_url']+common.READ_ENDPOINT, headers, config)
+        async with session.post(config['api_url']+common.READ_ENDPOINT, data = body, headers = headers, timeout = client_timeout(config)) as response:
+            status = response.status
+            if status == HTTPStatus.OK:
+                result = await response.json(content_type=None)
+                if result.get('code') == '0'  and result.get('data') and result['data'].get('msg'):
+                    inverter_data = result['data']['msg']
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    log.warning('Payload error getting charging/discharging times: %s' % (str(result)))
+            else:
+                common.record_error(config, status, msg=await response.text())
+                log.warning('HTTP error getting charging/discharging times: %d %s' % (status, await response.text()))
+    except CLIENT_ERRORS as e:
+        common.record_error(config, exception=e)
+        log.warning('Client error getting charging/discharging times: ' + repr(e))
+    if verbose:
+        print ('Inverter data read :', inverter_data)
+    if not inverter_data:
+        return None
+    return inverter_data
+
+async def get_inverter_datetime(config, session):
+    if not config.get('login_token'):
+        raise common.SolisControlException('Not logged in')
+    body, headers = common.prepare_request(config, common.READ_ENDPOINT, config['inverter_id'], '56')
+    headers['token']= config['login_token']
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    inverter_datetime = None
+    try:
+        await limiter.acquire_async(config['api_url']+common.READ_ENDPOINT, headers, config)
+        async with session.post(config['api_url']+common.READ_ENDPOINT, data = body, headers = headers, timeout = client_timeout(config)) as response:
+            status = response.status
+            if status == HTTPStatus.OK:
+                result = await response.json(content_type=None)
+                if result.get('code') == '0'  and result.get('data') and result['data'].get('msg'):
+                    inverter_datetime = datetime.fromisoformat(result['data']['msg'])
+                    config['inverter_datetime'] = inverter_datetime
+                    config['host_datetime'] = datetime.now()
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    log.warning('Payload error getting inverter time: %s' % (str(result)))
+            else:
+                common.record_error(config, status, msg=await response.text())
+                log.warning('HTTP error getting inverter time: %d %s' % (status, await response.text()))
+    except CLIENT_ERRORS as e:
+        common.record_error(config, exception=e)
+        log.warning('Client error getting inverter time: ' + repr(e))
+    if not inverter_datetime:
+        return None
+    return inverter_datetime
+
+async def set_inverter_datetime(config, session, inverter_datetime=None):
+    if not config.get('login_token'):
+        raise common.SolisControlException('Not logged in')
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    set_time_msg = None
+    if inverter_datetime is None:
+        inverter_datetime = datetime.now()
+    else:
+        if isinstance(inverter_datetime, str):
+            inverter_datetime = datetime.fromisoformat(inverter_datetime)
+        if not isinstance(inverter_datetime, datetime):
+            raise common.SolisControlException('Bad inverter datetime -> %s' % str(inverter_datetime))
+    try:
+        value = inverter_datetime.strftime('%Y-%m-%d %H:%M:%S')
+        body, headers = common.prepare_request(config, common.CONTROL_ENDPOINT, config['inverter_id'], '56', value)
+        headers['token'] = config['login_token']
+        await limiter.acquire_async(config['api_url']+common.CONTROL_ENDPOINT, headers, config)
+        async with session.post(config['api_url']+common.CONTROL_ENDPOINT, data = body, headers = headers, timeout = client_timeout(config)) as response:
+            status = response.status
+            if status == HTTPStatus.OK:
+                result = await response.json(content_type=None)
+                if result.get('code') == '0':
+                    set_time_msg = 'OK'
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    set_time_msg = 'Payload error setting inverter time: %s' % (str(result))
+            else:
+                common.record_error(config, status, msg=await response.text())
+                set_time_msg = 'HTTP error setting inverter time: %d %s' % (status, await response.text())
+    except CLIENT_ERRORS as e:
+        common.record_error(config, exception=e)
+        set_time_msg = 'Client error setting inverter time: ' + repr(e)
+    return set_time_msg
+
+async def connect(config, session):
+    # the inverter list lookup is skipped if the entry is already known (eg from a paged list - see solis_fleet.run_account)
+    # and the login is skipped if there is already a token (eg from one login for the whole account) - pop 'login_token' to force it
+    try:
+        if config.get('inverter_id') and config.get('inverter_sn'):
+            if not config.get('api_url'):
+                config['api_url'] = common.DEFAULT_API_URL
+        elif not await get_inverter_entry(config, session):
+            return False
+        if not await get_inverter_detail(config, session):
+            return False
+        if not config.get('login_token') and not await get_login_detail(config, session):
+            return False
+        await get_inverter_datetime(config, session)
+        check = common.check_time(config) # default acceptable time difference = 1 min
+        if check != 'OK':
+            check = await set_inverter_datetime(config, session)
+            if check == 'OK':
+                await get_inverter_datetime(config, session) # so later time checks see the corrected time
+        if check != 'OK':
+            return False
+        return True
+    except common.SolisControlException as e:
+        log.warning('Cannot connect to inverter: %s', str(e))
+        return False
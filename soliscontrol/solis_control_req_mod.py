@@ -3,12 +3,17 @@
 import logging
 import yaml
 import json
+import time
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 try:
     import solis_common as common
+    import solis_limiter as limiter
 except ImportError:
     from soliscontrol import solis_common as common
+    from soliscontrol import solis_limiter as limiter
 
 """ Client module for Solis Cloud API access via requests library
 See monitoring API https://oss.soliscloud.com/templet/SolisCloud%20Platform%20API%20Document%20V2.0.pdf
@@ -35,7 +40,23 @@
 if not PYSCRIPT:
     log = logging.getLogger(__name__)
     
-def make_request(call, *args, **kwargs):
+TOKEN_TTL = 3600 # seconds a login token is re-used before logging in again (see open_connection)
+CONNECTION_TTL = 24 * 3600 # seconds before a connection handle does a full reconnect
+TIME_CHECK_TTL = TOKEN_TTL # seconds between inverter clock checks on a connection handle
+LOCK_POLL = 0.05 # seconds between tries for a connection handle lock held by someone else
+    
+def sleep(secs):
+    if PYSCRIPT:
+        return task.sleep(secs)
+    else:
+        return time.sleep(secs)
+    
+def make_request(call, *args, config=None, **kwargs):
+    # every call waits its turn within the API rate limit first - see solis_limiter
+    # the timeout is worked out from the config after that wait so it only has the time left before any deadline
+    limiter.acquire(args[0] if args else kwargs.get('url', ''), kwargs.get('headers'), config)
+    if config is not None:
+        kwargs['timeout'] = common.request_timeout(config)
     if PYSCRIPT:
         return task.executor(call, *args, **kwargs)
     else:
@@ -45,13 +66,12 @@ def get_session():
     return Session()
     
 def get_inverter_entry(config, session): 
-    body = '{"stationId":"'+config['solis_station_id']+'"}'
-    header = common.prepare_post_header(config, body, common.INVERTER_ENDPOINT)
+    body, header = common.prepare_request(config, common.INVERTER_ENDPOINT, config['solis_station_id'])
     if not config.get('api_url'):
         config['api_url'] = common.DEFAULT_API_URL
     inverter_entry = None
     try:
-        with make_request(session.post, config['api_url']+common.INVERTER_ENDPOINT, data = body, headers = header) as response:
+        with make_request(session.post, config['api_url']+common.INVERTER_ENDPOINT, data = body, headers = header, config = config) as response:
             status = response.status_code
             if status == HTTPStatus.OK:
                 result = response.json()
@@ -61,24 +81,99 @@ def get_inverter_entry(config, session):
                         common.add_fields(common.ENTRY_FIELDS, record, config)
                         inverter_entry = record
                 else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
                     log.warning('Payload error getting inverter entry: %s %s' % (result.get('code'), result.get('msg')))
             else:
+                common.record_error(config, status, msg=response.text)
                 log.warning('HTTP error getting inverter entry: %d %s' % (status, response.text))
     except RequestException as e:
+        common.record_error(config, exception=e)
         log.warning('Request exception getting inverter entry: ' + str(e))
     #print(inverter_entry)
     return inverter_entry
         
+def get_list_page(config, session, endpoint, page_no, page_size=common.LIST_PAGE_SIZE):
+    # one page of a list endpoint (see common.LIST_NAMES) for every inverter in the account
+    # returns the page dict ('records', 'total', 'pages' etc) or None
+    body, header = common.prepare_page_request(config, endpoint, page_no, page_size)
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    list_page = None
+    try:
+        with make_request(session.post, config['api_url']+endpoint, data = body, headers = header, config = config) as response:
+            status = response.status_code
+            if status == HTTPStatus.OK:
+                result = response.json()
+                if result.get('success') and result.get('data'):
+                    list_page = common.list_page(result['data'])
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    log.warning('Payload error getting %s page %d: %s %s' % (common.LIST_NAMES[endpoint], page_no, result.get('code'), result.get('msg')))
+            else:
+                common.record_error(config, status, msg=response.text)
+                log.warning('HTTP error getting %s page %d: %d %s' % (common.LIST_NAMES[endpoint], page_no, status, response.text))
+    except RequestException as e:
+        common.record_error(config, exception=e)
+        log.warning('Request exception getting %s page %d: %s' % (common.LIST_NAMES[endpoint], page_no, str(e)))
+    return list_page
+    
+def iter_list(config, session, endpoint, page_size=common.LIST_PAGE_SIZE, concurrency=4):
+    # generator of the records of a list endpoint for every inverter in the account, yielded as each page arrives
+    # the first page gives the number of pages then the rest are fetched on a thread pool at most 'concurrency' at once
+    # (in sequence under pyscript) - pages which could not be read are listed in config['missing_pages']
+    config['missing_pages'] = []
+    first = get_list_page(config, session, endpoint, 1, page_size)
+    if not first:
+        config['missing_pages'].append(1)
+        return
+    yield from first['records']
+    pages = iter(range(2, common.page_count(first) + 1))
+    if PYSCRIPT:
+        for page_no in pages:
+            page = get_list_page(config, session, endpoint, page_no, page_size)
+            if page:
+                yield from page['records']
+            else:
+                config['missing_pages'].append(page_no)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = {}
+        for page_no in pages:
+            running[executor.submit(get_list_page, config, session, endpoint, page_no, page_size)] = page_no
+            if len(running) >= concurrency:
+                break
+        while running:
+            done, not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                page_no = running.pop(future)
+                page = future.result()
+                if page:
+                    yield from page['records']
+                else:
+                    config['missing_pages'].append(page_no)
+                for page_no in pages: # keep the pool full
+                    running[executor.submit(get_list_page, config, session, endpoint, page_no, page_size)] = page_no
+                    break
+    
+def iter_inverters(config, session, page_size=common.LIST_PAGE_SIZE, concurrency=4):
+    # generator of the inverter list records (id, sn, stationId etc) for every inverter in the account
+    return iter_list(config, session, common.INVERTER_ENDPOINT, page_size, concurrency)
+    
+def get_inverter_details(config, session, page_size=common.LIST_PAGE_SIZE, concurrency=4):
+    # battery SOC, over discharge SOC, power etc for every inverter in the account from the paged detail list
+    # (one request for each 100 inverters rather than one each) - returns a dict of per inverter state by serial number
+    # see common.detail_states()
+    return common.detail_states(iter_list(config, session, common.DETAIL_LIST_ENDPOINT, page_size, concurrency))
+    
 def get_inverter_detail(config, session): 
     if not config.get('inverter_id'):
         raise common.SolisControlException('No inverter id details from connection')
-    body = '{"id":"'+config['inverter_id']+'","sn":"'+config['inverter_sn']+'"}'
-    header = common.prepare_post_header(config, body, common.DETAIL_ENDPOINT)
+    body, header = common.prepare_request(config, common.DETAIL_ENDPOINT, config['inverter_id'], config['inverter_sn'])
     if not config.get('api_url'):
         config['api_url'] = common.DEFAULT_API_URL
     inverter_detail = None
     try:
-        with make_request(session.post, config['api_url']+common.DETAIL_ENDPOINT, data = body, headers = header) as response:
+        with make_request(session.post, config['api_url']+common.DETAIL_ENDPOINT, data = body, headers = header, config = config) as response:
             status = response.status_code
             if status == HTTPStatus.OK:
                 result = response.json()
@@ -87,22 +182,52 @@ def get_inverter_detail(config, session):
                     common.add_fields(common.DETAIL_FIELDS, record, config)
                     inverter_detail = record
                 else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
                     log.warning('Payload error getting inverter detail: %s %s' % (result.get('code'), result.get('msg')))
             else:
+                common.record_error(config, status, msg=response.text)
                 log.warning('HTTP error getting inverter detail: %d %s' % (status, response.text))
     except RequestException as e:
+        common.record_error(config, exception=e)
         log.warning('Request exception getting inverter detail: ' + str(e))
     #print(json.dumps(inverter_detail, indent=2))
     return inverter_detail
         
+def get_inverter_history(config, session, endpoint, when):
+    # list of records from the day (5 minute data, when is YYYY-MM-DD) or month (daily data, when is YYYY-MM) endpoint
+    # note 'solis_time_zone' (hours, default 0) and 'solis_currency' can be set in the config - returns None on error
+    if not config.get('inverter_id'):
+        raise common.SolisControlException('No inverter id details from connection')
+    body, header = common.prepare_request(config, endpoint, config['inverter_id'], config['inverter_sn'],
+        config.get('solis_currency', ''), when, config.get('solis_time_zone', 0))
+    if not config.get('api_url'):
+        config['api_url'] = common.DEFAULT_API_URL
+    records = None
+    try:
+        with make_request(session.post, config['api_url']+endpoint, data = body, headers = header, config = config) as response:
+            status = response.status_code
+            if status == HTTPStatus.OK:
+                result = response.json()
+                if result.get('success') and result.get('data') is not None:
+                    records = result['data']
+                else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
+                    log.warning('Payload error getting inverter history for %s: %s %s' % (when, result.get('code'), result.get('msg')))
+            else:
+                common.record_error(config, status, msg=response.text)
+                log.warning('HTTP error getting inverter history for %s: %d %s' % (when, status, response.text))
+    except RequestException as e:
+        common.record_error(config, exception=e)
+        log.warning('Request exception getting inverter history for %s: %s' % (when, str(e)))
+    return records
+        
 def get_login_detail(config, session): 
-    body = '{"userInfo":"'+config['solis_user_name']+'","passWord":"'+common.password_encode(config['solis_password'])+'"}'
-    header = common.prepare_post_header(config, body, common.LOGIN_ENDPOINT)
+    body, header = common.prepare_request(config, common.LOGIN_ENDPOINT, config['solis_user_name'], common.password_encode(config['solis_password']))
     if not config.get('api_url'):
         config['api_url'] = common.DEFAULT_API_URL
     login_detail = None
     try:
-        with make_request(session.post, config['api_url']+common.LOGIN_ENDPOINT, data = body, headers = header) as response:
+        with make_request(session.post, config['api_url']+common.LOGIN_ENDPOINT, data = body, headers = header, config = config) as response:
             status = response.status_code
             if status == HTTPStatus.OK:
                 #result = response.json()
@@ -113,10 +238,13 @@ def get_login_detail(config, session):
                     common.add_fields(common.LOGIN_FIELDS, record, config)
                     login_detail = record
                 else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
                     log.warning('Payload error getting login detail: %s %s' % (result.get('code'), result.get('msg')))
             else:
+                common.record_error(config, status, msg=response.text)
                 log.warning('HTTP error getting login detail: %d %s' % (status, response.text))
     except RequestException as e:
+        common.record_error(config, exception=e)
         log.warning('Request exception getting login detail: ' + str(e))
     #print(login_detail)
     return login_detail
@@ -126,6 +254,12 @@ def set_inverter_params(config, session, params, charge=True, timeslot=0, verbos
     # note params is a dict with 'start' (HH:MM), 'end' (HH:MM) and optional 'amps' keys
     # charge should be True for charging, otherwise False for discharging
     # timeslot can ONLY be 0, 1 or 2
+    return set_inverter_schedule(config, session, [ (params, charge, timeslot) ], verbose)
+    
+def set_inverter_schedule(config, session, edits, verbose=False, force=False):
+    # sets several charge/discharge timeslots in one read-modify-write of the inverter data - keeps other existing settings
+    # note edits is a list of (params, charge, timeslot) tuples - see set_inverter_params() above
+    # if the result is the same as the existing inverter data, nothing is written and common.UNCHANGED_MSG is returned (unless force is True)
     if not config.get('login_token'):
         raise common.SolisControlException('Not logged in')
     check = common.check_all(config, 2.0) # check current settings and time sync (more time leeway as already connected)
@@ -138,39 +272,51 @@ def set_inverter_params(config, session, params, charge=True, timeslot=0, verbos
         body = common.prepare_body(config)
         headers = common.prepare_post_header(config, body, common.READ_ENDPOINT)
         headers['token'] = config['login_token']
-        with make_request(session.post, config['api_url']+common.READ_ENDPOINT, data = body, headers = headers) as response:
+        with make_request(session.post, config['api_url']+common.READ_ENDPOINT, data = body, headers = headers, config = config) as response:
             status = response.status_code
             if status == HTTPStatus.OK:
                 result = response.json()
                 if result.get('code') == '0'  and result.get('data') and result['data'].get('msg'): 
                     inverter_data = result['data']['msg']
                 else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
                     set_times_msg = 'Payload error getting charging/discharging times: %s' % (str(result))
             else:
+                common.record_error(config, status, msg=response.text)
                 set_times_msg = 'HTTP error getting charging/discharging times: %d %s' % (status, response.text)
         if set_times_msg is not None:
             return set_times_msg
         
         if verbose: 
             print ('Inverter data read :', inverter_data)
-        inverter_data = common.update_inverter_data(inverter_data, params, charge=charge, timeslot=timeslot)
+        existing_data = inverter_data
+        inverter_data = common.apply_inverter_edits(inverter_data, edits)
+        if not force and common.unchanged_inverter_data(existing_data, inverter_data):
+            common.count_write(elided=True)
+            if verbose: 
+                print ('Inverter data unchanged - no write')
+            return common.UNCHANGED_MSG
         if verbose: 
             print ('Inverter data write:', inverter_data)
         
         body = common.prepare_body(config, inverter_data)
         headers = common.prepare_post_header(config, body, common.CONTROL_ENDPOINT)
         headers['token'] = config['login_token']
-        with make_request(session.post, config['api_url']+common.CONTROL_ENDPOINT, data = body, headers = headers) as response:
+        with make_request(session.post, config['api_url']+common.CONTROL_ENDPOINT, data = body, headers = headers, config = config) as response:
             status = response.status_code
             if status == HTTPStatus.OK:
                 result = response.json()
                 if result.get('code') == '0': 
                     set_times_msg = 'OK'
+                    common.count_write()
                 else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
                     set_times_msg = 'Payload error setting charging/discharging times: %s' % (str(result))
             else:
+                common.record_error(config, status, msg=response.text)
                 set_times_msg = 'HTTP error setting charging/discharging times: %d %s' % (status, response.text)
     except RequestException as e:
+        common.record_error(config, exception=e)
         set_times_msg = 'Request exception setting charging/discharging times: ' + str(e)
     return set_times_msg
     
@@ -191,17 +337,21 @@ def set_inverter_data(config, session, inverter_data=None, verbose=False):
         body = common.prepare_body(config, inverter_data)
         headers = common.prepare_post_header(config, body, common.CONTROL_ENDPOINT)
         headers['token'] = config['login_token']
-        with make_request(session.post, config['api_url']+common.CONTROL_ENDPOINT, data = body, headers = headers) as response:
+        with make_request(session.post, config['api_url']+common.CONTROL_ENDPOINT, data = body, headers = headers, config = config) as response:
             status = response.status_code
             if status == HTTPStatus.OK:
                 result = response.json()
                 if result.get('code') == '0': 
                     set_times_msg = 'OK'
+                    common.count_write()
                 else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
                     set_times_msg = 'Payload error setting charging/discharging times: %s' % (str(result))
             else:
+                common.record_error(config, status, msg=response.text)
                 set_times_msg = 'HTTP error setting charging/discharging times: %d %s' % (status, response.text)
     except RequestException as e:
+        common.record_error(config, exception=e)
         set_times_msg = 'Request exception setting charging/discharging times: ' + str(e)
     return set_times_msg
     
@@ -215,17 +365,20 @@ def get_inverter_data(config, session, verbose=False):
         config['api_url'] = common.DEFAULT_API_URL
     inverter_data = None                    
     try:
-        with make_request(session.post, config['api_url']+common.READ_ENDPOINT, data = body, headers = headers) as response:
+        with make_request(session.post, config['api_url']+common.READ_ENDPOINT, data = body, headers = headers, config = config) as response:
             status = response.status_code
             if status == HTTPStatus.OK:
                 result = response.json()
                 if result.get('code') == '0'  and result.get('data') and result['data'].get('msg'): 
                     inverter_data = result['data']['msg']
                 else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
                     log.warning('Payload error getting charging/discharging times: %s' % (str(result)))
             else:
+                common.record_error(config, status, msg=response.text)
                 log.warning('HTTP error getting charging/discharging times: %d %s' % (status, response.text))
     except RequestException as e:
+        common.record_error(config, exception=e)
         log.warning('Request exception getting charging/discharging times: ' + str(e))
     if verbose: 
         print ('Inverter data read :', inverter_data)
@@ -236,14 +389,13 @@ def get_inverter_data(config, session, verbose=False):
 def get_inverter_datetime(config, session):
     if not config.get('login_token'):
         raise common.SolisControlException('Not logged in')
-    body = '{"inverterId":"'+config['inverter_id']+'","cid":"56"}'
-    headers = common.prepare_post_header(config, body, common.READ_ENDPOINT)
+    body, headers = common.prepare_request(config, common.READ_ENDPOINT, config['inverter_id'], '56')
     headers['token']= config['login_token']
     if not config.get('api_url'):
         config['api_url'] = common.DEFAULT_API_URL
     inverter_datetime = None                    
     try:
-        with make_request(session.post, config['api_url']+common.READ_ENDPOINT, data = body, headers = headers) as response:
+        with make_request(session.post, config['api_url']+common.READ_ENDPOINT, data = body, headers = headers, config = config) as response:
             status = response.status_code
             if status == HTTPStatus.OK:
                 result = response.json()
@@ -252,10 +404,13 @@ def get_inverter_datetime(config, session):
                     config['inverter_datetime'] = inverter_datetime
                     config['host_datetime'] = datetime.now()
                 else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
                     log.warning('Payload error getting inverter time: %s' % (str(result)))
             else:
+                common.record_error(config, status, msg=response.text)
                 log.warning('HTTP error getting inverter time: %d %s' % (status, response.text))
     except RequestException as e:
+        common.record_error(config, exception=e)
         log.warning('Request exception getting inverter time: ' + str(e))
     if not inverter_datetime:
         return None
@@ -277,41 +432,245 @@ def set_inverter_datetime(config, session, inverter_datetime=None):
             raise SolisControlException('Bad inverter datetime -> %s' % str(inverter_datetime))
     try:
         value = inverter_datetime.strftime('%Y-%m-%d %H:%M:%S')
-        body = '{"inverterId":"'+config['inverter_id']+'","cid":"56","value":"'+value+'"}'
-        headers = common.prepare_post_header(config, body, common.CONTROL_ENDPOINT)
+        body, headers = common.prepare_request(config, common.CONTROL_ENDPOINT, config['inverter_id'], '56', value)
         headers['token'] = config['login_token']
-        with make_request(session.post, config['api_url']+common.CONTROL_ENDPOINT, data = body, headers = headers) as response:
+        with make_request(session.post, config['api_url']+common.CONTROL_ENDPOINT, data = body, headers = headers, config = config) as response:
             status = response.status_code
             if status == HTTPStatus.OK:
                 result = response.json()
                 if result.get('code') == '0': 
                     set_time_msg = 'OK'
                 else:
+                    common.record_error(config, status, result.get('code'), result.get('msg'))
                     set_time_msg = 'Payload error setting inverter time: %s' % (str(result))
             else:
+                common.record_error(config, status, msg=response.text)
                 set_time_msg = 'HTTP error setting inverter time: %d %s' % (status, response.text)
     except RequestException as e:
+        common.record_error(config, exception=e)
         set_time_msg = 'Request exception setting inverter time: ' + str(e)
     return set_time_msg
        
 def connect(config, session):
+    # the inverter list lookup is skipped if the entry is already known (eg from a paged list - see solis_fleet.run_account)
     try:
-        if not get_inverter_entry(config, session):
+        if config.get('inverter_id') and config.get('inverter_sn'):
+            if not config.get('api_url'):
+                config['api_url'] = common.DEFAULT_API_URL
+        elif not get_inverter_entry(config, session):
             return False
         if not get_inverter_detail(config, session):
             return False
         if not get_login_detail(config, session):
             return False
-        get_inverter_datetime(config, session)
-        check = common.check_time(config) # default acceptable time difference = 1 min
-        if check != 'OK':
-            check = set_inverter_datetime(config, session)
-        if check != 'OK':
+        if sync_time(config, session) != 'OK':
             return False
         return True
     except common.SolisControlException as e:
         log.warning('Cannot connect to inverter: %s', str(e))
         return False
+        
+CONNECT_STAGES = ( # (name, function, names of stages it depends on) in dependency order
+    ('entry', get_inverter_entry, ()),
+    ('login', get_login_detail, ()), # does not need the inverter list so overlaps it
+    ('detail', get_inverter_detail, ('entry',)),
+    ('datetime', get_inverter_datetime, ('entry', 'login')),
+)
+STAGE_RETRY_KINDS = ( 'timeout', 'connection', 'rate', 'server', 'busy' ) # error kinds worth calling a failed stage again for
+STAGE_ATTEMPTS = 3 # maximum calls of each connect_parallel() stage including the first
+STAGE_RETRY_DELAY = 1.0 # seconds before the first retry of a stage, doubled for each later one
+    
+def connect_parallel(config, session, stages=CONNECT_STAGES):
+    # connect() with independent calls overlapped on a thread pool - login runs alongside the inverter list
+    # and then the inverter detail and time reads run together (each stage only waits for those it depends on)
+    # returns (connected, timings) where timings has the seconds taken by each stage and the 'total'
+    # note under pyscript the stages are run in sequence as pyscript functions cannot run in a thread pool
+    # a stage failing with a transient error (eg B0115 or a timeout) is called again up to STAGE_ATTEMPTS times
+    # within any deadline - each stage works on its own copy of config so that stages running at the same time
+    # do not see each other's 'last_error', the copy is merged back when the stage ends
+    started = time.perf_counter()
+    timings = {}
+    
+    def call_stage(name, func):
+        before = dict(config)
+        stage_config = dict(before)
+        result = None
+        for attempt in range(STAGE_ATTEMPTS):
+            stage_config.pop('last_error', None)
+            try:
+                result = func(stage_config, session)
+            except common.SolisControlException as e:
+                log.warning('Cannot connect to inverter: %s', str(e))
+                break
+            kind = common.last_error_kind(stage_config)
+            if result or kind not in STAGE_RETRY_KINDS or attempt + 1 >= STAGE_ATTEMPTS:
+                break
+            delay = STAGE_RETRY_DELAY * (2 ** attempt)
+            left = common.remaining_time(stage_config)
+            if left is not None and left < delay + common.MIN_TIMEOUT:
+                break
+            log.info('Connect stage %s failed (%s: %s) - retry %d in %.1fs' % (name, kind, stage_config['last_error']['msg'], attempt + 1, delay))
+            sleep(delay)
+        config.update({ k: v for k, v in stage_config.items() if k not in before or before[k] is not v }) # only what this stage set
+        return result
+    
+    def run_stage(name, func, depends, futures):
+        for d in depends:
+            if not futures[d].result():
+                return False
+        stage_started = time.perf_counter()
+        result = call_stage(name, func)
+        timings[name] = time.perf_counter() - stage_started
+        return bool(result)
+    
+    if PYSCRIPT:
+        ok = True
+        for name, func, depends in stages:
+            ok = ok and run_stage(name, func, (), {})
+    else:
+        futures = {}
+        with ThreadPoolExecutor(max_workers=len(stages)) as executor: # one thread per stage so waiting stages cannot block others
+            for name, func, depends in stages:
+                futures[name] = executor.submit(run_stage, name, func, depends, futures)
+            ok = all(f.result() for f in futures.values())
+    if ok:
+        check = common.check_time(config) # default acceptable time difference = 1 min
+        if check != 'OK':
+            stage_started = time.perf_counter()
+            check = set_inverter_datetime(config, session)
+            if check == 'OK':
+                get_inverter_datetime(config, session) # so later time checks see the corrected time
+            timings['set_datetime'] = time.perf_counter() - stage_started
+        ok = check == 'OK'
+    timings['total'] = time.perf_counter() - started
+    return ok, timings
+    
+def open_connection(config, session=None):
+    # long lived connection handle (a dict) which keeps the session, the connection state in its own copy of config
+    # and the login token expiry so that repeated actions do not each need a full connect()
+    # note 'token_ttl' (seconds), 'time_check_ttl' (seconds between inverter clock checks) and 'connection_ttl'
+    # (seconds before a full reconnect) can be set in the config
+    # 'lock' is held by ensure_connected(), refresh_soc(), connection_call() (and solis_bundle) so that overlapping
+    # actions do not share the session and config at the same time - see lock_connection()
+    return {
+        'config': dict(config),
+        'session': session if session is not None else get_session(),
+        'lock': { 'guard': threading.Lock(), 'owner': None, 'depth': 0 },
+        'connected': None, # time of last full connect
+        'token': None,
+        'token_expiry': None,
+        'time_checked': None, # time of last inverter clock check
+        'detail_time': None, # time of last inverter detail (SOC) read
+    }
+    
+def lock_owner():
+    # who is asking for a lock - the task under Pyscript (where every task runs on the event loop thread) otherwise the thread
+    return task.current_task() if PYSCRIPT else threading.get_ident()
+    
+def lock_connection(conn):
+    # take the handle lock, waiting (by polling so the Pyscript event loop is not blocked) while another owner has it
+    # the same owner can take it again (eg connection_call() calls ensure_connected()) - release with unlock_connection()
+    lock = conn['lock']
+    owner = lock_owner()
+    while True:
+        with lock['guard']:
+            if lock['owner'] is None or lock['owner'] == owner:
+                lock['owner'] = owner
+                lock['depth'] += 1
+                return
+        sleep(LOCK_POLL)
+    
+def unlock_connection(conn):
+    lock = conn['lock']
+    with lock['guard']:
+        lock['depth'] -= 1
+        if lock['depth'] <= 0:
+            lock['owner'] = None
+            lock['depth'] = 0
+    
+def sync_time(config, session):
+    # check the inverter clock and correct it if it is out by more than a minute - returns 'OK' or an error message
+    get_inverter_datetime(config, session)
+    check = common.check_time(config) # default acceptable time difference = 1 min
+    if check != 'OK':
+        check = set_inverter_datetime(config, session)
+        if check == 'OK':
+            get_inverter_datetime(config, session) # so later time checks see the corrected time
+    return check
+    
+def ensure_connected(conn):
+    # make sure the handle is connected and logged in and the inverter clock has been checked recently
+    # only does the calls which are needed
+    lock_connection(conn)
+    try:
+        config = conn['config']
+        now = time.time()
+        if not conn['connected'] or now - conn['connected'] > config.get('connection_ttl', CONNECTION_TTL):
+            for k in ('inverter_id', 'login_token', 'inverter_datetime'):
+                config.pop(k, None)
+            if not connect(config, conn['session']):
+                conn['connected'] = None
+                return False
+            conn['connected'] = conn['detail_time'] = conn['time_checked'] = now
+            conn['token'] = None
+        token = config.get('login_token')
+        if token and token != conn['token']: # new token from connect() or elsewhere (eg solis_retry)
+            conn['token'] = token
+            conn['token_expiry'] = now + config.get('token_ttl', TOKEN_TTL)
+        elif not token or now >= conn['token_expiry']:
+            config.pop('login_token', None)
+            if not get_login_detail(config, conn['session']):
+                return False
+            conn['token'] = config['login_token']
+            conn['token_expiry'] = now + config.get('token_ttl', TOKEN_TTL)
+        if now - conn['time_checked'] > config.get('time_check_ttl', TIME_CHECK_TTL):
+            if sync_time(config, conn['session']) != 'OK':
+                return False
+            conn['time_checked'] = now
+        return True
+    finally:
+        unlock_connection(conn)
+    
+def refresh_soc(conn, max_age=0.0):
+    # re-read the inverter detail (battery SOC, power etc) if it is older than max_age seconds
+    # (not if ensure_connected() has just done a full connect as that reads the detail)
+    lock_connection(conn)
+    try:
+        connected = conn['connected']
+        if not ensure_connected(conn):
+            return False
+        if conn['connected'] != connected or (conn['detail_time'] and time.time() - conn['detail_time'] <= max_age):
+            return True
+        if not get_inverter_detail(conn['config'], conn['session']):
+            return False
+        conn['detail_time'] = time.time()
+        return True
+    finally:
+        unlock_connection(conn)
+    
+def connection_call(conn, func, *args, **kwargs):
+    # call func(config, session, *args, **kwargs) on the handle's connection
+    # if it fails because the token has expired, log in again and try once more
+    # returns None if not connected
+    lock_connection(conn)
+    try:
+        if not ensure_connected(conn):
+            return None
+        config = conn['config']
+        config.pop('last_error', None)
+        result = func(config, conn['session'], *args, **kwargs)
+        if config.get('last_error') and config['last_error']['kind'] == 'token':
+            config.pop('login_token', None)
+            if ensure_connected(conn):
+                config.pop('last_error', None)
+                result = func(config, conn['session'], *args, **kwargs)
+        return result
+    finally:
+        unlock_connection(conn)
+    
+def close_connection(conn):
+    conn['session'].close()
+    conn['connected'] = None
                 
 
         
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+import json
+import hmac
+import hashlib
+import base64
+import random
+import math
+import threading
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import solis_common as common
+except ImportError:
+    from soliscontrol import solis_common as common
+
+""" Local stand-in for the SolisCloud API for offline load testing of the client modules
+
+Implements the endpoints used by solis_control_req_mod and solis_control_async_mod
+(inverterList, inverterDetailList, inverterDetail, inverterDay, inverterMonth, login, atRead and control
+with cids 103 and 56) for a number of virtual inverters whose battery SOC evolves according to their charge/discharge schedule
+
+Every request has its Content-MD5 and Authorization headers checked exactly as they are produced
+by common.prepare_post_header() and the v2 endpoints also require the token from login
+
+Faults can be injected: latency (seconds per request), rate limiting (requests per second
+per API key and endpoint, HTTP 429 when exceeded), B0115 payload errors (a fraction of
+atRead/control requests) and login responses with the trailing commas that common.json_strip()
+works around (as sent by the real API)
+
+Run from the command line (see below) or in-process with start_server() - point the clients
+at it by setting 'api_url' in the config - see station_configs()"""
+
+DEFAULT_KEY_ID = '1300000000000000001'
+DEFAULT_KEY_SECRET = 'fakesecretfakesecretfakesecret00'
+DEFAULT_USER_NAME = 'fake@example.com'
+DEFAULT_PASSWORD = 'fakepassword'
+DEFAULT_PORT = 13333
+DATE_LEEWAY = 900 # seconds allowed between the Date header and server time
+FIRST_STATION_ID = 1298491919448600000
+
+def sign(key_secret, content_md5, content_type, date, resource):
+    # HMAC-SHA1 signature as in common.prepare_post_header()
+    encrypt_str = 'POST\n' + content_md5 + '\n' + content_type + '\n' + date + '\n' + resource
+    return base64.b64encode(hmac.new(key_secret.encode('utf-8'), msg=encrypt_str.encode('utf-8'), digestmod=hashlib.sha1).digest()).decode('utf-8')
+
+class FakeSolisCloud:
+    # server state and request handling - independent of the HTTP layer so it can also be called directly
+    # note handle() is thread safe
+
+    def __init__(self, inverters=10, key_id=DEFAULT_KEY_ID, key_secret=DEFAULT_KEY_SECRET, user_name=DEFAULT_USER_NAME,
+            password=DEFAULT_PASSWORD, latency=0.0, rate_limit=0, b0115_rate=0.0, trailing_commas=True,
+            clock_skew=0.0, time_scale=1.0, seed=None):
+        # rate_limit is the maximum requests per second for each API key and endpoint (0 = no limit)
+        # b0115_rate is the fraction of atRead/control requests which fail with a B0115 payload error
+        # clock_skew is the initial offset (minutes) of the inverter clocks from the host
+        # time_scale is the number of simulated seconds of battery charge/discharge per real second
+        self.key_id = key_id
+        self.key_secret = key_secret
+        self.user_name = user_name
+        self.password = password
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.b0115_rate = b0115_rate
+        self.trailing_commas = trailing_commas
+        self.time_scale = time_scale
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.windows = {} # (key id, endpoint) -> [ second, count ] for rate limiting
+        self.stats = { 'requests': 0, 'rejected': 0, 'rate_limited': 0, 'b0115': 0, 'writes': 0 }
+        self.inverters = {} # by inverter id
+        self.stations = {} # station id -> inverter id
+        for i in range(inverters):
+            station_id = str(FIRST_STATION_ID + i)
+            inverter_id = str(1308675217947000000 + i)
+            self.inverters[inverter_id] = {
+                'id': inverter_id,
+                'sn': '%016X' % (0x6031050000000000 + i),
+                'stationId': station_id,
+                'stationName': 'Fake Station %d' % (i + 1),
+                'batteryType': 'Pylon_HV',
+                'capacity': 7.1, # kWh
+                'soc': float(self.random.randint(20, 95)),
+                'ods': 20,
+                'power': 3.6,
+                'eToday': 0.0,
+                'inverter_data': common.DEFAULT_INVERTER_DATA,
+                'clock_offset': timedelta(minutes=clock_skew),
+                'updated': time.monotonic(),
+            }
+            self.stations[station_id] = inverter_id
+
+    def inverter_time(self, inverter):
+        return datetime.now() + inverter['clock_offset']
+
+    def evolve(self, inverter):
+        # move the battery SOC on according to the active charge/discharge slot at the inverter time
+        now = time.monotonic()
+        hours = (now - inverter['updated']) * self.time_scale / 3600.0
+        inverter['updated'] = now
+        inv_time = self.inverter_time(inverter)
+        minute = inv_time.hour * 60 + inv_time.minute
+        schedule = common.InverterSchedule.parse(inverter['inverter_data'])
+        amps = 0.0
+        for charge, timeslot, start, end in schedule.active_slots():
+            if (start <= minute < end) if start < end else (minute >= start or minute < end):
+                slot_amps = schedule.get_slot(charge, timeslot)[2]
+                amps = slot_amps if charge else -slot_amps
+                break
+        if amps == 0.0: # house load drawn from the battery
+            amps = -self.random.uniform(0.0, 5.0)
+        kwh = amps * common.ENERGY_AMP_HOUR * hours
+        soc = inverter['soc'] + kwh / inverter['capacity'] * 100.0
+        inverter['soc'] = min(max(soc, inverter['ods']), 100.0)
+        if amps > 0.0:
+            inverter['eToday'] += kwh
+        inverter['battery_power'] = amps * common.ENERGY_AMP_HOUR # kW
+
+    def check_rate(self, endpoint):
+        # True if the request is within the rate limit for the endpoint
+        if not self.rate_limit:
+            return True
+        second = int(time.monotonic())
+        window = self.windows.setdefault((self.key_id, endpoint), [ second, 0 ])
+        if window[0] != second:
+            window[0] = second
+            window[1] = 0
+        window[1] += 1
+        return window[1] <= self.rate_limit
+
+    def check_signature(self, path, headers, body):
+        # error message if the Content-MD5, Date or Authorization headers do not match the request, otherwise None
+        content_md5 = headers.get('Content-MD5', '')
+        if content_md5 != common.digest(body):
+            return 'Content-MD5 does not match body'
+        date = headers.get('Date', '')
+        try:
+            sent = parsedate_to_datetime(date)
+        except (TypeError, ValueError):
+            return 'Bad Date header -> %s' % date
+        if abs((datetime.now(timezone.utc) - sent).total_seconds()) > DATE_LEEWAY:
+            return 'Date header out of range -> %s' % date
+        expected = 'API ' + self.key_id + ':' + sign(self.key_secret, content_md5, headers.get('Content-Type', ''), date, path)
+        if headers.get('Authorization', '') != expected:
+            return 'Authorization signature does not match'
+        return None
+
+    def handle(self, path, headers, body):
+        # process one POST request, returns (HTTP status, response text)
+        with self.lock:
+            self.stats['requests'] += 1
+            if not self.check_rate(path):
+                self.stats['rate_limited'] += 1
+                return HTTPStatus.TOO_MANY_REQUESTS, '{"success":false,"code":"429","msg":"Too many requests"}'
+            error = self.check_signature(path, headers, body)
+            if error:
+                self.stats['rejected'] += 1
+                return HTTPStatus.FORBIDDEN, json.dumps({ 'success': False, 'code': '403', 'msg': error })
+            try:
+                request = json.loads(body) if body else {}
+            except ValueError:
+                return HTTPStatus.BAD_REQUEST, json.dumps({ 'success': False, 'code': '400', 'msg': 'Bad JSON body' })
+            if path == common.INVERTER_ENDPOINT:
+                return self.inverter_list(request)
+            elif path == common.DETAIL_ENDPOINT:
+                return self.inverter_detail(request)
+            elif path == common.DETAIL_LIST_ENDPOINT:
+                return self.inverter_detail_list(request)
+            elif path in (common.DAY_ENDPOINT, common.MONTH_ENDPOINT):
+                inverter = self.inverters.get(request.get('id'))
+                if not inverter:
+                    return HTTPStatus.OK, json.dumps({ 'success': False, 'code': 'R0000', 'msg': 'Inverter not found' })
+                if path == common.DAY_ENDPOINT:
+                    return self.inverter_day(inverter, request)
+                return self.inverter_month(inverter, request)
+            elif path == common.LOGIN_ENDPOINT:
+                return self.login(request)
+            elif path in (common.READ_ENDPOINT, common.CONTROL_ENDPOINT):
+                if headers.get('token') not in self.tokens:
+                    return HTTPStatus.OK, json.dumps({ 'code': 'Z0001', 'msg': 'Token invalid or expired' })
+                inverter = self.inverters.get(request.get('inverterId'))
+                if not inverter:
+                    return HTTPStatus.OK, json.dumps({ 'code': 'R0000', 'msg': 'Inverter not found' })
+                if self.b0115_rate and self.random.random() < self.b0115_rate:
+                    self.stats['b0115'] += 1
+                    return HTTPStatus.OK, json.dumps({ 'code': 'B0115', 'msg': 'Device busy, please try again later' })
+                if path == common.READ_ENDPOINT:
+                    return self.at_read(inverter, request)
+                return self.control(inverter, request)
+            return HTTPStatus.NOT_FOUND, json.dumps({ 'success': False, 'code': '404', 'msg': 'Unknown endpoint' })
+
+    def inverter_list(self, request):
+        records = []
+        for inverter in self.inverters.values():
+            if request.get('stationId') and inverter['stationId'] != request['stationId']:
+                continue
+            records.append({ 'id': inverter['id'], 'sn': inverter['sn'], 'stationId': inverter['stationId'], 'stationName': inverter['stationName'] })
+        page_no = int(request.get('pageNo', 1))
+        page_size = int(request.get('pageSize', 20))
+        page = records[(page_no - 1) * page_size:page_no * page_size]
+        data = { 'page': { 'current': page_no, 'size': page_size, 'total': len(records), 'pages': (len(records) + page_size - 1) // page_size, 'records': page } }
+        return HTTPStatus.OK, json.dumps({ 'success': True, 'code': '0', 'msg': 'success', 'data': data })
+
+    def inverter_detail(self, request):
+        inverter = self.inverters.get(request.get('id'))
+        if not inverter or (request.get('sn') and request['sn'] != inverter['sn']):
+            return HTTPStatus.OK, json.dumps({ 'success': False, 'code': 'R0000', 'msg': 'Inverter not found' })
+        return HTTPStatus.OK, json.dumps({ 'success': True, 'code': '0', 'msg': 'success', 'data': self.detail_record(inverter) })
+
+    def inverter_detail_list(self, request):
+        inverters = list(self.inverters.values())
+        page_no = int(request.get('pageNo', 1))
+        page_size = int(request.get('pageSize', 20))
+        page = [ self.detail_record(inverter) for inverter in inverters[(page_no - 1) * page_size:page_no * page_size] ]
+        data = { 'page': { 'current': page_no, 'size': page_size, 'total': len(inverters), 'pages': (len(inverters) + page_size - 1) // page_size, 'records': page } }
+        return HTTPStatus.OK, json.dumps({ 'success': True, 'code': '0', 'msg': 'success', 'data': data })
+
+    def detail_record(self, inverter):
+        self.evolve(inverter)
+        return {
+            'id': inverter['id'],
+            'sn': inverter['sn'],
+            'stationId': inverter['stationId'],
+            'stationName': inverter['stationName'],
+            'batteryType': inverter['batteryType'],
+            'batteryCapacitySoc': round(inverter['soc'], 1),
+            'socDischargeSet': inverter['ods'],
+            'power': inverter['power'],
+            'eToday': round(inverter['eToday'], 2),
+            'batteryPower': round(inverter.get('battery_power', 0.0), 3),
+            'dataTimestamp': str(int(time.time() * 1000)),
+        }
+
+    def day_records(self, inverter, day, tz_hours):
+        # synthetic 5 minute history for a past day (up to now for today) - the same every time it is asked for
+        rand = random.Random('%s %s' % (inverter['sn'], day))
+        midnight = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc) - timedelta(hours=tz_hours)
+        now = datetime.now(timezone.utc)
+        soc = rand.uniform(20.0, 60.0)
+        imported = exported = 0.0
+        records = []
+        for i in range(288):
+            stamp = midnight + timedelta(minutes=5 * i, seconds=rand.randint(0, 59))
+            if stamp > now:
+                break
+            hour = i / 12.0
+            pv = max(0.0, math.sin((hour - 6.0) * math.pi / 12.0)) * rand.uniform(1.0, 3.5) # kW
+            load = rand.uniform(0.2, 1.5)
+            current = 40.0 if 2.0 <= hour < 5.0 else max(-25.0, min(25.0, (pv - load) * 20.0)) # A (+ve charging)
+            if (current > 0.0 and soc >= 100.0) or (current < 0.0 and soc <= inverter['ods']):
+                current = 0.0
+            battery = current * 0.05 # kW at about 50V
+            grid = load + battery - pv # kW (+ve importing)
+            soc = min(100.0, max(float(inverter['ods']), soc + battery / 12.0 / inverter['capacity'] * 100.0))
+            imported += max(grid, 0.0) / 12.0
+            exported += max(-grid, 0.0) / 12.0
+            records.append({ 'dataTimestamp': str(int(stamp.timestamp() * 1000)), 'timeStr': (stamp + timedelta(hours=tz_hours)).strftime('%Y-%m-%d %H:%M:%S'),
+                'batteryCapacitySoc': round(soc, 1), 'batteryPower': round(battery, 3), 'bstteryCurrent': round(current, 1),
+                'pSum': round(grid, 3), 'familyLoadPower': round(load, 3), 'pac': round((pv - battery) * 1000.0, 0), 'pacStr': 'W',
+                'dcPac': round(pv * 1000.0, 0), 'dcPacStr': 'W', 'gridPurchasedTodayEnergy': round(imported, 2), 'gridSellTodayEnergy': round(exported, 2) })
+        return records
+
+    def inverter_day(self, inverter, request):
+        try:
+            records = self.day_records(inverter, request.get('time', ''), float(request.get('timeZone', 0)))
+        except ValueError:
+            return HTTPStatus.OK, json.dumps({ 'success': False, 'code': 'B0001', 'msg': 'Bad time %s' % request.get('time') })
+        return HTTPStatus.OK, json.dumps({ 'success': True, 'code': '0', 'msg': 'success', 'data': records })
+
+    def inverter_month(self, inverter, request):
+        # daily totals from the synthetic 5 minute history
+        try:
+            first = datetime.strptime(request.get('month', '') + '-01', '%Y-%m-%d')
+        except ValueError:
+            return HTTPStatus.OK, json.dumps({ 'success': False, 'code': 'B0001', 'msg': 'Bad month %s' % request.get('month') })
+        tz_hours = float(request.get('timeZone', 0))
+        records = []
+        day = first
+        while day.month == first.month:
+            day_records = self.day_records(inverter, day.strftime('%Y-%m-%d'), tz_hours)
+            if not day_records:
+                break
+            stamp = day.replace(tzinfo=timezone.utc) - timedelta(hours=tz_hours)
+            records.append({ 'date': int(stamp.timestamp() * 1000), 'dateStr': day.strftime('%Y-%m-%d'),
+                'energy': round(sum(r['dcPac'] for r in day_records) / 12000.0, 2), 'energyStr': 'kWh',
+                'batteryChargeEnergy': round(sum(max(r['batteryPower'], 0.0) for r in day_records) / 12.0, 2),
+                'batteryDischargeEnergy': round(sum(max(-r['batteryPower'], 0.0) for r in day_records) / 12.0, 2),
+                'gridPurchasedEnergy': day_records[-1]['gridPurchasedTodayEnergy'], 'gridSellEnergy': day_records[-1]['gridSellTodayEnergy'],
+                'homeLoadEnergy': round(sum(r['familyLoadPower'] for r in day_records) / 12.0, 2) })
+            day += timedelta(days=1)
+        return HTTPStatus.OK, json.dumps({ 'success': True, 'code': '0', 'msg': 'success', 'data': records })
+
+    def login(self, request):
+        if request.get('userInfo') != self.user_name or request.get('passWord') != common.password_encode(self.password):
+            return HTTPStatus.OK, '{"success":false,"code":"Z0002","msg":"Incorrect user name or password"}'
+        token = 'token_%016x' % self.random.getrandbits(64)
+        self.tokens.add(token)
+        if self.trailing_commas: # as sent by the real API
+            return HTTPStatus.OK, '{"success":true,"code":"0","msg":"success","data":{"token":"%s","uid":"1",},}' % token
+        return HTTPStatus.OK, json.dumps({ 'success': True, 'code': '0', 'msg': 'success', 'data': { 'token': token, 'uid': '1' } })
+
+    def at_read(self, inverter, request):
+        cid = str(request.get('cid'))
+        if cid == '103':
+            msg = inverter['inverter_data']
+        elif cid == '56':
+            msg = self.inverter_time(inverter).strftime('%Y-%m-%d %H:%M:%S')
+        else:
+            return HTTPStatus.OK, json.dumps({ 'code': 'B0001', 'msg': 'Unsupported cid %s' % cid })
+        return HTTPStatus.OK, json.dumps({ 'code': '0', 'msg': 'success', 'data': { 'msg': msg } })
+
+    def control(self, inverter, request):
+        cid = str(request.get('cid'))
+        value = request.get('value')
+        if value is None:
+            return HTTPStatus.OK, json.dumps({ 'code': 'B0001', 'msg': 'No value' })
+        if cid == '103':
+            try:
+                schedule = common.InverterSchedule.parse(value)
+            except common.SolisControlException as e:
+                return HTTPStatus.OK, json.dumps({ 'code': 'B0001', 'msg': str(e) })
+            self.evolve(inverter) # bring the SOC up to date with the old schedule first
+            inverter['inverter_data'] = schedule.to_string()
+        elif cid == '56':
+            try:
+                inverter['clock_offset'] = datetime.fromisoformat(value) - datetime.now()
+            except ValueError:
+                return HTTPStatus.OK, json.dumps({ 'code': 'B0001', 'msg': 'Bad time value %s' % value })
+        else:
+            return HTTPStatus.OK, json.dumps({ 'code': 'B0001', 'msg': 'Unsupported cid %s' % cid })
+        self.stats['writes'] += 1
+        return HTTPStatus.OK, json.dumps({ 'code': '0', 'msg': 'success', 'data': [ { 'code': '0', 'msg': value } ] })
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    # HTTP layer - the FakeSolisCloud instance is the 'cloud' attribute of the server
+
+    protocol_version = 'HTTP/1.1' # keep alive
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        cloud = self.server.cloud
+        if cloud.latency:
+            time.sleep(cloud.latency)
+        status, text = cloud.handle(self.path, self.headers, body)
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # quiet
+        pass
+
+def start_server(cloud, host='127.0.0.1', port=0):
+    # run a server for the cloud in a background thread, returns (server, api_url) - stop with server.shutdown()
+    # port 0 picks a free port
+    server = ThreadingHTTPServer((host, port), FakeRequestHandler)
+    server.daemon_threads = True
+    server.cloud = cloud
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://%s:%d' % server.server_address[:2]
+
+def station_configs(cloud, api_url, base=None):
+    # list of client config dicts, one for each virtual station - base is copied into each (eg main.yaml settings)
+    configs = []
+    for inverter in cloud.inverters.values():
+        config = dict(base or {})
+        config.setdefault('battery_capacity', inverter['capacity'])
+        config.setdefault('battery_max_current', 74)
+        config.setdefault('inverter_max_current', 62.5)
+        config.update({
+            'api_url': api_url,
+            'solis_key_id': cloud.key_id,
+            'solis_key_secret': cloud.key_secret,
+            'solis_user_name': cloud.user_name,
+            'solis_password': cloud.password,
+            'solis_station_id': inverter['stationId'],
+        })
+        configs.append(config)
+    return configs
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run a local stand-in SolisCloud API server for load testing',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", "--inverters", help="number of virtual inverters", type=int, default=10)
+    parser.add_argument("-p", "--port", help="port to listen on", type=int, default=DEFAULT_PORT)
+    parser.add_argument("-l", "--latency", help="delay added to each request (seconds)", type=float, default=0.0)
+    parser.add_argument("-r", "--rate", help="maximum requests per second per endpoint (0 = no limit)", type=int, default=0)
+    parser.add_argument("-b", "--b0115", help="fraction of atRead/control requests which fail with B0115", type=float, default=0.0)
+    parser.add_argument("-s", "--skew", help="initial inverter clock offset (minutes)", type=float, default=0.0)
+    parser.add_argument("-x", "--scale", help="simulated seconds of battery charge/discharge per real second", type=float, default=1.0)
+    parser.add_argument("--no-commas", help="send login responses without trailing commas", action='store_true')
+    args = parser.parse_args()
+
+    cloud = FakeSolisCloud(args.inverters, latency=args.latency, rate_limit=args.rate, b0115_rate=args.b0115,
+        trailing_commas=not args.no_commas, clock_skew=args.skew, time_scale=args.scale)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), FakeRequestHandler)
+    server.daemon_threads = True
+    server.cloud = cloud
+    print ('Fake SolisCloud API on http://127.0.0.1:%d' % args.port)
+    print ('solis_key_id: "%s"\nsolis_key_secret: "%s"\nsolis_user_name: "%s"\nsolis_password: "%s"' % (cloud.key_id, cloud.key_secret, cloud.user_name, cloud.password))
+    print ('Station ids:', ' '.join(i['stationId'] for i in cloud.inverters.values()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print (cloud.stats)
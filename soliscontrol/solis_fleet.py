@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+import asyncio
+import logging
+import time
+import yaml
+import argparse
+
+try:
+    import solis_control_async_mod as solis_control
+    import solis_common as common
+    import solis_limiter as limiter
+except ImportError:
+    from soliscontrol import solis_control_async_mod as solis_control
+    from soliscontrol import solis_common as common
+    from soliscontrol import solis_limiter as limiter
+
+""" Fleet controller which plans and sets charge/discharge times for many stations concurrently
+Each station runs a connect -> read -> plan -> write pipeline on a shared aiohttp session
+with the number of stations in progress at any one time bounded by 'concurrency'
+
+The fleet is defined in a YAML file (default 'fleet.yaml') with optional 'defaults' which apply to every station
+and a list of 'stations' each with at least a 'solis_station_id' - for example:
+
+defaults:
+  battery_capacity: 7.1
+  battery_max_current: 74
+  inverter_max_current: 62.5
+  charge_period:
+    start: "02:01"
+    end: "04:59"
+    current: 50
+    kwh_requirement: 5.0 # target energy after charging (kWh)
+stations:
+  - solis_station_id: "xxxx"
+  - solis_station_id: "yyyy"
+    charge_period:
+      start: "02:01"
+      end: "04:59"
+      current: 40
+      minutes: 60 # fixed duration (overrides kwh_requirement)
+
+With --account every station in the API account is found from the paged inverter list (so 'stations' is not needed)
+and each station starts as soon as it is found rather than after the whole list has been read
+
+API credentials are taken from 'secrets.yaml' (as in solis_run.py) unless set in the fleet file"""
+
+DEFAULT_CONCURRENCY = 50
+
+log = logging.getLogger(__name__)
+
+def plan_station(config):
+    # work out (params, charge, timeslot) edits for each configured period of a connected station
+    # a period with 'minutes' is set to that fixed duration, one with 'kwh_requirement' is timed to reach that target energy
+    edits = []
+    for p in common.extract_periods(config):
+        config_period = config[p['name']]
+        if config_period.get('minutes') is not None:
+            start, end = common.start_end_from_minutes(config_period, int(config_period['minutes']))
+        elif config_period.get('kwh_requirement') is not None:
+            required = float(config_period['kwh_requirement'])
+            if required < 0.0: # negative means no action is taken (preserves existing settings)
+                continue
+            unavailable_energy, full_energy, current_energy, real_soc = common.energy_values(config)
+            eah = common.period_eah(config, p['charge'], config_period['current'])
+            if p['charge']:
+                start, end, energy_after = common.charge_times(config_period, full_energy, current_energy, required, eah)
+            else:
+                start, end, energy_after = common.discharge_times(config_period, current_energy, required, eah)
+        else:
+            continue
+        start, end = common.limit_times(config_period, start, end)
+        params = { 'start': start, 'end': end, 'amps': str(config_period['current']) }
+        edits.append((params, p['charge'], p['timeslot']))
+    return edits
+
+async def run_station(config, session, semaphore, planner=plan_station, test=False):
+    # connect -> plan -> read/write pipeline for one station, returns a result dict
+    result = { 'station_id': config.get('solis_station_id'), 'status': 'Error', 'message': '', 'edits': [], 'seconds': 0.0 }
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            if not await solis_control.connect(config, session):
+                result['message'] = 'Could not connect to Solis API'
+            else:
+                result['station_name'] = config.get('station_name')
+                result['battery_soc'] = config.get('battery_soc')
+                edits = planner(config)
+                for params, charge, timeslot in edits:
+                    result['edits'].append('%s%d %s-%s (%sA)' % ('c' if charge else 'd', timeslot + 1, params['start'], params['end'], params.get('amps', '')))
+                if not edits:
+                    result['message'] = 'OK'
+                else: # one read and (unless unchanged or test) one write
+                    result['message'] = await solis_control.set_inverter_schedule(config, session, edits, test=test)
+                if common.write_ok(result['message']):
+                    result['status'] = 'OK'
+        except common.SolisControlException as e:
+            result['message'] = str(e)
+        result['seconds'] = time.perf_counter() - started
+    if result['status'] != 'OK':
+        log.warning('Station %s: %s', result['station_id'], result['message'])
+    return result
+
+async def run_fleet(configs, concurrency=DEFAULT_CONCURRENCY, planner=plan_station, test=False, session=None):
+    # run the station pipeline for every config in the list, at most 'concurrency' at once
+    # note each config dict is copied so connection state is kept separate for each station
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    own_session = session is None
+    if own_session:
+        session = solis_control.get_session(concurrency)
+    try:
+        results = await asyncio.gather(*[ run_station(dict(c), session, semaphore, planner, test) for c in configs ])
+    finally:
+        if own_session:
+            await session.close()
+    return summarise(results, time.perf_counter() - started)
+
+async def run_account(base, concurrency=DEFAULT_CONCURRENCY, planner=plan_station, test=False, session=None,
+        page_size=common.LIST_PAGE_SIZE, page_concurrency=4):
+    # run the station pipeline for every station in the API account - stations are found by paging through the
+    # inverter list and each one is started as soon as its record arrives so work overlaps discovery
+    # base is the config (credentials and settings) used for every station, the summary includes the 'index'
+    # of inverter records by station id and serial number (see common.index_inverters) - the API account is logged in
+    # once and the token shared by every station
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    own_session = session is None
+    if own_session:
+        session = solis_control.get_session(concurrency)
+    index = common.index_inverters([])
+    tasks = []
+    list_config = dict(base)
+    try:
+        if await solis_control.get_login_detail(list_config, session): # one login shared by every station
+            base = dict(base, login_token=list_config['login_token'])
+        async for record in solis_control.iter_inverters(list_config, session, page_size, page_concurrency):
+            station_id = record.get('stationId')
+            new_station = station_id not in index['stations']
+            common.index_inverters([ record ], index)
+            if new_station: # note only the first inverter of each station is controlled (as in get_inverter_entry)
+                config = dict(base)
+                config['solis_station_id'] = str(station_id)
+                common.add_fields(common.ENTRY_FIELDS, record, config) # so connect() does not look up the entry again
+                tasks.append(asyncio.ensure_future(run_station(config, session, semaphore, planner, test)))
+        results = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if own_session:
+            await session.close()
+    summary = summarise(results, time.perf_counter() - started)
+    summary['index'] = index
+    summary['missing_pages'] = list_config.get('missing_pages', [])
+    return summary
+
+async def sweep_details(base, session=None, page_size=common.LIST_PAGE_SIZE, page_concurrency=4):
+    # battery SOC etc of every inverter in the API account from the paged detail list (one request for each page
+    # rather than one for each inverter) - returns per inverter state by serial number (see common.detail_states)
+    own_session = session is None
+    if own_session:
+        session = solis_control.get_session(page_concurrency)
+    try:
+        return await solis_control.get_inverter_details(dict(base), session, page_size, page_concurrency)
+    finally:
+        if own_session:
+            await session.close()
+
+def summarise(results, elapsed):
+    # summary dict of the station results
+    ok = sum(1 for r in results if r['status'] == 'OK')
+    unchanged = sum(1 for r in results if r['message'] == common.UNCHANGED_MSG)
+    return {
+        'results': results,
+        'stations': len(results),
+        'ok': ok,
+        'failed': len(results) - ok,
+        'unchanged': unchanged, # stations where the control write was skipped as the schedule was already set
+        'seconds': elapsed,
+        'stations_per_minute': len(results) * 60.0 / elapsed if elapsed > 0 else 0.0,
+    }
+
+def load_defaults(fleet, secrets_file='secrets.yaml'):
+    # secrets + fleet defaults
+    base = {}
+    try:
+        with open(secrets_file, 'r') as file:
+            base.update(yaml.safe_load(file) or {})
+    except FileNotFoundError:
+        pass
+    base.update(fleet.get('defaults') or {})
+    return base
+
+def load_fleet(fleet_file='fleet.yaml', secrets_file='secrets.yaml', account=False):
+    # list of station configs - each is secrets + fleet defaults + station settings
+    # if account is True only the base config (secrets + fleet defaults) is returned - see run_account()
+    with open(fleet_file, 'r') as file:
+        fleet = yaml.safe_load(file)
+    base = load_defaults(fleet, secrets_file)
+    if account:
+        return base
+    configs = []
+    for station in fleet.get('stations') or []:
+        config = dict(base)
+        config.update(station)
+        config['solis_station_id'] = str(config['solis_station_id'])
+        configs.append(config)
+    return configs
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Plan and set charging/discharging times for a fleet of stations via the Solis API',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("fleet", help="YAML file defining the fleet of stations", nargs='?', default='fleet.yaml')
+    parser.add_argument("-c", "--concurrency", help="maximum number of stations processed at once", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("-t", "--test", help="test mode, plans are calculated but no times are set", action='store_true')
+    parser.add_argument("-a", "--account", help="run every station in the API account (the fleet file only gives the defaults)", action='store_true')
+    parser.add_argument("-b", "--battery", help="only show the battery SOC of every inverter in the API account", action='store_true')
+    parser.add_argument("-s", "--silent", help="only the summary is printed out", action='store_true')
+    parser.add_argument("-l", "--limit", help="client side API rate limit in requests per second for each API key (0 = no limit)", type=float, default=0.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.limit > 0.0:
+        limiter.set_limits(rate=args.limit, enabled=True)
+    if args.battery:
+        started = time.perf_counter()
+        states = asyncio.run(sweep_details(load_fleet(args.fleet, account=True)))
+        if not args.silent:
+            for sn, state in states.items():
+                print ('%s %s %s: SOC %s%% (ODS %s%%)' % (state['solis_station_id'], sn, state.get('station_name', ''), state.get('battery_soc'), state.get('battery_ods')))
+        print ('%d inverters in %.1fs' % (len(states), time.perf_counter() - started))
+    else:
+        if args.account:
+            summary = asyncio.run(run_account(load_fleet(args.fleet, account=True), args.concurrency, test=args.test))
+        else:
+            summary = asyncio.run(run_fleet(load_fleet(args.fleet), args.concurrency, test=args.test))
+        if not args.silent:
+            for r in summary['results']:
+                print ('%s %s (%.1fs): %s %s' % (r['station_id'], r['status'], r['seconds'], r['message'] if r['message'] != 'OK' else '', ' '.join(r['edits'])))
+        print ('%d stations (%d OK, %d failed, %d unchanged) in %.1fs = %.1f stations per minute' % (summary['stations'], summary['ok'], summary['failed'], summary['unchanged'], summary['seconds'], summary['stations_per_minute']))
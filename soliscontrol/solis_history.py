@@ -0,0 +1,182 @@
+import os
+import struct
+import argparse
+from array import array
+from collections import deque
+
+""" Persistent ring buffers of daily values (eg energy use, solar forecasts and forecast multipliers)
+
+Each buffer is kept in memory as an array of floats and on disk in a small binary file - a header with the
+capacity and the number of values ever added, then the values themselves. Adding a value overwrites the oldest
+slot in place so it is O(1) in time and disk writes, whatever the capacity (default about 2 years)
+
+The mean and maximum of the latest 'window' values (eg history_days) are kept up to date as values are added
+using a running sum and a monotonic deque, so reading them needs no parsing or scanning
+
+A buffer with no file (path None) is kept only in memory - eg for sub-minute samples see solis_s3_poller
+
+For use with Pyscript (file access is wrapped with task.executor) or from the command line
+buffer state is passed between methods in a dict
+See https://hacs-pyscript.readthedocs.io/en/latest/index.html"""
+
+MAGIC = b'SHB1'
+HEADER = struct.Struct('<4sIQ') # magic, capacity, number of values ever added
+DEFAULT_CAPACITY = 732 # values kept in each buffer (2 years of daily values)
+BINARY = getattr(os, 'O_BINARY', 0) # Windows
+
+try:
+    task.executor()
+except NameError:
+    PYSCRIPT = False
+except TypeError:
+    PYSCRIPT = True
+else: # default
+    PYSCRIPT = False
+
+def io_call(func, *args):
+    # func must be a native (eg os) function under pyscript
+    if PYSCRIPT:
+        return task.executor(func, *args)
+    else:
+        return func(*args)
+
+def read_file(path):
+    # contents of a file as bytes or None if it does not exist
+    if not io_call(os.path.exists, path):
+        return None
+    fd = io_call(os.open, path, os.O_RDONLY | BINARY)
+    try:
+        size = io_call(os.fstat, fd).st_size
+        return io_call(os.read, fd, size)
+    finally:
+        io_call(os.close, fd)
+
+def write_at(path, writes):
+    # write each (offset, bytes) in writes into an existing file
+    fd = io_call(os.open, path, os.O_WRONLY | BINARY)
+    try:
+        for offset, data in writes:
+            io_call(os.lseek, fd, offset, os.SEEK_SET)
+            io_call(os.write, fd, data)
+    finally:
+        io_call(os.close, fd)
+
+def new_buffer(path, window, capacity):
+    return { 'path': path, 'window': window, 'capacity': max(capacity, window), 'values': array('d', bytes(8 * max(capacity, window))),
+        'seq': 0, 'sum': 0.0, 'max': deque() }
+
+def recalc(buf):
+    # rebuild the running sum and maximum deque from the latest window values
+    buf['sum'] = 0.0
+    buf['max'] = deque()
+    start = max(0, buf['seq'] - buf['window'])
+    for seq in range(start, buf['seq']):
+        update_window(buf, seq, buf['values'][seq % buf['capacity']], False)
+
+def update_window(buf, seq, value, drop=True):
+    # add the value at seq to the running sum and maximum deque (and drop the value which leaves the window)
+    buf['sum'] += value
+    if drop and seq >= buf['window']:
+        buf['sum'] -= buf['values'][(seq - buf['window']) % buf['capacity']]
+    queue = buf['max']
+    while queue and queue[-1][1] <= value:
+        queue.pop()
+    queue.append((seq, value))
+    while queue[0][0] <= seq - buf['window']:
+        queue.popleft()
+
+def save(buf):
+    # write the whole buffer to a temporary file and replace the existing one
+    if buf['path'] is None:
+        return
+    folder = os.path.dirname(buf['path'])
+    if folder:
+        io_call(os.makedirs, folder, 0o755, True)
+    temp_path = buf['path'] + '.tmp'
+    fd = io_call(os.open, temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | BINARY, 0o644)
+    try:
+        io_call(os.write, fd, HEADER.pack(MAGIC, buf['capacity'], buf['seq']) + buf['values'].tobytes())
+    finally:
+        io_call(os.close, fd)
+    io_call(os.replace, temp_path, buf['path'])
+
+def open_history(path, window, capacity=DEFAULT_CAPACITY):
+    # load a buffer from its file (or a new empty one) - mean() and maximum() are over the latest window values
+    # if the file has a different capacity the latest values are kept and it is rewritten (unless capacity is None)
+    data = read_file(path) if path is not None else None
+    if data and len(data) >= HEADER.size and data[:4] == MAGIC:
+        magic, file_capacity, seq = HEADER.unpack_from(data)
+        stored = array('d', data[HEADER.size:HEADER.size + 8 * file_capacity])
+        if len(stored) == file_capacity:
+            buf = new_buffer(path, window, capacity or file_capacity)
+            if file_capacity == buf['capacity']:
+                buf['values'] = stored
+                buf['seq'] = seq
+                recalc(buf)
+            else:
+                extend(buf, [ stored[s % file_capacity] for s in range(max(0, seq - file_capacity), seq) ])
+            return buf
+    return new_buffer(path, window, capacity or DEFAULT_CAPACITY)
+
+def extend(buf, values):
+    # add many values (eg migrated from elsewhere) then write the whole file once
+    for v in values:
+        buf['values'][buf['seq'] % buf['capacity']] = float(v)
+        buf['seq'] += 1
+    recalc(buf)
+    save(buf)
+
+def append(buf, value):
+    # add a value replacing the oldest - only the value and header are written to disk
+    value = float(value)
+    seq = buf['seq']
+    update_window(buf, seq, value)
+    slot = seq % buf['capacity']
+    buf['values'][slot] = value
+    buf['seq'] = seq + 1
+    if slot == buf['capacity'] - 1: # once round the buffer so remove any rounding drift in the running sum
+        recalc(buf)
+    if buf['path'] is None:
+        pass
+    elif seq == 0 or not io_call(os.path.exists, buf['path']):
+        save(buf)
+    else: # the value first so an interrupted write loses the value rather than recording a bad one
+        write_at(buf['path'], [ (HEADER.size + 8 * slot, buf['values'][slot:slot + 1].tobytes()),
+            (0, HEADER.pack(MAGIC, buf['capacity'], buf['seq'])) ])
+
+def count(buf):
+    # number of values in the window
+    return min(buf['seq'], buf['window'])
+
+def stored(buf):
+    # number of values kept
+    return min(buf['seq'], buf['capacity'])
+
+def values(buf, n=None):
+    # latest n values (default the window) oldest first
+    n = min(n if n is not None else buf['window'], stored(buf))
+    return [ buf['values'][s % buf['capacity']] for s in range(buf['seq'] - n, buf['seq']) ]
+
+def mean(buf):
+    # mean of the values in the window (None if empty)
+    n = count(buf)
+    return buf['sum'] / n if n else None
+
+def maximum(buf):
+    # maximum of the values in the window (None if empty)
+    return buf['max'][0][1] if buf['max'] else None
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Show the contents of a history ring buffer file',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("file", help="buffer file")
+    parser.add_argument("-w", "--window", help="number of latest values for the mean and maximum", type=int, default=7)
+    parser.add_argument("-a", "--all", help="print all the stored values", action='store_true')
+    args = parser.parse_args()
+
+    buf = open_history(args.file, args.window, None)
+    print ('Capacity %d, stored %d, added %d' % (buf['capacity'], stored(buf), buf['seq']))
+    if count(buf):
+        print ('Latest %d: mean %.2f, max %.2f' % (count(buf), mean(buf), maximum(buf)))
+    print (','.join('%g' % v for v in values(buf, stored(buf) if args.all else None)))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import logging
+import argparse
+import yaml
+from datetime import date, datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError: # optional dependency - see setup.py extras
+    raise ImportError("solis_ingest needs numpy - install it with 'pip install numpy' or 'pip install soliscontrol[numpy]'") from None
+
+try:
+    import solis_common as common
+    import solis_control_req_mod as solis_control
+except ImportError:
+    from soliscontrol import solis_common as common
+    from soliscontrol import solis_control_req_mod as solis_control
+
+""" Ingestion of historical inverter data from the Solis Cloud API into a local columnar store
+
+Two tables are kept for each inverter - 'day' has the 5 minute data from the inverterDay endpoint (battery SOC,
+battery power and current, grid power and import/export, house load and PV) and 'month' has the daily totals
+from the inverterMonth endpoint. The first run backfills from a start date and each later run only fetches
+the days (or months) after the high-water mark, which is the last complete period stored
+
+Each table is a folder with one file of raw little-endian float64 values per column (plus 'time' in epoch
+seconds) and a meta.json with the number of rows and the high-water mark. New rows are appended to the
+column files and then meta.json is replaced, so an interrupted run leaves the table as it was.
+Tables are read back as numpy memmaps so a long history can be sliced without loading it all - see load_table()
+
+store/
+  <inverter sn>/
+    day/
+      meta.json
+      time.f8
+      battery_soc.f8 ...
+
+Requires numpy"""
+
+DAY_COLUMNS = { # inverterDay field -> column (powers in kW, current in A, energies in kWh)
+    'batteryCapacitySoc': 'battery_soc',
+    'batteryPower': 'battery_power',
+    'bstteryCurrent': 'battery_current', # sic
+    'pSum': 'grid_power',
+    'familyLoadPower': 'load_power',
+    'pac': 'inverter_power',
+    'dcPac': 'pv_power',
+    'gridPurchasedTodayEnergy': 'grid_import_today',
+    'gridSellTodayEnergy': 'grid_export_today',
+}
+MONTH_COLUMNS = { # inverterMonth field -> column (energies in kWh)
+    'energy': 'pv_energy',
+    'batteryChargeEnergy': 'battery_charge_energy',
+    'batteryDischargeEnergy': 'battery_discharge_energy',
+    'gridPurchasedEnergy': 'grid_import_energy',
+    'gridSellEnergy': 'grid_export_energy',
+    'homeLoadEnergy': 'load_energy',
+}
+TABLES = { # table -> (endpoint, record time field, columns)
+    'day': (common.DAY_ENDPOINT, 'dataTimestamp', DAY_COLUMNS),
+    'month': (common.MONTH_ENDPOINT, 'date', MONTH_COLUMNS),
+}
+UNIT_SCALES = { 'W': 0.001, 'kW': 1.0, 'MW': 1000.0, 'Wh': 0.001, 'kWh': 1.0, 'MWh': 1000.0 } # by the unit field eg 'pacStr'
+DTYPE = np.dtype('<f8')
+EXTENSION = '.f8'
+META_FILE = 'meta.json'
+DEFAULT_STORE = 'solis_data'
+DEFAULT_BACKFILL = { 'day': 30, 'month': 12 } # periods fetched on the first run if no start is given
+
+log = logging.getLogger(__name__)
+
+def table_folder(store, inverter_sn, table):
+    return os.path.join(store, inverter_sn, table)
+
+def column_names(table):
+    return [ 'time' ] + list(TABLES[table][2].values())
+
+def read_meta(folder, table):
+    # table metadata - rows stored, high-water mark (last complete YYYY-MM-DD or YYYY-MM) and time of the last row
+    try:
+        with open(os.path.join(folder, META_FILE), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return { 'table': table, 'columns': column_names(table), 'rows': 0, 'high_water': None, 'last_time': None }
+
+def write_meta(folder, meta):
+    temp_path = os.path.join(folder, META_FILE + '.tmp')
+    with open(temp_path, 'w') as file:
+        json.dump(meta, file, indent=2)
+    os.replace(temp_path, os.path.join(folder, META_FILE))
+
+def open_table(store, inverter_sn, table):
+    # metadata for a table (created if necessary) - column files longer than the rows in meta.json
+    # (left by an interrupted append) are cut back
+    folder = table_folder(store, inverter_sn, table)
+    os.makedirs(folder, exist_ok=True)
+    meta = read_meta(folder, table)
+    size = meta['rows'] * DTYPE.itemsize
+    for column in meta['columns']:
+        path = os.path.join(folder, column + EXTENSION)
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        elif os.path.getsize(path) > size:
+            os.truncate(path, size)
+    return meta
+
+def record_value(record, key):
+    # float value of a record field scaled to kW/kWh by its unit field (NaN if missing)
+    try:
+        value = float(record[key])
+    except (KeyError, TypeError, ValueError):
+        return float('nan')
+    return value * UNIT_SCALES.get(record.get(key + 'Str'), 1.0)
+
+def to_columns(records, table, after=None):
+    # dict of column -> numpy array from API records in time order (only those later than after, epoch seconds)
+    endpoint, time_key, columns = TABLES[table]
+    times = np.array([ record_value(r, time_key) / 1000.0 for r in records ], dtype=DTYPE)
+    keep = ~np.isnan(times)
+    if after is not None:
+        keep &= times > after
+    order = np.argsort(times[keep], kind='stable')
+    result = { 'time': times[keep][order] }
+    for key, column in columns.items():
+        result[column] = np.array([ record_value(r, key) for r in records ], dtype=DTYPE)[keep][order]
+    return result
+
+def append_rows(store, inverter_sn, meta, columns, high_water=None):
+    # append arrays to the column files then record the new row count (and high-water mark) in meta.json
+    folder = table_folder(store, inverter_sn, meta['table'])
+    rows = len(columns['time'])
+    if rows:
+        for column in meta['columns']:
+            with open(os.path.join(folder, column + EXTENSION), 'ab') as file:
+                file.write(np.ascontiguousarray(columns[column], dtype=DTYPE).tobytes())
+        meta['rows'] += rows
+        meta['last_time'] = float(columns['time'][-1])
+    if high_water:
+        meta['high_water'] = high_water
+    meta['updated'] = datetime.now().isoformat(timespec='seconds')
+    write_meta(folder, meta)
+    return rows
+
+def load_table(store, inverter_sn, table='day', columns=None, mmap=True):
+    # dict of column -> read only numpy array (memory mapped unless mmap is False) for all the rows in a table
+    # columns is a list of column names (default all)
+    folder = table_folder(store, inverter_sn, table)
+    meta = read_meta(folder, table)
+    result = {}
+    for column in columns or meta['columns']:
+        path = os.path.join(folder, column + EXTENSION)
+        if meta['rows'] == 0:
+            result[column] = np.empty(0, dtype=DTYPE)
+        elif mmap:
+            result[column] = np.memmap(path, dtype=DTYPE, mode='r', shape=(meta['rows'],))
+        else:
+            result[column] = np.fromfile(path, dtype=DTYPE, count=meta['rows'])
+    return result
+
+def period_list(table, first, last):
+    # YYYY-MM-DD days (or YYYY-MM months) from first to last inclusive
+    periods = []
+    if table == 'day':
+        day = first
+        while day <= last:
+            periods.append(day.isoformat())
+            day += timedelta(days=1)
+    else:
+        month = first.replace(day=1)
+        while month <= last:
+            periods.append(month.strftime('%Y-%m'))
+            month = (month + timedelta(days=32)).replace(day=1)
+    return periods
+
+def pending_periods(table, high_water=None, start=None, end=None):
+    # complete periods not yet stored - after the high-water mark (or from start) up to end (default yesterday or last month)
+    today = date.today()
+    if table == 'day':
+        last = min(end or today, today - timedelta(days=1))
+        if high_water:
+            first = date.fromisoformat(high_water) + timedelta(days=1)
+        else:
+            first = start or today - timedelta(days=DEFAULT_BACKFILL['day'])
+    else:
+        last = min(end or today, today.replace(day=1) - timedelta(days=1))
+        if high_water:
+            first = (date.fromisoformat(high_water + '-01') + timedelta(days=32)).replace(day=1)
+        else:
+            first = start or (today.replace(day=1) - timedelta(days=DEFAULT_BACKFILL['month'] * 31)).replace(day=1)
+    return period_list(table, first, last)
+
+def sync_table(config, session, store, table='day', start=None, end=None, max_periods=None):
+    # fetch and append the pending periods for the connected inverter (config needs 'inverter_id' and 'inverter_sn')
+    # periods are stored in order and it stops at the first one which cannot be read so the high-water mark has no gaps
+    # returns a result dict - 'status' is 'OK' if all the pending periods (up to max_periods) were stored
+    inverter_sn = config['inverter_sn']
+    meta = open_table(store, inverter_sn, table)
+    periods = pending_periods(table, meta['high_water'], start, end)
+    if max_periods is not None:
+        periods = periods[:max_periods]
+    result = { 'inverter_sn': inverter_sn, 'table': table, 'status': 'OK', 'message': 'OK', 'periods': 0, 'rows': 0 }
+    for period in periods:
+        records = solis_control.get_inverter_history(config, session, TABLES[table][0], period)
+        if records is None:
+            result['status'] = 'Error'
+            result['message'] = 'Cannot get %s data for %s' % (table, period)
+            break
+        result['rows'] += append_rows(store, inverter_sn, meta, to_columns(records, table, meta['last_time']), period)
+        result['periods'] += 1
+    result['high_water'] = meta['high_water']
+    result['total_rows'] = meta['rows']
+    return result
+
+def describe_table(store, inverter_sn, table):
+    # one line summary of a table
+    meta = read_meta(table_folder(store, inverter_sn, table), table)
+    if not meta['rows']:
+        return '%s %s: empty' % (inverter_sn, table)
+    data = load_table(store, inverter_sn, table, [ 'time' ])
+    first = datetime.fromtimestamp(float(data['time'][0])).strftime('%Y-%m-%d %H:%M')
+    last = datetime.fromtimestamp(float(data['time'][-1])).strftime('%Y-%m-%d %H:%M')
+    return '%s %s: %d rows %s to %s (high-water %s)' % (inverter_sn, table, meta['rows'], first, last, meta['high_water'])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Backfill and incrementally sync historical inverter data into a local columnar store',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("store", help="folder for the stored data", nargs='?', default=DEFAULT_STORE)
+    parser.add_argument("-t", "--table", help="table(s) to sync", choices=[ 'day', 'month', 'both' ], default='both')
+    parser.add_argument("-s", "--start", help="first day to backfill (YYYY-MM-DD) when a table is empty", type=date.fromisoformat)
+    parser.add_argument("-e", "--end", help="last day to sync (YYYY-MM-DD) - default the last complete day or month", type=date.fromisoformat)
+    parser.add_argument("-n", "--max", help="maximum number of days (or months) fetched for each table", type=int)
+    parser.add_argument("-a", "--account", help="sync every inverter in the API account", action='store_true')
+    parser.add_argument("-i", "--info", help="only show what is in the store", action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    tables = [ 'day', 'month' ] if args.table == 'both' else [ args.table ]
+    if args.info:
+        for inverter_sn in sorted(os.listdir(args.store)) if os.path.isdir(args.store) else []:
+            for table in tables:
+                print (describe_table(args.store, inverter_sn, table))
+    else:
+        with open('secrets.yaml', 'r') as file:
+            config = yaml.safe_load(file)
+        with solis_control.get_session() as session:
+            if args.account:
+                inverters = []
+                for record in solis_control.iter_inverters(config, session):
+                    inverter_config = dict(config)
+                    common.add_fields(common.ENTRY_FIELDS, record, inverter_config)
+                    inverters.append(inverter_config)
+            elif solis_control.get_inverter_entry(config, session):
+                inverters = [ config ]
+            else:
+                inverters = []
+                print ('Error: could not connect to Solis API')
+            for inverter_config in inverters:
+                for table in tables:
+                    started = time.perf_counter()
+                    result = sync_table(inverter_config, session, args.store, table, args.start, args.end, args.max)
+                    print ('%s %s: %s, %d periods, %d new rows (%d total, high-water %s) in %.1fs' % (result['inverter_sn'], table,
+                        result['message'], result['periods'], result['rows'], result['total_rows'], result['high_water'], time.perf_counter() - started))
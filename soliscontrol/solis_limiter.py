@@ -0,0 +1,199 @@
+import heapq
+import asyncio
+import threading
+import time
+
+try:
+    import solis_common as common
+except ImportError:
+    from soliscontrol import solis_common as common
+
+""" Client side rate limiter and priority scheduler for Solis Cloud API calls
+
+SolisCloud throttles requests per API key so all calls made through solis_control_req_mod.make_request()
+(and the aiohttp calls in solis_control_async_mod via acquire_async()) share a token bucket for each key id (taken from the Authorization header). Each endpoint has a cost in
+tokens and the bucket refills at 'rate' tokens per second up to 'burst'
+
+Calls waiting for tokens are queued by endpoint priority so control writes go ahead of reads, then
+telemetry (inverterDetail) and last the bulk list and history calls - calls of the same priority are served in order.
+A call which would have to wait past the deadline in its config (see common.set_deadline()) raises DeadlineExceeded
+
+Limiting is off by default (LIMITS) as a single station stays well within the API limits - turn it on with
+set_limits(enabled=True) when many stations share one API key
+
+Waiting is done by polling (with task.sleep under Pyscript) rather than blocking on a lock so
+it does not hold up the Pyscript event loop
+
+Queue depth and wait times are kept in METRICS - see metrics()"""
+
+LIMITS = { # off by default - turn on with set_limits() eg for a fleet sharing one API key
+    'enabled': False,
+    'rate': 2.0, # tokens added per second for each API key
+    'burst': 5.0, # maximum tokens which can be saved up
+    'poll': 0.05, # seconds between checks when waiting behind other calls
+}
+COSTS = { # tokens used by each endpoint (default 1.0)
+    common.INVERTER_ENDPOINT: 2.0,
+}
+PRIORITIES = { # lower goes first (default 2)
+    common.CONTROL_ENDPOINT: 0,
+    common.LOGIN_ENDPOINT: 1,
+    common.READ_ENDPOINT: 2,
+    common.INVERTER_ENDPOINT: 3,
+    common.DETAIL_ENDPOINT: 3,
+    common.DETAIL_LIST_ENDPOINT: 4, # bulk and history calls go last
+    common.DAY_ENDPOINT: 4,
+    common.MONTH_ENDPOINT: 4,
+}
+BUCKETS = {} # key id -> { 'tokens': available tokens, 'updated': monotonic time, 'queue': heap of waiting tickets }
+METRICS = { 'requests': 0, 'waited': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'max_queue_depth': 0, 'by_priority': {} }
+LOCK = threading.Lock()
+SEQUENCE = [ 0 ] # ticket counter so equal priorities are served in order
+
+try:
+    task.executor()
+except NameError:
+    PYSCRIPT = False
+except TypeError:
+    PYSCRIPT = True
+else: # default
+    PYSCRIPT = False
+
+def sleep(secs):
+    if PYSCRIPT:
+        return task.sleep(secs)
+    else:
+        return time.sleep(secs)
+
+def set_limits(rate=None, burst=None, costs=None, enabled=None):
+    # change the limits for all keys eg set_limits(enabled=False) to turn off limiting
+    if rate is not None:
+        LIMITS['rate'] = float(rate)
+    if burst is not None:
+        LIMITS['burst'] = float(burst)
+    if costs:
+        COSTS.update(costs)
+    if enabled is not None:
+        LIMITS['enabled'] = enabled
+
+def split_request(url, headers):
+    # (endpoint path, key id) for a request
+    endpoint = url[url.find('/', url.find('//') + 2):] if '//' in url else url
+    key_id = ''
+    authorization = (headers or {}).get('Authorization', '')
+    if authorization.startswith('API '):
+        key_id = authorization[4:].split(':')[0]
+    return endpoint, key_id
+
+def refill(bucket, now):
+    bucket['tokens'] = min(LIMITS['burst'], bucket['tokens'] + (now - bucket['updated']) * LIMITS['rate'])
+    bucket['updated'] = now
+
+def queue_depth():
+    # number of calls currently waiting for all keys
+    return sum(len(b['queue']) for b in BUCKETS.values())
+
+def try_acquire(key_id, ticket, cost):
+    # take the tokens if the ticket is first in the queue and there are enough, returns 0.0 if so
+    # otherwise returns the number of seconds to wait before trying again
+    with LOCK:
+        bucket = BUCKETS[key_id]
+        now = time.monotonic()
+        refill(bucket, now)
+        if bucket['queue'][0] is not ticket:
+            return LIMITS['poll']
+        if bucket['tokens'] >= cost:
+            bucket['tokens'] -= cost
+            heapq.heappop(bucket['queue'])
+            return 0.0
+        return max((cost - bucket['tokens']) / LIMITS['rate'], 0.001)
+
+def enqueue(url, headers):
+    # join the queue for the bucket of the request's key - returns the waiting state used by acquire()
+    endpoint, key_id = split_request(url, headers)
+    state = { 'key_id': key_id, 'cost': min(COSTS.get(endpoint, 1.0), LIMITS['burst']),
+        'priority': PRIORITIES.get(endpoint, 2), 'started': time.monotonic() }
+    with LOCK:
+        bucket = BUCKETS.setdefault(key_id, { 'tokens': LIMITS['burst'], 'updated': state['started'], 'queue': [] })
+        SEQUENCE[0] += 1
+        state['ticket'] = [ state['priority'], SEQUENCE[0] ]
+        heapq.heappush(bucket['queue'], state['ticket'])
+        METRICS['max_queue_depth'] = max(METRICS['max_queue_depth'], queue_depth())
+    return state
+
+def next_wait(state, config=None):
+    # seconds to wait before trying again (0.0 if the tokens have been taken)
+    # raises DeadlineExceeded (recorded as the last error in config) if waiting would pass the deadline in config
+    wait = try_acquire(state['key_id'], state['ticket'], state['cost'])
+    if wait > 0.0 and config is not None:
+        left = common.remaining_time(config)
+        if left is not None and wait > left - common.MIN_TIMEOUT:
+            e = common.DeadlineExceeded('Deadline passed waiting for the API rate limit - %.1fs left' % left)
+            common.record_error(config, msg=str(e), exception=e)
+            raise e
+    return wait
+
+def dequeue(state, granted):
+    # leave the queue (if not granted eg cancelled or out of time) and record the wait - returns the seconds waited
+    if not granted:
+        with LOCK:
+            bucket = BUCKETS[state['key_id']]
+            if state['ticket'] in bucket['queue']:
+                bucket['queue'].remove(state['ticket'])
+                heapq.heapify(bucket['queue'])
+        return 0.0
+    waited = time.monotonic() - state['started']
+    with LOCK:
+        METRICS['requests'] += 1
+        if waited > 0.001:
+            METRICS['waited'] += 1
+        METRICS['wait_total'] += waited
+        METRICS['wait_max'] = max(METRICS['wait_max'], waited)
+        by_priority = METRICS['by_priority'].setdefault(state['priority'], { 'requests': 0, 'wait_total': 0.0 })
+        by_priority['requests'] += 1
+        by_priority['wait_total'] += waited
+    return waited
+
+def acquire(url, headers=None, config=None):
+    # wait until a call to url can be made within the rate limit - returns the seconds waited
+    # raises DeadlineExceeded if the wait would pass any deadline in config
+    if not LIMITS['enabled']:
+        return 0.0
+    state = enqueue(url, headers)
+    granted = False
+    try:
+        while True:
+            wait = next_wait(state, config)
+            if wait <= 0.0:
+                granted = True
+                break
+            sleep(wait)
+    finally:
+        waited = dequeue(state, granted)
+    return waited
+
+async def acquire_async(url, headers=None, config=None):
+    # acquire() for asyncio clients (eg solis_control_async_mod) - waits without blocking the event loop
+    if not LIMITS['enabled']:
+        return 0.0
+    state = enqueue(url, headers)
+    granted = False
+    try:
+        while True:
+            wait = next_wait(state, config)
+            if wait <= 0.0:
+                granted = True
+                break
+            await asyncio.sleep(wait)
+    finally: # also if the task is cancelled while waiting
+        waited = dequeue(state, granted)
+    return waited
+
+def metrics():
+    # copy of METRICS with the current queue depth and mean waits added
+    with LOCK:
+        result = dict(METRICS)
+        result['queue_depth'] = queue_depth()
+        result['wait_mean'] = METRICS['wait_total'] / METRICS['requests'] if METRICS['requests'] else 0.0
+        result['by_priority'] = { p: dict(v, wait_mean=v['wait_total'] / v['requests']) for p, v in METRICS['by_priority'].items() }
+    return result
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+import random
+import argparse
+import time
+
+try:
+    import numpy as np
+except ImportError: # optional dependency - see setup.py extras
+    raise ImportError("solis_planner needs numpy - install it with 'pip install numpy' or 'pip install soliscontrol[numpy]'") from None
+
+try:
+    import solis_common as common
+except ImportError:
+    from soliscontrol import solis_common as common
+
+""" Vectorised (numpy) versions of the charge/discharge planning functions in solis_common
+for working out many plans at once eg across a fleet of inverters or a range of 'what-if' targets
+
+Inputs can be numpy arrays or scalars (which are broadcast against each other) and
+times are handled as integer minutes from midnight rather than HH:MM strings. Planned
+episodes which are off are returned as start = end = 0 (ie '00:00' to '00:00')
+
+The results are identical to the scalar solis_common functions - for 'random' sync the
+placement uses rng which can be a seed, a numpy Generator or a random.Random instance
+(a random.Random seeded the same as the 'random' module gives the same offsets as solis_common). rng can also be
+an array of uniform fractions in [0, 1) (broadcast against the inputs) when the same plan must give the same
+placement each time it is made
+
+Requires numpy"""
+
+SYNC_RANDOM = 0
+SYNC_START = 1
+SYNC_END = 2
+SYNC_CODES = { 'start': SYNC_START, 'end': SYNC_END }
+
+def sync_code(sync):
+    # integer code(s) for the 'sync' setting of a period - anything other than 'start' or 'end' is random
+    if isinstance(sync, str) or sync is None:
+        return SYNC_CODES.get(str(sync).lower(), SYNC_RANDOM)
+    return np.asarray(sync, dtype=np.int64)
+
+def to_minutes(hhmm):
+    # HH:MM string (or array of strings) to minutes from midnight, numbers are passed through
+    if isinstance(hhmm, str):
+        return common.hhmm_to_minutes(hhmm)
+    hhmm = np.asarray(hhmm)
+    if hhmm.dtype.kind in 'US':
+        return np.array([ common.hhmm_to_minutes(str(h)) for h in hhmm.ravel() ], dtype=np.int64).reshape(hhmm.shape)
+    return hhmm.astype(np.int64)
+
+def to_hhmm(minutes):
+    # minutes from midnight (scalar or array) to HH:MM strings
+    minutes = np.asarray(minutes, dtype=np.int64) % 1440
+    hours, mins = np.divmod(minutes, 60)
+    return np.char.add(np.char.add(np.char.zfill(hours.astype(str), 2), ':'), np.char.zfill(mins.astype(str), 2))
+
+def default_eah(eah):
+    # the energy amp hour constant(s) with the solis_common default applied where not set (None or zero)
+    if eah is None:
+        return common.ENERGY_AMP_HOUR
+    eah = np.asarray(eah, dtype=np.float64)
+    return np.where(eah == 0.0, common.ENERGY_AMP_HOUR, eah)
+
+def diff_minutes(start, end):
+    # difference in minutes between start and end (end before start is taken to run over midnight)
+    return (np.asarray(end, dtype=np.int64) - start) % 1440
+
+def calc_minutes(current, energy_kwh, eah=None):
+    # minutes required to charge/discharge a particular amount of available energy (kWH) - see common.calc_minutes()
+    current = np.asarray(current, dtype=np.float64)
+    energy_kwh = np.asarray(energy_kwh, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        minutes = 60.0 * energy_kwh / (current * default_eah(eah))
+    minutes = np.where((energy_kwh <= 0.0) | (current <= 0.0), 0.0, minutes)
+    return np.trunc(minutes).astype(np.int64)
+
+def calc_energy_kwh(current, start, end, eah=None):
+    # energy (kWh) charged/discharged from start to end minutes - see common.calc_energy_kwh()
+    minutes = diff_minutes(start, end)
+    energy = minutes * np.asarray(current, dtype=np.float64) * default_eah(eah) / 60.0
+    return np.where(minutes <= 0, 0.0, energy)
+
+def random_offsets(leftover, rng=None):
+    # random offsets from 0 to leftover inclusive (0 where leftover is not positive) - see common.start_end_times()
+    leftover = np.asarray(leftover, dtype=np.int64)
+    if isinstance(rng, random.Random): # draw in the same order as the scalar path would
+        flat = [ rng.randint(0, int(l)) if l > 0 else 0 for l in leftover.ravel() ]
+        return np.array(flat, dtype=np.int64).reshape(leftover.shape)
+    if not isinstance(rng, np.random.Generator):
+        rng = np.random.default_rng(rng)
+    return np.where(leftover > 0, rng.integers(0, np.maximum(leftover, 0) + 1), 0)
+
+def start_end_from_minutes(period_start, period_end, minutes, sync=SYNC_RANDOM, rng=None):
+    # tie episodes to the beginning or end of the period or position them randomly within it
+    # returns arrays of start and end minutes - see common.start_end_from_minutes()
+    period_start = to_minutes(period_start)
+    period_end = to_minutes(period_end)
+    sync = sync_code(sync)
+    duration = diff_minutes(period_start, period_end)
+    minutes = np.minimum(np.asarray(minutes, dtype=np.int64), duration)
+    minutes, duration, period_start, period_end, sync = np.broadcast_arrays(minutes, duration, period_start, period_end, sync)
+    active = minutes > 0
+    leftover = duration - minutes
+    is_random = active & (sync == SYNC_RANDOM)
+    offsets = np.zeros(minutes.shape, dtype=np.int64)
+    if is_random.any():
+        if isinstance(rng, np.ndarray): # fixed uniform fractions in [0, 1) - see the module notes
+            fractions = np.broadcast_to(rng, minutes.shape)[is_random]
+            offsets[is_random] = np.minimum((fractions * (leftover[is_random] + 1)).astype(np.int64), leftover[is_random])
+        else:
+            offsets[is_random] = random_offsets(leftover[is_random], rng)
+    start = np.where(sync == SYNC_END, period_end - minutes, period_start + offsets)
+    end = np.where(sync == SYNC_END, period_end, start + minutes)
+    start = np.where(active, start % 1440, 0)
+    end = np.where(active, end % 1440, 0)
+    return start, end
+
+def charge_times(config_period, full_energy, current_energy, target_level, eah=None, rng=None):
+    # start/end minutes and energy after charging to reach target levels of available energy (kWh) - see common.charge_times()
+    # config_period has 'start', 'end', 'current' and optional 'sync' - any of which can be arrays
+    full_energy = np.asarray(full_energy, dtype=np.float64)
+    current_energy = np.asarray(current_energy, dtype=np.float64)
+    target_level = np.asarray(target_level, dtype=np.float64)
+    current = config_period['current']
+    energy_gap = np.minimum(target_level - current_energy, full_energy - current_energy)
+    energy_gap = np.where((target_level <= 0.0) | (target_level - current_energy <= 0.0), 0.0, energy_gap)
+    minutes = calc_minutes(current, energy_gap, eah)
+    start, end = start_end_from_minutes(config_period['start'], config_period['end'], minutes, config_period.get('sync', SYNC_RANDOM), rng)
+    energy_after = current_energy + calc_energy_kwh(current, start, end, eah)
+    return start, end, energy_after
+
+def discharge_times(config_period, current_energy, target_level, eah=None, rng=None):
+    # start/end minutes and energy after discharging to reduce to target levels of available energy (kWh) - see common.discharge_times()
+    current_energy = np.asarray(current_energy, dtype=np.float64)
+    target_level = np.asarray(target_level, dtype=np.float64)
+    current = config_period['current']
+    energy_gap = np.where(target_level <= 0.0, 0.0, current_energy - target_level)
+    minutes = calc_minutes(current, energy_gap, eah)
+    start, end = start_end_from_minutes(config_period['start'], config_period['end'], minutes, config_period.get('sync', SYNC_RANDOM), rng)
+    energy_after = current_energy - calc_energy_kwh(current, start, end, eah)
+    return start, end, energy_after
+
+def check_scalar(n=10000, seed=1):
+    # compare vectorised results with the scalar solis_common functions for n random cases, returns the number of mismatches
+    gen = np.random.default_rng(seed)
+    full = gen.uniform(2.0, 20.0, n)
+    current = full * gen.uniform(0.0, 1.0, n)
+    target = gen.uniform(-1.0, 22.0, n)
+    amps = gen.integers(5, 100, n)
+    eah = gen.choice([ 0.0, 0.045, 0.05, 0.055 ], n)
+    starts = gen.integers(0, 600, n)
+    ends = starts + gen.integers(1, 600, n)
+    mismatches = 0
+    for sync in ('start', 'end', 'random'):
+        for charge in (True, False):
+            period = { 'start': starts, 'end': ends, 'current': amps, 'sync': sync }
+            random.seed(seed)
+            rng = random.Random(seed)
+            if charge:
+                vs, ve, va = charge_times(period, full, current, target, eah, rng)
+            else:
+                vs, ve, va = discharge_times(period, current, target, eah, rng)
+            for i in range(n):
+                scalar_period = { 'start': common.minutes_to_hhmm(starts[i]), 'end': common.minutes_to_hhmm(ends[i]), 'current': int(amps[i]), 'sync': sync }
+                if charge:
+                    s, e, a = common.charge_times(scalar_period, full[i], current[i], target[i], eah[i])
+                else:
+                    s, e, a = common.discharge_times(scalar_period, current[i], target[i], eah[i])
+                if s != common.minutes_to_hhmm(vs[i]) or e != common.minutes_to_hhmm(ve[i]) or a != va[i]:
+                    mismatches += 1
+    return mismatches
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check and time the vectorised planner against the scalar solis_common functions',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", "--number", help="number of random cases", type=int, default=10000)
+    parser.add_argument("-s", "--seed", help="random seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print ('Mismatches with scalar path:', check_scalar(args.number, args.seed))
+    period = { 'start': '02:01', 'end': '04:59', 'current': 50, 'sync': 'random' }
+    gen = np.random.default_rng(args.seed)
+    full = np.full(args.number, 8.0)
+    current = gen.uniform(0.0, 8.0, args.number)
+    target = gen.uniform(0.0, 10.0, args.number)
+    started = time.perf_counter()
+    for i in range(args.number):
+        common.charge_times(period, full[i], current[i], target[i])
+    scalar = time.perf_counter() - started
+    started = time.perf_counter()
+    charge_times(period, full, current, target, rng=args.seed)
+    vector = time.perf_counter() - started
+    print ('%d charge plans: scalar %.3fs, vectorised %.4fs (%.0fx)' % (args.number, scalar, vector, scalar / vector))
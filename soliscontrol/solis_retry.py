@@ -0,0 +1,138 @@
+import logging
+import random
+import time
+
+try:
+    import solis_control_req_mod as solis_control
+    import solis_common as common
+except ImportError:
+    from soliscontrol import solis_control_req_mod as solis_control
+    from soliscontrol import solis_common as common
+
+""" Retry policy for Solis Cloud API calls made with solis_control_req_mod
+
+Failed calls are classified from the error recorded in config['last_error'] (see common.error_kind())
+and transient errors (timeouts, connection errors, HTTP 429 and 5xx, B0115 and an expired token) are
+retried with capped exponential backoff and jitter so a transient blip costs seconds rather than minutes.
+An expired token is renewed by logging in again before the retry. If the config has a deadline
+(see common.set_deadline()) no retry is made which could not start before it
+
+Each station has a circuit breaker which opens after a run of calls have failed (after any retries) so further calls fail
+immediately (CircuitOpenException) until a reset period has passed, then one trial call is let through
+
+For use with Pyscript (sleeps with task.sleep) or from the command line
+connection state is passed between methods in the config dict
+See https://hacs-pyscript.readthedocs.io/en/latest/index.html"""
+
+RETRY_KINDS = ( 'timeout', 'connection', 'rate', 'server', 'busy', 'token' )
+DEFAULT_POLICY = {
+    'attempts': 5, # maximum number of calls including the first
+    'base_delay': 2.0, # seconds before the first retry, doubled for each later one
+    'max_delay': 60.0, # cap on any one delay (seconds)
+    'jitter': 0.5, # proportion of each delay which is randomised
+    'breaker_failures': 3, # consecutive failed calls (after retries) which open the circuit breaker
+    'breaker_reset': 300.0, # seconds before an open circuit breaker lets a trial call through
+}
+BREAKERS = {} # station id -> { 'failures': consecutive failures, 'opened': monotonic time opened or None }
+
+try:
+    task.executor()
+except NameError:
+    PYSCRIPT = False
+except TypeError:
+    PYSCRIPT = True
+else: # default
+    PYSCRIPT = False
+
+if not PYSCRIPT:
+    log = logging.getLogger(__name__)
+
+class CircuitOpenException(common.SolisControlException):
+    pass
+
+def sleep(secs):
+    if PYSCRIPT:
+        return task.sleep(secs)
+    else:
+        return time.sleep(secs)
+
+def get_policy(config):
+    # default policy updated with any 'retry_policy' settings in the config
+    policy = dict(DEFAULT_POLICY)
+    policy.update(config.get('retry_policy') or {})
+    return policy
+
+def backoff_delay(attempt, policy=DEFAULT_POLICY):
+    # seconds to wait before retry number 'attempt' (0 for the first retry)
+    delay = min(policy['max_delay'], policy['base_delay'] * (2 ** attempt))
+    return delay * (1.0 - policy['jitter'] * random.random())
+
+def result_ok(result):
+    # default test of a call result - message strings must be OK (or unchanged), anything else must be truthy
+    if isinstance(result, str):
+        return common.write_ok(result)
+    return bool(result)
+
+def breaker_state(station_id, policy=DEFAULT_POLICY):
+    # 'closed' (calls allowed), 'open' (calls blocked) or 'half-open' (a trial call is allowed)
+    breaker = BREAKERS.get(station_id)
+    if not breaker or breaker['opened'] is None:
+        return 'closed'
+    if time.monotonic() - breaker['opened'] >= policy['breaker_reset']:
+        return 'half-open'
+    return 'open'
+
+def record_outcome(station_id, ok, policy=DEFAULT_POLICY):
+    # update the circuit breaker for a station after a call
+    breaker = BREAKERS.setdefault(station_id, { 'failures': 0, 'opened': None })
+    if ok:
+        breaker['failures'] = 0
+        breaker['opened'] = None
+    else:
+        breaker['failures'] += 1
+        if breaker['failures'] >= policy['breaker_failures'] or breaker['opened'] is not None:
+            breaker['opened'] = time.monotonic() # (re)open - including a failed trial call when half-open
+
+def call(func, config, session, *args, ok=result_ok, **kwargs):
+    # call a solis_control_req_mod function as func(config, session, *args, **kwargs) retrying transient errors
+    # returns the result of the last call made - raises CircuitOpenException if the station's breaker is open
+    # and lets common.DeadlineExceeded through (a spent time budget does not count against the breaker)
+    policy = get_policy(config)
+    station_id = config.get('solis_station_id')
+    if breaker_state(station_id, policy) == 'open':
+        raise CircuitOpenException('Circuit breaker open for station %s after %d failures' % (station_id, BREAKERS[station_id]['failures']))
+    result = None
+    for attempt in range(policy['attempts']):
+        config.pop('last_error', None)
+        result = func(config, session, *args, **kwargs)
+        if ok(result):
+            record_outcome(station_id, True, policy)
+            return result
+        kind = common.last_error_kind(config)
+        if kind not in RETRY_KINDS or attempt + 1 >= policy['attempts']:
+            break
+        if kind == 'token': # log in again for a new token (no need to wait)
+            log.info('%s failed (%s: %s) - logging in again' % (func.__name__, kind, config['last_error']['msg']))
+            config.pop('login_token', None)
+            solis_control.get_login_detail(config, session)
+            continue
+        delay = backoff_delay(attempt, policy)
+        left = common.remaining_time(config)
+        if left is not None and left < delay + common.MIN_TIMEOUT:
+            log.info('%s failed (%s: %s) - no time left for a retry before the deadline' % (func.__name__, kind, config['last_error']['msg']))
+            break
+        log.info('%s failed (%s: %s) - retry %d in %.1fs' % (func.__name__, kind, config['last_error']['msg'], attempt + 1, delay))
+        sleep(delay)
+    if common.last_error_kind(config) != 'deadline':
+        record_outcome(station_id, False, policy)
+    return result
+
+def connect(config, session):
+    # solis_control.connect() with retries
+    return call(solis_control.connect, config, session)
+
+def refresh_soc(conn):
+    # solis_control.refresh_soc() with retries for a connection handle - see solis_control.open_connection()
+    def refresh_soc(config, session):
+        return solis_control.refresh_soc(conn)
+    return call(refresh_soc, conn['config'], conn['session'])
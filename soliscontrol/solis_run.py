@@ -6,6 +6,8 @@
 try:
     import solis_control_req_mod as solis_control
     import solis_common as common
+    import solis_retry as retry
+    import solis_cache
 except ImportError:
     # following lines add this file's parent directory to sys.path without using __file__ which is unreliable
     # see https://stackoverflow.com/questions/714063/importing-modules-from-parent-folder
@@ -13,8 +15,10 @@
     import os.path as path, sys
     current_dir = path.dirname(path.abspath(getsourcefile(lambda:0)))
     sys.path.insert(0, current_dir[:current_dir.rfind(path.sep)])
-    from soliscontrol import solis_control_req_mod as solis
+    from soliscontrol import solis_control_req_mod as solis_control
     from soliscontrol import solis_common as common
+    from soliscontrol import solis_retry as retry
+    from soliscontrol import solis_cache
     sys.path.pop(0) # restore sys.path
 
 if __name__ == "__main__":
@@ -24,6 +28,8 @@
     parser.add_argument("-r", "--remove", help="remove all existing inverter charging/discharging times", action='store_true')
     parser.add_argument("-s", "--silent", help="no status messages are printed out", action='store_true')
     parser.add_argument("-v", "--verbose", help="additional information messages are printed out", action='store_true')
+    parser.add_argument("-n", "--no-cache", help="do not use the cached station details and login token (%s)" % solis_cache.CACHE_FILE, action='store_true')
+    parser.add_argument("-t", "--deadline", help="seconds allowed for all the API calls (no limit if not set)", type=float)
     
     with open('secrets.yaml', 'r') as file:
         secrets = yaml.safe_load(file)
@@ -45,49 +51,71 @@
         parser.add_argument(short, long, help=help, type=int)
     args = parser.parse_args()    
 
-    with solis_control.get_session() as session:
+    if args.deadline:
+        common.set_deadline(config, args.deadline) # each request gets the time left as its timeout
+    try:
+        with solis_control.get_session() as session:
     
-        connected = solis_control.connect(config, session)
+            if args.no_cache:
+                connected = retry.connect(config, session) # transient errors are retried - see solis_retry
+            else:
+                connected = retry.call(solis_cache.connect, config, session) # skips discovery calls if details are cached
         
-        if connected:
+            if connected:
             
-            if not args.silent:
-                common.print_status(config)
+                if not args.silent:
+                    common.print_status(config)
             
-            error = False
-            if args.remove:
-                result = solis_control.set_inverter_data(config, session, inverter_data=None, verbose=args.verbose) # turns off all charging/discharging
-                if not args.silent or args.verbose:
-                    if result == 'OK':
-                        print ('Cleared inverter data')
-                    else:
-                        print ('Error: clearing inverter data: %s' % (result))
-                        error = True
-            else:
-                args_dict = dict(vars(args))
-                #for k, v in args_dict.items():
-                #     print(k, v)
-                for p in periods:
-                    period_name = p['name']
-                    if args_dict.get(period_name) is not None and config.get(period_name):
-                        config_period = config[period_name]
-                        cstart, cend = common.start_end_from_minutes(config_period, args_dict[period_name])
-                        cstart, cend = common.limit_times(config_period, cstart, cend)
-                        params = { 'start': cstart, 'end': cend, 'amps': str(config_period['current']) }
-                        result = solis_control.set_inverter_params(config, session, params, charge=p['charge'], timeslot=p['timeslot'], verbose=args.verbose)
+                error = False
+                if args.remove:
+                    result = solis_control.set_inverter_data(config, session, inverter_data=None, verbose=args.verbose) # turns off all charging/discharging
+                    if not args.silent or args.verbose:
+                        if result == 'OK':
+                            print ('Cleared inverter data')
+                        else:
+                            print ('Error: clearing inverter data: %s' % (result))
+                            error = True
+                else:
+                    args_dict = dict(vars(args))
+                    #for k, v in args_dict.items():
+                    #     print(k, v)
+                    edits = []
+                    changed = []
+                    for p in periods:
+                        period_name = p['name']
+                        if args_dict.get(period_name) is not None and config.get(period_name):
+                            config_period = config[period_name]
+                            cstart, cend = common.start_end_from_minutes(config_period, args_dict[period_name])
+                            cstart, cend = common.limit_times(config_period, cstart, cend)
+                            params = { 'start': cstart, 'end': cend, 'amps': str(config_period['current']) }
+                            edits.append((params, p['charge'], p['timeslot']))
+                            changed.append(p)
+                    if edits: # all timeslots are set in one read and one write
+                        result = retry.call(solis_control.set_inverter_schedule, config, session, edits, verbose=args.verbose)
                         if not args.silent or args.verbose:
-                            if result == 'OK':
-                                print ('***%s New: %s - %s (%sA)' % (p['long_name'], cstart, cend, str(config_period['current'])))
-                            else:
-                                print ('***%s Error: %s' % (p['long_name'], result))
-                                error = True
+                            for p, (params, charge, timeslot) in zip(changed, edits):
+                                if result == common.UNCHANGED_MSG:
+                                    print ('***%s Unchanged: %s - %s (%sA)' % (p['long_name'], params['start'], params['end'], params['amps']))
+                                elif result == 'OK':
+                                    print ('***%s New: %s - %s (%sA)' % (p['long_name'], params['start'], params['end'], params['amps']))
+                                else:
+                                    print ('***%s Error: %s' % (p['long_name'], result))
+                        if not common.write_ok(result):
+                            error = True
+                        if args.verbose:
+                            print ('Control writes: %(written)d sent, %(elided)d skipped' % common.WRITE_COUNTS)
+                            print ('Rate limiter: %(requests)d requests, %(waited)d waited (max %(wait_max).1fs, mean %(wait_mean).2fs), max queue %(max_queue_depth)d' % solis_control.limiter.metrics())
             
-            if error is False:          
-                inverter_data = solis_control.get_inverter_data(config, session, verbose=args.verbose)
-                if not args.silent or args.verbose:
-                    if inverter_data:
-                        for p in periods:
-                            existing = common.extract_inverter_params(inverter_data, charge=p['charge'], timeslot=p['timeslot'])
-                            print ('%s: %s - %s (%sA)' % (p['long_name'], existing['start'], existing['end'], existing['amps']))
-                    else:
-                        print ('Error: cannot get inverter data')
\ No newline at end of file
+                if error is False:          
+                    inverter_data = solis_control.get_inverter_data(config, session, verbose=args.verbose)
+                    if not args.silent or args.verbose:
+                        if inverter_data:
+                            for p in periods:
+                                existing = common.extract_inverter_params(inverter_data, charge=p['charge'], timeslot=p['timeslot'])
+                                print ('%s: %s - %s (%sA)' % (p['long_name'], existing['start'], existing['end'], existing['amps']))
+                        else:
+                            print ('Error: cannot get inverter data')            
+                if not args.no_cache:
+                    solis_cache.store(config) # keeps any renewed login token for next time
+    except common.DeadlineExceeded as e:
+        print ('Error: %s' % str(e))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+import asyncio
+import logging
+import time
+import yaml
+import argparse
+from aiohttp import ClientSession, ClientError, ClientTimeout, TCPConnector, BasicAuth
+
+try:
+    import solis_s3_logger as logger
+    import solis_common as common
+except ImportError:
+    from soliscontrol import solis_s3_logger as logger
+    from soliscontrol import solis_common as common
+
+""" Async client for local Solis S3 data loggers using aiohttp - checks many loggers concurrently
+
+For each logger inverter.cgi and moniter.cgi are fetched in parallel (responses are parsed as in solis_s3_logger).
+If the inverter is not connected to the logger, the logger is restarted and moniter.cgi is then polled every few seconds
+until it reports the inverter connected again (or recover_timeout passes) instead of waiting a fixed time
+
+The loggers are defined in a YAML file (default 'loggers.yaml') with optional 'defaults' which apply to every logger
+and a list of 'loggers' each with at least a 'solis_s3_ip' - for example:
+
+defaults:
+  solis_s3_username: admin
+  solis_s3_password: xxxx
+loggers:
+  - solis_s3_ip: 192.168.1.20
+  - solis_s3_ip: 192.168.1.21
+    solis_s3_password: yyyy
+
+Not for use with Home Assistant pyscript (see solis_s3_logger instead)"""
+
+DEFAULT_CONCURRENCY = 20
+RECOVER_TIMEOUT = 120.0 # seconds to wait for the inverter to reconnect after a restart
+POLL_INTERVAL = 5.0 # seconds between checks after a restart
+
+log = logging.getLogger(__name__)
+
+CLIENT_ERRORS = (ClientError, asyncio.TimeoutError, ValueError, IndexError) # including unparseable responses
+
+def get_session(limit=DEFAULT_CONCURRENCY):
+    # limit is the maximum number of simultaneous connections in the pool
+    return ClientSession(connector=TCPConnector(limit=limit))
+
+def logger_url(config, page):
+    return 'http://' + config.get(logger.IP_FIELD, logger.DEFAULT_IP) + '/' + page
+
+def logger_auth(config):
+    return BasicAuth(config.get(logger.USERNAME_FIELD, logger.DEFAULT_USERNAME), config.get(logger.PASSWORD_FIELD, logger.DEFAULT_PASSWORD))
+
+async def get_page(config, session, page, parser=None):
+    # text of a logger page (parsed if parser is set) or None
+    connect, read = common.request_timeout(config, logger.TIMEOUT)
+    try:
+        async with session.get(logger_url(config, page), auth=logger_auth(config), timeout=ClientTimeout(total=read, sock_connect=connect)) as response:
+            text = await response.text()
+            if response.status != 200:
+                log.warning('HTTP error getting %s from %s: %d %s' % (page, config.get(logger.IP_FIELD), response.status, text))
+                return None
+            return parser(text) if parser else text
+    except CLIENT_ERRORS as e:
+        log.debug('Error getting %s from %s: %s' % (page, config.get(logger.IP_FIELD), repr(e)))
+        return None
+
+async def get_inverter_data(config, session):
+    inverter_data = await get_page(config, session, 'inverter.cgi', logger.parse_inverter_data)
+    if inverter_data:
+        config['inverter'] = inverter_data
+    return inverter_data
+
+async def get_device_data(config, session):
+    device_data = await get_page(config, session, 'moniter.cgi', logger.parse_device_data)
+    if device_data:
+        config['device'] = device_data
+    return device_data
+
+async def restart(config, session):
+    return 'OK' if await get_page(config, session, 'restart.cgi') is not None else 'Error restarting logger'
+
+async def connect(config, session):
+    inverter_data, device_data = await asyncio.gather(get_inverter_data(config, session), get_device_data(config, session))
+    return bool(inverter_data and device_data)
+
+async def wait_for_recovery(config, session, timeout=RECOVER_TIMEOUT, interval=POLL_INTERVAL, semaphore=None):
+    # poll until the logger reports the inverter connected - returns the seconds taken or None if it has not by the timeout
+    # the semaphore (if set) is only held for each poll, not while sleeping
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        await asyncio.sleep(interval)
+        async with semaphore or asyncio.Semaphore(1):
+            device_data = await get_device_data(config, session)
+        if device_data and device_data['Connected']:
+            return time.monotonic() - started
+    return None
+
+async def check_logger(config, session, semaphore=None, fix=True, recover_timeout=RECOVER_TIMEOUT, interval=POLL_INTERVAL):
+    # check one logger and if necessary (and fix is True) restart it and wait for the inverter to reconnect
+    # the semaphore limits the loggers being checked at once but is let go while waiting for a restarted logger
+    # returns a health dict - 'status' is 'OK' if the inverter is connected to the logger at the end
+    result = { 'ip': config.get(logger.IP_FIELD, logger.DEFAULT_IP), 'status': 'Error', 'message': '', 'reachable': False,
+        'connected': False, 'restarted': False, 'time_to_recover': None, 'seconds': 0.0 }
+    semaphore = semaphore or asyncio.Semaphore(1)
+    started = time.perf_counter()
+    async with semaphore:
+        inverter_data, device_data = await asyncio.gather(get_inverter_data(config, session), get_device_data(config, session))
+        if not device_data:
+            result['message'] = 'Cannot connect to logger'
+        else:
+            result['reachable'] = True
+            result['device'] = device_data
+            result['inverter'] = inverter_data
+            result['connected'] = device_data['Connected']
+            if device_data['Connected']:
+                result['message'] = 'Inverter connected to logger'
+            elif not fix:
+                result['message'] = 'Inverter not connected to logger'
+            else:
+                log.info('Inverter not connected to logger %s - restarting' % result['ip'])
+                restarted = await restart(config, session)
+                result['restarted'] = restarted == 'OK'
+                if restarted != 'OK':
+                    result['message'] = restarted
+    if result['restarted']:
+        result['time_to_recover'] = await wait_for_recovery(config, session, recover_timeout, interval, semaphore)
+        if result['time_to_recover'] is None:
+            result['message'] = 'Restarted - inverter not reconnected after %.0fs' % recover_timeout
+        else:
+            result['connected'] = True
+            result['message'] = 'Restarted - inverter reconnected after %.1fs' % result['time_to_recover']
+            async with semaphore:
+                result['inverter'] = await get_inverter_data(config, session)
+    if result['connected']:
+        result['status'] = 'OK'
+    result['seconds'] = time.perf_counter() - started
+    if result['status'] != 'OK':
+        log.warning('Logger %s: %s', result['ip'], result['message'])
+    return result
+
+async def check_loggers(configs, concurrency=DEFAULT_CONCURRENCY, fix=True, recover_timeout=RECOVER_TIMEOUT, interval=POLL_INTERVAL, session=None):
+    # check every logger in the list, at most 'concurrency' at once, returns aggregated health with the result for each
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+    own_session = session is None
+    if own_session:
+        session = get_session(concurrency * 2) # two requests at once for each logger
+    try:
+        results = await asyncio.gather(*[ check_logger(dict(c), session, semaphore, fix, recover_timeout, interval) for c in configs ])
+    finally:
+        if own_session:
+            await session.close()
+    recovered = [ r['time_to_recover'] for r in results if r['time_to_recover'] is not None ]
+    return {
+        'results': results,
+        'loggers': len(results),
+        'ok': sum(1 for r in results if r['status'] == 'OK'),
+        'unreachable': sum(1 for r in results if not r['reachable']),
+        'restarted': sum(1 for r in results if r['restarted']),
+        'recovered': len(recovered),
+        'max_time_to_recover': max(recovered) if recovered else None,
+        'seconds': time.perf_counter() - started,
+    }
+
+def load_loggers(loggers_file='loggers.yaml'):
+    # list of logger configs - each is the defaults + logger settings
+    with open(loggers_file, 'r') as file:
+        loggers = yaml.safe_load(file)
+    configs = []
+    for entry in loggers.get('loggers') or []:
+        config = dict(loggers.get('defaults') or {})
+        config.update(entry)
+        configs.append(config)
+    return configs
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check many local Solis S3 data loggers concurrently and if necessary restart them',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("loggers", help="YAML file defining the loggers", nargs='?', default='loggers.yaml')
+    parser.add_argument("-c", "--concurrency", help="maximum number of loggers checked at once", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("-t", "--test", help="test mode, loggers are checked but not restarted", action='store_true')
+    parser.add_argument("-r", "--recover", help="seconds to wait for the inverter to reconnect after a restart", type=float, default=RECOVER_TIMEOUT)
+    parser.add_argument("-s", "--silent", help="only the summary is printed out", action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    configs = load_loggers(args.loggers)
+    summary = asyncio.run(check_loggers(configs, args.concurrency, not args.test, args.recover))
+    if not args.silent:
+        for r in summary['results']:
+            print ('%s %s (%.1fs): %s' % (r['ip'], r['status'], r['seconds'], r['message']))
+    print ('%d loggers (%d OK, %d unreachable, %d restarted, %d recovered) in %.1fs' % (summary['loggers'], summary['ok'],
+        summary['unreachable'], summary['restarted'], summary['recovered'], summary['seconds']))
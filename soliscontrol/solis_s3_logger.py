@@ -3,6 +3,11 @@
 import yaml
 import time
 
+try:
+    import solis_common as common
+except ImportError:
+    from soliscontrol import solis_common as common
+
 """ Check the local S3 data logger is working and if necessary restart it to reconnect to Solis servers
 
 Requires configuration settings in secrets.yaml:
@@ -23,6 +28,7 @@
 USERNAME_FIELD = 'solis_s3_username'
 PASSWORD_FIELD = 'solis_s3_password'
 IP_FIELD = 'solis_s3_ip'
+TIMEOUT = ( 3.0, 10.0 ) # (connect, read) timeouts for the local logger when there is no deadline
 
 try:
     task.executor()
@@ -51,6 +57,37 @@ def sleep(secs):
 def get_session():
     return Session()
     
+def parse_inverter_data(text): # inverter.cgi response (also used by solis_s3_async)
+    result = text.strip('\x00\r\n').split(';')
+    inverter_data = {}
+    inverter_data['Serial'] = result[0]
+    inverter_data['Firmware'] = result[1]
+    inverter_data['Model'] = result[2]
+    inverter_data['Temperature_C'] = float(result[3])
+    inverter_data['Current_Power_W'] = float(result[4])
+    inverter_data['Yield_Today_kWh'] = float(result[5])
+    inverter_data['Total_Yield_kWh'] = float(result[6])
+    inverter_data['Alerts'] = result[7] not in [ 'NO', 'No', 'no' ]
+    return inverter_data
+    
+def parse_device_data(text): # moniter.cgi response (also used by solis_s3_async)
+    result = text.strip('\x00\r\n').split(';')
+    device_data = {}
+    device_data['Serial'] = result[0]
+    device_data['Firmware'] = result[1]
+    mode = 'None'
+    if result[2] == 'Enable':
+        mode = 'AP'
+    elif result[6] == 'Enable':
+        mode = 'STA'
+    device_data['Mode'] = mode
+    device_data['SSID'] = result[7]
+    device_data['Signal_%'] = result[8] # result can be non-numeric ? none?
+    device_data['IP'] = result[9]
+    device_data['MAC'] = result[10]
+    device_data['Connected'] = result[11] == 'Connected' or result[12] == 'Connected'
+    return device_data
+    
 def get_inverter_data(config, session): 
     user = config.get(USERNAME_FIELD, DEFAULT_USERNAME)
     pwd = config.get(PASSWORD_FIELD, DEFAULT_PASSWORD)
@@ -58,18 +95,9 @@ def get_inverter_data(config, session):
     
     inverter_data = None
     try:
-        with make_request(session.get, url, auth=(user, pwd)) as response:
+        with make_request(session.get, url, auth=(user, pwd), timeout=common.request_timeout(config, TIMEOUT)) as response:
             if response.ok:
-                result = response.text.strip('\x00\r\n').split(';')
-                inverter_data = {}
-                inverter_data['Serial'] = result[0]
-                inverter_data['Firmware'] = result[1]
-                inverter_data['Model'] = result[2]
-                inverter_data['Temperature_C'] = float(result[3])
-                inverter_data['Current_Power_W'] = float(result[4])
-                inverter_data['Yield_Today_kWh'] = float(result[5])
-                inverter_data['Total_Yield_kWh'] = float(result[6])
-                inverter_data['Alerts'] = result[7] not in [ 'NO', 'No', 'no' ]
+                inverter_data = parse_inverter_data(response.text)
                 config['inverter'] = inverter_data
             else:
                 log.warning('HTTP error getting inverter data: %d %s' % (response.status_code, response.text))
@@ -84,23 +112,9 @@ def get_device_data(config, session):
     
     device_data = None
     try:
-        with make_request(session.get, url, auth=(user, pwd)) as response:
+        with make_request(session.get, url, auth=(user, pwd), timeout=common.request_timeout(config, TIMEOUT)) as response:
             if response.ok:
-                result = response.text.strip('\x00\r\n').split(';')
-                device_data = {}
-                device_data['Serial'] = result[0]
-                device_data['Firmware'] = result[1]
-                mode = 'None'
-                if result[2] == 'Enable':
-                    mode = 'AP'
-                elif result[6] == 'Enable':
-                    mode = 'STA'
-                device_data['Mode'] = mode
-                device_data['SSID'] = result[7]
-                device_data['Signal_%'] = result[8] # result can be non-numeric ? none?
-                device_data['IP'] = result[9]
-                device_data['MAC'] = result[10]
-                device_data['Connected'] = result[11] == 'Connected' or result[12] == 'Connected'
+                device_data = parse_device_data(response.text)
                 config['device'] = device_data 
             else:
                 log.warning('HTTP error getting device data: %d %s' % (response.status_code, response.text))
@@ -114,7 +128,7 @@ def restart(config, session):
     url = 'http://' + config.get(IP_FIELD, DEFAULT_IP) + '/restart.cgi'
     
     try:
-        with make_request(session.get, url, auth=(user, pwd)) as response:
+        with make_request(session.get, url, auth=(user, pwd), timeout=common.request_timeout(config, TIMEOUT)) as response:
             if not response.ok:
                 return 'HTTP error during restart: %d %s' % (response.status_code, response.text)
     except RequestException as e:
@@ -0,0 +1,140 @@
+import time
+import argparse
+import yaml
+
+try:
+    import solis_s3_logger as logger
+    import solis_history as history
+except ImportError:
+    from soliscontrol import solis_s3_logger as logger
+    from soliscontrol import solis_history as history
+
+""" Poller which samples the local S3 data logger (inverter.cgi) every few seconds without using the cloud API
+
+Samples are kept in memory in fixed-size ring buffers (see solis_history - one for the sample times and one for each
+field) so memory use does not grow however long it runs. The default capacity is 6 hours of 5 second samples
+
+Downsampled views (eg 1 or 5 minute means with min/max) and power ramp rates are calculated from the buffers on demand
+
+The requests session is kept open between samples so each one re-uses the keep-alive connection to the logger
+
+For use with Pyscript (sleeps with task.sleep) or from the command line
+series state is passed between methods in a dict"""
+
+FIELDS = { # series field -> inverter data key (see solis_s3_logger.get_inverter_data())
+    'power': 'Current_Power_W',
+    'temperature': 'Temperature_C',
+    'yield_today': 'Yield_Today_kWh',
+}
+DEFAULT_INTERVAL = 5.0 # seconds between samples
+DEFAULT_CAPACITY = 4320 # samples kept (6 hours at 5 second intervals)
+
+def new_series(capacity=DEFAULT_CAPACITY, interval=DEFAULT_INTERVAL):
+    # empty time series - the rolling mean/max of each field buffer is over the last minute of samples
+    window = max(1, int(round(60.0 / interval)))
+    series = { 'time': history.open_history(None, window, capacity), 'interval': interval, 'samples': 0, 'errors': 0 }
+    for field in FIELDS:
+        series[field] = history.open_history(None, window, capacity)
+    return series
+
+def add_sample(series, inverter_data, timestamp=None):
+    history.append(series['time'], timestamp if timestamp is not None else time.time())
+    for field, key in FIELDS.items():
+        history.append(series[field], inverter_data[key])
+    series['samples'] += 1
+
+def sample(config, session, series):
+    # read the logger once and add the result to the series - returns the inverter data or None
+    inverter_data = logger.get_inverter_data(config, session)
+    if inverter_data:
+        add_sample(series, inverter_data)
+    else:
+        series['errors'] += 1
+    return inverter_data
+
+def poll(config, series=None, duration=None, count=None, callback=None):
+    # sample every series['interval'] seconds until duration (seconds) or count samples have been taken (or forever)
+    # callback(series, inverter_data) is called after each successful sample - returns the series
+    series = series or new_series()
+    started = time.monotonic()
+    n = 0
+    with logger.get_session() as session:
+        while (duration is None or time.monotonic() - started < duration) and (count is None or n < count):
+            next_time = started + (n + 1) * series['interval']
+            inverter_data = sample(config, session, series)
+            if inverter_data and callback:
+                callback(series, inverter_data)
+            n += 1
+            wait = next_time - time.monotonic()
+            if wait > 0: # ticks are kept in step even if a sample is slow
+                logger.sleep(wait)
+    return series
+
+def samples(series, field, since=None):
+    # list of (time, value) for a field oldest first (only those at or after since)
+    n = history.stored(series['time'])
+    result = list(zip(history.values(series['time'], n), history.values(series[field], n)))
+    if since is not None:
+        result = [ s for s in result if s[0] >= since ]
+    return result
+
+def latest(series, field):
+    # rolling mean and max of a field over the last minute of samples
+    return history.mean(series[field]), history.maximum(series[field])
+
+def downsample(series, field, period=60, since=None):
+    # list of (period start time, mean, min, max, number of samples) for each period (seconds) with samples
+    result = []
+    bucket = None
+    for t, v in samples(series, field, since):
+        start = t - (t % period)
+        if bucket is None or start != bucket[0]:
+            if bucket is not None:
+                result.append((bucket[0], bucket[1] / bucket[4], bucket[2], bucket[3], bucket[4]))
+            bucket = [ start, 0.0, v, v, 0 ]
+        bucket[1] += v
+        bucket[2] = min(bucket[2], v)
+        bucket[3] = max(bucket[3], v)
+        bucket[4] += 1
+    if bucket is not None:
+        result.append((bucket[0], bucket[1] / bucket[4], bucket[2], bucket[3], bucket[4]))
+    return result
+
+def ramps(series, field='power', period=60, since=None):
+    # list of (period start time, rate of change per minute) between the means of consecutive periods
+    # eg power ramps in W/min - periods without samples are skipped
+    result = []
+    previous = None
+    for start, mean, low, high, n in downsample(series, field, period, since):
+        if previous is not None:
+            result.append((start, (mean - previous[1]) * 60.0 / (start - previous[0])))
+        previous = (start, mean)
+    return result
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Sample a local Solis S3 data logger and show per period power, ramp and temperature',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-i", "--interval", help="seconds between samples", type=float, default=DEFAULT_INTERVAL)
+    parser.add_argument("-d", "--duration", help="seconds to sample for", type=float, default=300.0)
+    parser.add_argument("-p", "--period", help="seconds in each downsampled period", type=int, default=60)
+    parser.add_argument("-v", "--verbose", help="print each sample", action='store_true')
+    args = parser.parse_args()
+
+    with open('secrets.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+
+    def show(series, inverter_data):
+        mean, high = latest(series, 'power')
+        print ('%s %6.0fW (1 min mean %.0fW, max %.0fW) %.1fC %.1fkWh' % (time.strftime('%H:%M:%S'), inverter_data['Current_Power_W'],
+            mean, high, inverter_data['Temperature_C'], inverter_data['Yield_Today_kWh']))
+
+    series = poll(config, new_series(interval=args.interval), duration=args.duration, callback=show if args.verbose else None)
+    print ('%d samples, %d errors' % (series['samples'], series['errors']))
+    power_ramps = dict(ramps(series, 'power', args.period))
+    temperatures = dict((d[0], d[1]) for d in downsample(series, 'temperature', args.period))
+    print ('%-8s %8s %8s %8s %10s %6s' % ('Period', 'Mean W', 'Min W', 'Max W', 'Ramp W/min', 'Temp C'))
+    for start, mean, low, high, n in downsample(series, 'power', args.period):
+        ramp = power_ramps.get(start)
+        print ('%-8s %8.0f %8.0f %8.0f %10s %6.1f' % (time.strftime('%H:%M', time.localtime(start)), mean, low, high,
+            '%.0f' % ramp if ramp is not None else '-', temperatures[start]))
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+import os
+import time
+import argparse
+import itertools
+import yaml
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError: # optional dependency - see setup.py extras
+    raise ImportError("solis_simulate needs numpy - install it with 'pip install numpy' or 'pip install soliscontrol[numpy]'") from None
+
+try:
+    import solis_common as common
+    import solis_planner as planner
+    import solis_ingest as ingest
+    import solis_tariff as tariff
+except ImportError:
+    from soliscontrol import solis_common as common
+    from soliscontrol import solis_planner as planner
+    from soliscontrol import solis_ingest as ingest
+    from soliscontrol import solis_tariff as tariff
+
+""" Battery and tariff simulator for backtesting the Flux charge/discharge strategy over historical data
+
+Household consumption and solar generation are replayed minute by minute for every day and every parameter set
+(config) at once - the state is held in numpy arrays of configs x days. Before each charge/discharge period
+(cron_before minutes ahead) the same plan is made as by solis_flux_times - the requirement from the maximum
+daily consumption over the previous history_days (or daily_consumption_kwh) scaled to the rest of the day,
+less the solar forecast for the rest of the day, but at least base_reserve_kwh (see calc_level() and
+calc_requirement()) - and the times are worked out with the vectorised solis_planner functions.
+Outside the planned times the battery covers the load and stores surplus solar (self use) within the
+limits set by battery_capacity, battery_ods and battery_max_current (or inverter_max_current if lower)
+
+As every day is simulated together, each day needs the battery energy at the end of the day before. This is
+found by fixed-point iteration - all days are run from a guess, the end of each day becomes the start of the
+next and only the days whose starting energy changed are run again until nothing changes (after the second
+pass there are few as a full or empty battery or a charge to target makes the rest of the day independent of the start)
+
+For each config the result has the cost, grid import and export and the reserve breaches (minutes and days
+when the available energy was below base_reserve_kwh outside a charge period and minutes when the battery was empty)
+
+The solar forecast is the actual solar for the rest of the day times forecast_multiplier and a random daily
+error (log-normal, forecast_error) which is the same for every config. Costs use the 'tariff' in each config (default
+DEFAULT_TARIFF) or slot prices as used by solis_tariff. Periods must not cross midnight
+
+3 years of data for 100 configs runs in a few seconds
+
+Requires numpy"""
+
+MINUTES = 1440
+DTYPE = np.float32 # of the minute by minute state
+DEFAULT_TARIFF = { # illustrative Flux-like rates (per kWh) - 'windows' override the default rates between start and end
+    'import': 0.28,
+    'export': 0.15,
+    'windows': [
+        { 'start': '02:00', 'end': '05:00', 'import': 0.17, 'export': 0.05 },
+        { 'start': '16:00', 'end': '19:00', 'import': 0.39, 'export': 0.30 },
+    ],
+}
+DEFAULTS = { # settings as the solis_flux_times app defaults (battery_ods is normally read from the inverter)
+    'battery_ods': 20.0,
+    'history_days': 7,
+    'cron_before': 20,
+    'forecast_multiplier': 1.0,
+}
+DEFAULT_ERROR = 0.3 # sigma of the log-normal daily forecast error
+TOLERANCE = 0.01 # kWh - the fixed-point iteration stops when no day start changes by more than this
+MAX_PASSES = 20
+MIN_SAMPLES = 200 # fewest 5 minute samples for a stored day to be used (out of 288)
+
+def synthetic_days(days=365, seed=1):
+    # dict with 'dates', 'load' and 'pv' (days x minutes arrays in kW) of made up but plausible data
+    gen = np.random.default_rng(seed)
+    minute = np.arange(MINUTES) / 60.0
+    season = np.cos(2.0 * np.pi * (np.arange(days) - 172) / 365.0)[:, None] # 1 in midsummer, -1 in midwinter
+    daylight = 12.0 + 4.0 * season
+    sun = np.clip(np.sin(np.pi * (minute - (12.5 - daylight / 2.0)) / daylight), 0.0, None)
+    cloud = gen.uniform(0.2, 1.0, (days, 1)) * np.clip(1.0 + 0.3 * gen.standard_normal((days, MINUTES)), 0.0, None)
+    pv = 4.0 * (0.6 + 0.4 * season) * sun * cloud
+    base = 0.15 + 0.05 * gen.standard_normal((days, 1)) ** 2 - 0.05 * season
+    peaks = 1.2 * np.exp(-((minute - 7.5) / 0.8) ** 2) + 1.8 * np.exp(-((minute - 18.5) / 1.5) ** 2)
+    load = base + peaks * gen.uniform(0.6, 1.4, (days, 1)) + gen.exponential(0.05, (days, MINUTES))
+    dates = np.datetime64('2023-01-01') + np.arange(days)
+    return { 'dates': [ str(d) for d in dates ], 'load': load, 'pv': pv }
+
+def stored_days(store, inverter_sn):
+    # dict with 'dates', 'load' and 'pv' (days x minutes arrays in kW) from the 5 minute history stored by solis_ingest
+    # each day is interpolated to minutes - days with fewer than MIN_SAMPLES samples are left out
+    data = ingest.load_table(store, inverter_sn, 'day', [ 'time', 'load_power', 'pv_power' ], mmap=False)
+    ok = ~(np.isnan(data['load_power']) | np.isnan(data['pv_power']))
+    load = data['load_power'][ok]
+    pv = data['pv_power'][ok]
+    local = np.array([ datetime.fromtimestamp(t) for t in data['time'][ok] ], dtype='datetime64[s]')
+    day = local.astype('datetime64[D]')
+    minute = (local - day).astype(np.float64) / 60.0
+    dates, first, counts = np.unique(day, return_index=True, return_counts=True)
+    grid = np.arange(MINUTES, dtype=np.float64)
+    result = { 'dates': [], 'load': [], 'pv': [] }
+    for date, i, n in zip(dates, first, counts):
+        if n >= MIN_SAMPLES:
+            result['dates'].append(str(date))
+            result['load'].append(np.interp(grid, minute[i:i + n], load[i:i + n]))
+            result['pv'].append(np.interp(grid, minute[i:i + n], pv[i:i + n]))
+    result['load'] = np.array(result['load']).reshape(-1, MINUTES)
+    result['pv'] = np.array(result['pv']).reshape(-1, MINUTES)
+    return result
+
+def tariff_rates(rates_config):
+    # (import, export) arrays of the rate for each minute of the day from a tariff dict (see DEFAULT_TARIFF)
+    minutes = np.arange(MINUTES)
+    rates = np.empty((2, MINUTES), dtype=np.float64)
+    rates[0] = rates_config['import']
+    rates[1] = rates_config['export']
+    for window in rates_config.get('windows') or []:
+        start = common.hhmm_to_minutes(window['start'])
+        end = common.hhmm_to_minutes(window['end'])
+        inside = (minutes >= start) & (minutes < end) if start < end else (minutes >= start) | (minutes < end)
+        rates[0, inside] = window.get('import', rates_config['import'])
+        rates[1, inside] = window.get('export', rates_config['export'])
+    return rates
+
+def price_rates(prices, export=None, start='00:00'):
+    # (import, export) arrays of the rate for each minute of the day from slot prices eg from solis_tariff.load_prices()
+    # with no export prices nothing is paid for export
+    smins = tariff.slot_minutes(len(prices))
+    shift = common.hhmm_to_minutes(start)
+    rates = np.zeros((2, MINUTES), dtype=np.float64)
+    rates[0] = np.roll(np.repeat(prices, smins), shift)
+    if export is not None:
+        rates[1] = np.roll(np.repeat(export, smins), shift)
+    return rates
+
+def sweep(base, ranges):
+    # list of configs - base with every combination of the values in ranges (name -> list of values)
+    # a name with a dot sets a value inside a period eg 'charge_period.current'
+    configs = []
+    names = list(ranges)
+    for values in itertools.product(*[ ranges[n] for n in names ]):
+        config = { k: dict(v) if isinstance(v, dict) else v for k, v in base.items() }
+        for name, value in zip(names, values):
+            if '.' in name:
+                period, key = name.split('.', 1)
+                config[period][key] = value
+            else:
+                config[name] = value
+        configs.append(config)
+    return configs
+
+def config_arrays(configs, rates=None):
+    # settings of each config as arrays (one value per config) and a list of period dicts of arrays
+    # rates (see price_rates()) apply to every config otherwise each config has its own 'tariff' (default DEFAULT_TARIFF)
+    # note every config must have the same periods as the first one and periods with a text (entity) kwh_requirement are timed as if it was not set
+    def get(key):
+        return np.array([ c.get(key, DEFAULTS.get(key)) for c in configs ], dtype=np.float64)
+    settings = {
+        'capacity': get('battery_capacity'),
+        'ods': get('battery_ods'),
+        'max_current': np.array([ min(c['battery_max_current'], c.get('inverter_max_current') or c['battery_max_current']) for c in configs ], dtype=np.float64),
+        'history_days': get('history_days').astype(np.int64),
+        'forecast_multiplier': get('forecast_multiplier'),
+        'daily_consumption': np.array([ c.get('daily_consumption_kwh') or np.nan for c in configs ], dtype=np.float64),
+        'base_reserve': np.array([ c.get('base_reserve_kwh', c['battery_capacity'] * 0.15) for c in configs ], dtype=np.float64),
+        'eah': np.array([ common.period_eah(c, True) or common.ENERGY_AMP_HOUR for c in configs ], dtype=np.float64),
+    }
+    settings['full'] = settings['capacity'] * (1.0 - settings['ods'] / 100.0)
+    if rates is None:
+        rates = np.array([ tariff_rates(c.get('tariff') or DEFAULT_TARIFF) for c in configs ])
+    else:
+        rates = np.broadcast_to(rates, (len(configs), 2, MINUTES))
+    settings['import_rate'] = rates[:, 0, :]
+    settings['export_rate'] = rates[:, 1, :]
+    cron_before = get('cron_before').astype(np.int64)
+    periods = []
+    for p in common.extract_periods(configs[0], max_three=False):
+        values = [ c[p['name']] for c in configs ]
+        requirement = [ v.get('kwh_requirement') for v in values ]
+        period = {
+            'name': p['name'],
+            'charge': p['charge'],
+            'start': np.array([ common.hhmm_to_minutes(v['start']) for v in values ], dtype=np.int64),
+            'end': np.array([ common.hhmm_to_minutes(v['end']) for v in values ], dtype=np.int64),
+            'current': np.array([ v['current'] for v in values ], dtype=np.float64),
+            'sync': np.array([ planner.sync_code(v.get('sync')) for v in values ], dtype=np.int64),
+            'requirement': np.array([ np.nan if r is None or isinstance(r, str) else r for r in requirement ], dtype=np.float64),
+            'eah': np.array([ common.period_eah(c, p['charge'], v['current']) or common.ENERGY_AMP_HOUR for c, v in zip(configs, values) ], dtype=np.float64),
+        }
+        if (period['end'] < period['start']).any():
+            raise common.SolisControlException('Cannot simulate %s: periods crossing midnight are not supported' % p['name'])
+        period['trigger'] = np.maximum(period['start'] - cron_before, 0)
+        period['remain'] = (MINUTES - period['start']) / float(MINUTES) # proportion of day remaining - see calc_requirement()
+        periods.append(period)
+    return settings, periods
+
+def daily_requirement(daily_load, history_days, fixed):
+    # configs x days array of the full day requirement - the maximum daily consumption over the previous history_days
+    # (the day itself on the first day) unless a fixed daily_consumption_kwh is set
+    days = len(daily_load)
+    result = np.empty((len(history_days), days))
+    for n in np.unique(history_days):
+        padded = np.concatenate((np.full(n, -np.inf), daily_load))
+        previous = np.lib.stride_tricks.sliding_window_view(padded[:-1], n).max(axis=1)
+        previous[0] = daily_load[0]
+        result[history_days == n] = previous
+    return np.where(np.isnan(fixed)[:, None], result, fixed[:, None])
+
+def simulate_days(data, settings, periods, start_energy, days, fractions):
+    # run the given days (index array) for every config from start_energy (configs x days) - returns a dict of configs x days arrays
+    # of the totals for each day and the 'end_energy'
+    # fractions (periods x configs x days, uniform in [0, 1)) place the times of periods with random sync - see solis_planner
+    # the minute by minute state is float32 (to halve the memory traffic) and planned times are only checked when they start or end
+    net = np.ascontiguousarray((data['pv'][days] - data['load'][days]).T / 60.0, dtype=DTYPE) # minutes x days of solar surplus (+ve) or shortfall in kWh
+    remaining_pv = np.ascontiguousarray(data['remaining_pv'][days].T)
+    error = data['forecast_factor'][days]
+    requirement = data['requirement'][:, days]
+    full = settings['full'][:, None]
+    full32 = full.astype(DTYPE)
+    max_rate = (settings['max_current'] * settings['eah'] / 60.0)[:, None].astype(DTYPE) # kWh per minute for self use
+    base_reserve = settings['base_reserve'][:, None]
+    export_rate = np.ascontiguousarray(settings['export_rate'].T[:, :, None], dtype=DTYPE)
+    extra_rate = np.ascontiguousarray((settings['import_rate'] - settings['export_rate']).T[:, :, None], dtype=DTYPE)
+    shape = (len(full), len(days))
+    energy = np.minimum(start_energy[:, days], full).astype(DTYPE)
+    totals = { k: np.zeros(shape, dtype=DTYPE) for k in ('import', 'grid', 'cost', 'breach', 'empty') }
+    events = {} # minute -> list of (period index, starting) for planned times starting (True) or ending (False)
+    required = [ np.where(np.isnan(p['requirement'])[:, None], requirement * p['remain'][:, None], p['requirement'][:, None]) for p in periods ]
+    planned = [ (np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=np.int64)) for p in periods ]
+    forced = np.zeros(shape, dtype=DTYPE) # +ve charging, -ve discharging (kWh per minute) in planned times
+    is_forced = np.zeros(shape, dtype=bool)
+    charging = np.zeros(shape, dtype=bool)
+    new_energy = np.empty(shape, dtype=DTYPE)
+    grid = np.empty(shape, dtype=DTYPE)
+    low = np.empty(shape, dtype=bool)
+    reserve32 = base_reserve.astype(DTYPE)
+    for minute in range(MINUTES):
+        for p, period in enumerate(periods):
+            planning = period['trigger'] == minute
+            if not planning.any():
+                continue
+            forecast = remaining_pv[minute][None, :] * error[None, :] * settings['forecast_multiplier'][planning, None]
+            level = np.maximum(required[p][planning] - forecast, base_reserve[planning])
+            level = np.where(required[p][planning] < 0.0, -1.0, level) # negative requirement - do nothing
+            config_period = { k: period[k][planning, None] for k in ('start', 'end', 'current', 'sync') }
+            rng = fractions[p][planning] # same random placement each time a day is run
+            if period['charge']:
+                start, end, _ = planner.charge_times(config_period, full[planning], energy[planning], level, period['eah'][planning, None], rng)
+            else:
+                start, end, _ = planner.discharge_times(config_period, energy[planning], level, period['eah'][planning, None], rng)
+            planned[p][0][planning] = np.where(start == end, -1, start) # -1 never starts or ends
+            planned[p][1][planning] = np.where(start == end, -1, end)
+            for m in np.unique(start[start != end]):
+                events.setdefault(int(m), []).append((p, True))
+            for m in np.unique(end[start != end]):
+                events.setdefault(int(m), []).append((p, False))
+        for p, starting in sorted(events.pop(minute, []), key=lambda e: e[1]): # ends first
+            period = periods[p]
+            mask = planned[p][0 if starting else 1] == minute
+            if starting:
+                rate = (period['current'] * period['eah'] / 60.0 * (1.0 if period['charge'] else -1.0)).astype(DTYPE)
+                forced[mask] = np.broadcast_to(rate[:, None], shape)[mask]
+            is_forced[mask] = starting
+            if period['charge']:
+                charging[mask] = starting
+        np.maximum(net[minute], -max_rate, out=new_energy) # self use
+        np.minimum(new_energy, max_rate, out=new_energy)
+        if is_forced.any():
+            np.copyto(new_energy, forced, where=is_forced)
+        new_energy += energy
+        np.maximum(new_energy, 0.0, out=new_energy) # limited by the energy available and the room left
+        np.minimum(new_energy, full32, out=new_energy)
+        np.subtract(new_energy, energy, out=grid) # battery charge (+ve) or discharge
+        grid -= net[minute] # +ve import
+        energy, new_energy = new_energy, energy
+        totals['grid'] += grid
+        totals['cost'] += grid * export_rate[minute]
+        np.maximum(grid, 0.0, out=grid)
+        totals['import'] += grid
+        totals['cost'] += grid * extra_rate[minute] # so cost is import * import rate - export * export rate
+        np.less(energy, reserve32, out=low)
+        low &= ~charging
+        totals['breach'] += low
+        np.less_equal(energy, 0.0, out=low)
+        totals['empty'] += low
+    totals['export'] = totals['import'] - totals.pop('grid')
+    totals['end_energy'] = energy.astype(np.float64)
+    return { k: v.astype(np.float64) for k, v in totals.items() }
+
+def simulate(data, configs, rates=None, initial_level=None, forecast_error=DEFAULT_ERROR, seed=1, tolerance=TOLERANCE, max_passes=MAX_PASSES):
+    # simulate every day of data (see synthetic_days() or stored_days()) for every config, the battery starting at
+    # initial_level available energy (default half full) - rates are as for config_arrays()
+    # returns a summary dict with a result dict for each config and the number of fixed-point 'passes'
+    settings, periods = config_arrays(configs, rates)
+    days = len(data['load'])
+    gen = np.random.default_rng(seed)
+    fractions = gen.random((len(periods), len(configs), days)) # for random sync - drawn once so the iteration can settle
+    data = dict(data)
+    data['remaining_pv'] = np.cumsum(data['pv'][:, ::-1], axis=1)[:, ::-1] / 60.0 # kWh from each minute to the end of the day
+    data['forecast_factor'] = np.exp(gen.normal(0.0, forecast_error, days)) if forecast_error else np.ones(days)
+    data['requirement'] = daily_requirement(data['load'].sum(axis=1) / 60.0, settings['history_days'], settings['daily_consumption'])
+    if initial_level is None:
+        first_level = settings['full'] * 0.5
+    else:
+        first_level = np.minimum(np.broadcast_to(np.asarray(initial_level, dtype=np.float64), settings['full'].shape), settings['full'])
+    start_energy = np.repeat(first_level[:, None], days, axis=1)
+    totals = None
+    run = np.arange(days)
+    passes = 0
+    while len(run) and passes < max_passes:
+        passes += 1
+        result = simulate_days(data, settings, periods, start_energy, run, fractions[:, :, run])
+        if totals is None:
+            totals = result
+        else:
+            for k in totals:
+                totals[k][:, run] = result[k]
+        new_start = np.concatenate((first_level[:, None], totals['end_energy'][:, :-1]), axis=1)
+        run = np.flatnonzero(np.abs(new_start - start_energy).max(axis=0) > tolerance)
+        start_energy = new_start
+    results = []
+    for i in range(len(configs)):
+        results.append({
+            'cost': float(totals['cost'][i].sum()),
+            'daily_cost': float(totals['cost'][i].mean()),
+            'import': float(totals['import'][i].sum()),
+            'export': float(totals['export'][i].sum()),
+            'breach_minutes': int(totals['breach'][i].sum()),
+            'breach_days': int((totals['breach'][i] > 0).sum()),
+            'empty_minutes': int(totals['empty'][i].sum()),
+        })
+    return { 'results': results, 'days': days, 'passes': passes, 'converged': not len(run) }
+
+def parse_sweep(text):
+    # 'name=v1,v2,...' -> (name, [ values ]) with the values typed as in YAML
+    name, values = text.split('=', 1)
+    return name.strip(), [ yaml.safe_load(v) for v in values.split(',') ]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Backtest the Flux charge/discharge strategy for many parameter sets over historical or synthetic data',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("store", help="folder of data stored by solis_ingest.py (made up data if not set)", nargs='?')
+    parser.add_argument("-s", "--sn", help="inverter serial number in the store (default the first)")
+    parser.add_argument("-c", "--config", help="YAML config file (main.yaml settings plus any solis_flux_times settings and an optional 'tariff')", default='main.yaml')
+    parser.add_argument("-p", "--param", help="setting values to sweep eg base_reserve_kwh=1,2,3 or charge_period.current=30,50 (can be repeated)", action='append', default=[])
+    parser.add_argument("-f", "--prices", help="CSV or JSON price file (see solis_tariff.py) used instead of the tariff")
+    parser.add_argument("-d", "--days", help="number of days of made up data", type=int, default=3 * 365)
+    parser.add_argument("-e", "--error", help="sigma of the log-normal daily solar forecast error", type=float, default=DEFAULT_ERROR)
+    parser.add_argument("-r", "--seed", help="random seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        base = yaml.safe_load(file)
+    if args.store:
+        data = stored_days(args.store, args.sn or sorted(os.listdir(args.store))[0])
+    else:
+        data = synthetic_days(args.days, args.seed)
+    rates = price_rates(*tariff.load_prices(args.prices)) if args.prices else None
+    ranges = dict(parse_sweep(p) for p in args.param)
+    configs = sweep(base, ranges)
+    started = time.perf_counter()
+    summary = simulate(data, configs, rates, forecast_error=args.error, seed=args.seed)
+    elapsed = time.perf_counter() - started
+    print ('%d days x %d configs in %.1fs (%d passes%s)' % (summary['days'], len(configs), elapsed, summary['passes'],
+        '' if summary['converged'] else ', not converged'))
+    names = list(ranges)
+    values = list(itertools.product(*[ ranges[n] for n in names ]))
+    print (''.join('%-24s' % n for n in names) + '%10s %10s %10s %9s %9s %8s' % ('Cost', 'Import kWh', 'Export kWh', 'Breach d', 'Breach m', 'Empty m'))
+    for i in sorted(range(len(configs)), key=lambda i: summary['results'][i]['cost']):
+        r = summary['results'][i]
+        print (''.join('%-24s' % v for v in values[i]) + '%10.2f %10.1f %10.1f %9d %9d %8d' % (r['cost'], r['import'], r['export'],
+            r['breach_days'], r['breach_minutes'], r['empty_minutes']))
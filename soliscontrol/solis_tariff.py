@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+import json
+import csv
+import time
+import argparse
+import yaml
+
+try:
+    import numpy as np
+except ImportError: # optional dependency - see setup.py extras
+    raise ImportError("solis_tariff needs numpy - install it with 'pip install numpy' or 'pip install soliscontrol[numpy]'") from None
+
+try:
+    import solis_common as common
+except ImportError:
+    from soliscontrol import solis_common as common
+
+""" Dynamic tariff optimiser for half-hourly (eg Octopus Agile) or other regularly priced tariffs
+
+Instead of filling one fixed window per configured period, this chooses which slots of the day to charge
+(or discharge) the battery to minimise import cost (less any export revenue) while finishing the day
+with at least a target level of available energy. The choice is made by dynamic programming over
+battery energy levels (vectorised with numpy) and is limited to the 3 charge and 3 discharge
+windows which the inverter supports (cid 103) - see pack_edits()
+
+A 48 slot day solves in a few milliseconds so it can be run across a whole fleet
+
+Prices are read from a CSV or JSON file - see load_prices()
+
+Requires numpy"""
+
+IDLE = 0
+CHARGE = 1
+DISCHARGE = 2
+MAX_WINDOWS = 3 # charge and discharge time slots available on the inverter
+INF = float('inf')
+
+def load_prices(price_file):
+    # returns (import prices, export prices or None, start HH:MM) from a price file for one day
+    # JSON can be a list of prices, or a dict with 'prices', optional 'export' list and optional 'start' (HH:MM)
+    # or an Octopus API response dict with 'results' each having 'value_inc_vat' and 'valid_from'
+    # CSV has one row per slot with either 'price' or 'HH:MM,price' or 'HH:MM,price,export'
+    start = '00:00'
+    export = None
+    if price_file.lower().endswith('.json'):
+        with open(price_file, 'r') as file:
+            data = json.load(file)
+        if isinstance(data, list):
+            prices = data
+        elif 'results' in data:
+            results = sorted(data['results'], key=lambda r: r['valid_from'])
+            prices = [ r['value_inc_vat'] for r in results ]
+            start = results[0]['valid_from'][11:16] if results else start
+        else:
+            prices = data['prices']
+            export = data.get('export')
+            start = data.get('start', start)
+    else:
+        prices = []
+        export = []
+        with open(price_file, 'r', newline='') as file:
+            for i, row in enumerate(csv.reader(file)):
+                row = [ r.strip() for r in row if r.strip() ]
+                if not row:
+                    continue
+                try:
+                    values = [ float(r) for r in (row[1:] if ':' in row[0] else row) ]
+                except ValueError: # header row
+                    continue
+                if ':' in row[0] and not prices:
+                    start = row[0]
+                prices.append(values[0])
+                if len(values) > 1:
+                    export.append(values[1])
+        export = export if export and len(export) == len(prices) else None
+    prices = np.asarray(prices, dtype=np.float64)
+    if export is not None:
+        export = np.asarray(export, dtype=np.float64)
+    return prices, export, start
+
+def slot_minutes(n_slots):
+    # duration of each slot when the day is split into n_slots
+    if n_slots <= 0 or 1440 % n_slots:
+        raise common.SolisControlException('Bad number of price slots: should divide into 1440 minutes -> %d' % n_slots)
+    return 1440 // n_slots
+
+def optimise(prices, current_energy, full_energy, charge_amps, discharge_amps=None, export_prices=None,
+        target_level=0.0, reserve_level=0.0, eah=None, start='00:00', resolution=None):
+    # find the cheapest charge/discharge slots for one day of prices (one price per equal slot from 'start')
+    # current_energy, full_energy, target_level and reserve_level are available energy in kWh - see common.energy_values()
+    # target_level is the minimum energy at the end and reserve_level the minimum energy while discharging
+    # discharging is only considered if export_prices and discharge_amps are given
+    # resolution is the size of the energy steps used (kWh) - default is a quarter of the energy charged per slot
+    # returns a dict with 'cost', 'actions' (IDLE/CHARGE/DISCHARGE per slot), 'energy' (after each slot),
+    # 'minutes' (active minutes in each slot), 'charge_windows' and 'discharge_windows' (lists of (start, end) minutes)
+    prices = np.asarray(prices, dtype=np.float64)
+    n = len(prices)
+    smins = slot_minutes(n)
+    eah = eah if eah else common.ENERGY_AMP_HOUR
+    charge_kwh = charge_amps * eah * smins / 60.0 # energy added by charging for a whole slot
+    discharging = export_prices is not None and bool(discharge_amps)
+    discharge_kwh = discharge_amps * eah * smins / 60.0 if discharging else charge_kwh
+    if not resolution:
+        resolution = min(charge_kwh, discharge_kwh) / 4.0
+    c = max(1, int(round(charge_kwh / resolution))) # energy steps per slot
+    d = max(1, int(round(discharge_kwh / resolution)))
+    top = int(full_energy / resolution) # energy steps when full
+    n_levels = top + 1
+    e0 = min(max(int(round(current_energy / resolution)), 0), top)
+    floor = min(int(np.ceil(reserve_level / resolution)), top)
+    target = min(int(np.ceil(target_level / resolution)), top)
+    export_prices = np.asarray(export_prices, dtype=np.float64) if discharging else np.zeros(n)
+    first = common.hhmm_to_minutes(start) or 0
+
+    k = MAX_WINDOWS + 1
+    kd = k if discharging else 1 # no discharge window dimension needed when only charging
+    shape = (k, kd, 3, n_levels) # charge windows used, discharge windows used, mode, energy level
+    levels = np.arange(n_levels)
+    steps = { CHARGE: c, DISCHARGE: d }
+    after = { CHARGE: np.minimum(levels + c, top), # level reached from each level by a whole slot
+        DISCHARGE: np.where(levels > floor, np.maximum(levels - d, floor), levels) }
+    moves = { CHARGE: (after[CHARGE] - levels) * resolution, DISCHARGE: (levels - after[DISCHARGE]) * resolution }
+    value = np.full(shape, INF)
+    value[0, 0, IDLE, e0] = 0.0
+    values = [ value ] # value of every state before each slot, kept for the trace back
+    for t in range(n):
+        new_value = np.full(shape, INF)
+        midnight = t > 0 and (first + t * smins) % 1440 == 0 # windows cannot run over midnight
+        new_value[:, :, IDLE, :] = value.min(axis=2) # idle from any mode
+        for action, price in ((CHARGE, prices[t]), (DISCHARGE, -export_prices[t])):
+            if action == DISCHARGE and (not discharging or floor >= top):
+                continue
+            other = DISCHARGE if action == CHARGE else CHARGE
+            # either continue an existing window or open a new window from idle/the other mode
+            opened = np.full((k, kd, n_levels), INF)
+            src = np.minimum(value[:, :, IDLE, :], value[:, :, other, :])
+            if action == CHARGE:
+                opened[1:] = src[:-1]
+            else:
+                opened[:, 1:] = src[:, :-1]
+            cand = opened if midnight else np.minimum(value[:, :, action, :], opened)
+            cost = cand + price * moves[action]
+            # shift energy levels - charging is clipped when full and discharging at the reserve
+            # so several source levels can end at the clipped level (the cheapest is kept)
+            result = new_value[:, :, action, :]
+            s = steps[action]
+            if action == CHARGE:
+                if s < top:
+                    result[:, :, s:top] = cost[:, :, :top-s]
+                result[:, :, top] = cost[:, :, max(top - s, 0):].min(axis=2)
+            else:
+                if floor + s < top:
+                    result[:, :, floor+1:top-s+1] = cost[:, :, floor+1+s:]
+                result[:, :, floor] = cost[:, :, floor+1:min(floor + s, top) + 1].min(axis=2)
+        value = new_value
+        values.append(value)
+
+    final = value[:, :, :, target:]
+    if not np.isfinite(final).any():
+        raise common.SolisControlException('No plan reaches target level %.1fkWh' % target_level)
+    state = np.unravel_index(np.argmin(final), final.shape)
+    state = (int(state[0]), int(state[1]), int(state[2]), int(state[3]) + target)
+    cost = float(value[state])
+
+    # trace back the chosen states by finding the cheapest predecessor of each
+    states = [ state ]
+    for t in range(n - 1, -1, -1):
+        before = values[t]
+        kc, kdis, mode, lvl = state
+        if mode == IDLE:
+            candidates = [ ((kc, kdis, m, lvl), 0.0) for m in (IDLE, CHARGE, DISCHARGE) ]
+        else:
+            midnight = t > 0 and (first + t * smins) % 1440 == 0
+            price = prices[t] if mode == CHARGE else -export_prices[t]
+            other = DISCHARGE if mode == CHARGE else CHARGE
+            candidates = []
+            for src in np.nonzero(after[mode] == lvl)[0]:
+                src = int(src)
+                if src == lvl and mode == DISCHARGE: # no move at or below the reserve
+                    continue
+                extra = price * moves[mode][src]
+                if not midnight:
+                    candidates.append(((kc, kdis, mode, src), extra))
+                if mode == CHARGE and kc > 0:
+                    candidates += [ ((kc - 1, kdis, m, src), extra) for m in (IDLE, other) ]
+                elif mode == DISCHARGE and kdis > 0:
+                    candidates += [ ((kc, kdis - 1, m, src), extra) for m in (IDLE, other) ]
+        state = min(candidates, key=lambda cand: before[cand[0]] + cand[1])[0]
+        states.append(state)
+    states.reverse() # states[0] is the start, states[t+1] is after slot t
+    levels = np.array([ s[3] for s in states ])
+    actions = np.array([ s[2] for s in states[1:] ])
+    energy = levels[1:] * resolution
+    minutes = np.zeros(n, dtype=np.int64)
+    for t in range(n):
+        moved = abs(levels[t+1] - levels[t])
+        if actions[t] == CHARGE:
+            minutes[t] = int(np.ceil(smins * moved / c))
+        elif actions[t] == DISCHARGE:
+            minutes[t] = int(np.ceil(smins * moved / d))
+    return {
+        'cost': cost,
+        'actions': actions,
+        'energy': energy,
+        'minutes': minutes,
+        'charge_windows': windows(actions, minutes, CHARGE, first, smins),
+        'discharge_windows': windows(actions, minutes, DISCHARGE, first, smins),
+        'slot_minutes': smins,
+        'start': first,
+    }
+
+def windows(actions, minutes, action, first=0, smins=30):
+    # contiguous runs of an action as (start, end) minutes from midnight
+    # a run ending part way through a slot (eg when the battery becomes full) is trimmed to the minutes used
+    result = []
+    run_start = None
+    for t in range(len(actions) + 1):
+        slot_start = (first + t * smins) % 1440
+        active = t < len(actions) and actions[t] == action and not (run_start is not None and slot_start == 0)
+        if active and run_start is None:
+            run_start = slot_start
+        elif not active and run_start is not None:
+            last = t - 1
+            while last > 0 and minutes[last] == 0 and (first + last * smins) % 1440 != run_start: # nothing moved (eg already full)
+                last -= 1
+            end = min((first + last * smins) % 1440 + int(minutes[last]), 1439)
+            if end > run_start:
+                result.append((run_start, end))
+            run_start = slot_start if t < len(actions) and actions[t] == action else None
+    return result
+
+def pack_edits(plan, charge_amps, discharge_amps=None):
+    # convert an optimised plan into (params, charge, timeslot) edits for the 3 inverter time slots
+    # unused time slots are turned off - see solis_control_req_mod.set_inverter_schedule()
+    edits = []
+    for charge, wins, amps in ((True, plan['charge_windows'], charge_amps), (False, plan['discharge_windows'], discharge_amps)):
+        if len(wins) > MAX_WINDOWS:
+            raise common.SolisControlException('Too many %s windows for inverter: %d' % ('charge' if charge else 'discharge', len(wins)))
+        for timeslot in range(MAX_WINDOWS):
+            if timeslot < len(wins):
+                start, end = wins[timeslot]
+                params = { 'start': common.minutes_to_hhmm(start), 'end': common.minutes_to_hhmm(end) }
+            else:
+                params = { 'start': '00:00', 'end': '00:00' }
+            if amps:
+                params['amps'] = str(amps)
+            edits.append((params, charge, timeslot))
+    return edits
+
+def describe(plan, prices):
+    # text lines summarising a plan
+    lines = []
+    for name, action in (('Charge', CHARGE), ('Discharge', DISCHARGE)):
+        for start, end in plan['charge_windows' if action == CHARGE else 'discharge_windows']:
+            lines.append('%s %s - %s' % (name, common.minutes_to_hhmm(start), common.minutes_to_hhmm(end)))
+    lines.append('Cost %.2f, final energy %.1fkWh' % (plan['cost'], plan['energy'][-1]))
+    return lines
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Optimise charge/discharge times for a dynamic tariff and optionally set them on the inverter',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("prices", help="CSV or JSON file of prices for each slot of the day")
+    parser.add_argument("-t", "--target", help="target available energy at end of the day (kWh)", type=float, default=0.0)
+    parser.add_argument("-r", "--reserve", help="minimum available energy when discharging (kWh)", type=float, default=0.0)
+    parser.add_argument("-a", "--apply", help="set the optimised times on the inverter", action='store_true')
+    parser.add_argument("-v", "--verbose", help="additional information messages are printed out", action='store_true')
+    args = parser.parse_args()
+
+    try:
+        import solis_control_req_mod as solis_control
+    except ImportError:
+        from soliscontrol import solis_control_req_mod as solis_control
+
+    with open('secrets.yaml', 'r') as file:
+        secrets = yaml.safe_load(file)
+    with open('main.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+    config.update(secrets)
+    prices, export, start = load_prices(args.prices)
+    charge_amps = config['charge_period']['current']
+    discharge_amps = config['discharge_period']['current'] if config.get('discharge_period') else None
+
+    with solis_control.get_session() as session:
+        if solis_control.connect(config, session):
+            unavailable_energy, full_energy, current_energy, real_soc = common.energy_values(config)
+            started = time.perf_counter()
+            plan = optimise(prices, current_energy, full_energy, charge_amps, discharge_amps, export,
+                target_level=args.target, reserve_level=args.reserve, eah=config.get('energy_amp_hour'), start=start)
+            if args.verbose:
+                print ('Solved %d slots in %.1fms' % (len(prices), (time.perf_counter() - started) * 1000.0))
+            print ('Current energy %.1fkWh (%.0f%% of max %.1fkWh)' % (current_energy, real_soc, full_energy))
+            for line in describe(plan, prices):
+                print (line)
+            if args.apply:
+                result = solis_control.set_inverter_schedule(config, session, pack_edits(plan, charge_amps, discharge_amps), verbose=args.verbose)
+                print ('Set inverter times:', result)
+        else:
+            print ('Error: could not connect to Solis API')
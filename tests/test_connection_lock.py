@@ -0,0 +1,56 @@
+import threading
+import time
+
+from soliscontrol import solis_bundle as bundle
+
+solis_control = bundle.solis_control
+
+def connected_handle():
+    # a handle which ensure_connected() treats as connected, logged in and time checked (so no API calls)
+    conn = solis_control.open_connection({ 'login_token': 'token' }, session=object())
+    now = time.time()
+    conn.update({ 'connected': now, 'token': 'token', 'token_expiry': now + 3600, 'time_checked': now, 'detail_time': now })
+    return conn
+
+def test_overlapping_bundle_calls_do_not_interleave(monkeypatch):
+    events = []
+    def get_inverter_data(config, session):
+        events.append(('enter', threading.get_ident()))
+        time.sleep(0.05)
+        events.append(('exit', threading.get_ident()))
+        return '0,0,0,0,00:00,00:00,00:00,00:00,0,0,0,0,00:00,00:00,00:00,00:00,0,0'
+    monkeypatch.setattr(solis_control, 'get_inverter_data', get_inverter_data)
+    conn = connected_handle()
+    results = []
+    threads = [ threading.Thread(target=lambda: results.append(bundle.read_schedule(conn))) for i in range(2) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [ r['status'] for r in results ] == [ 'OK', 'OK' ]
+    assert [ e[0] for e in events ] == [ 'enter', 'exit', 'enter', 'exit' ]
+    assert events[0][1] == events[1][1] and events[2][1] == events[3][1]
+    assert conn['lock']['owner'] is None
+
+def test_tasks_on_one_thread_take_turns(monkeypatch):
+    # under Pyscript every task runs on the event loop thread so the owner is the task, not the thread
+    conn = connected_handle()
+    current = [ 'task A' ]
+    monkeypatch.setattr(solis_control, 'lock_owner', lambda: current[0])
+    waits = []
+    def sleep(secs): # task B is waiting - let task A finish meanwhile
+        waits.append(current[0])
+        current[0] = 'task A'
+        solis_control.unlock_connection(conn)
+        solis_control.unlock_connection(conn)
+        current[0] = 'task B'
+    monkeypatch.setattr(solis_control, 'sleep', sleep)
+    solis_control.lock_connection(conn)
+    solis_control.lock_connection(conn) # the same task can take it again
+    assert conn['lock']['depth'] == 2
+    current[0] = 'task B'
+    solis_control.lock_connection(conn) # waits until task A has let go
+    assert waits == [ 'task B' ]
+    assert conn['lock']['owner'] == 'task B'
+    solis_control.unlock_connection(conn)
+    assert conn['lock']['owner'] is None